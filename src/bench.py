@@ -0,0 +1,263 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from lexer.lexer import Lexer, TableLexer
+from parser.parser import Parser
+from preprocessor import Preprocessor
+from cache import ParseCache
+from semantic import SemanticAnalyzer
+from optimizer.passes import PassManager, pipeline
+from ir.lower import Lowering
+from compiler.x86_64_linux import x86_64_Linux
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR = os.path.join(ROOT, "benchmarks")
+
+
+def corpus(lines):
+    with open(os.path.join(ROOT, "includes", "minlib.oxy")) as f:
+        unit = f.read() + "\n"
+    reps = max(1, lines // unit.count("\n"))
+    return unit * reps
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_lexer(args):
+    text = corpus(args.lines)
+    lines = text.count("\n")
+
+    old_time, old_tokens = timed(lambda: Lexer(text).tokenize(), args.repeat)
+    new_time, new_tokens = timed(lambda: TableLexer(text).tokenize(), args.repeat)
+
+    same = [(t.type, t.value) for t in old_tokens] == [(t.type, t.value) for t in new_tokens]
+    if not same:
+        print("error: lexers disagree on token stream")
+        sys.exit(1)
+
+    print(f"corpus: {lines} lines, {len(new_tokens)} tokens")
+    print(f"{'Lexer':<12} {lines / old_time:>12,.0f} lines/s")
+    print(f"{'TableLexer':<12} {lines / new_time:>12,.0f} lines/s  ({old_time / new_time:.1f}x)")
+
+
+def peak(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_memory(args):
+    def materialized(path):
+        with open(path) as f:
+            text = f.read()
+        return Parser(TableLexer(text).tokenize()).parse()
+
+    def streamed(path):
+        with open(path) as f:
+            return Parser(TableLexer(reader=f).stream()).parse()
+
+    def lex_only(path):
+        with open(path) as f:
+            for _ in TableLexer(reader=f).stream():
+                pass
+
+    print(f"{'lines':>8} {'read+list':>12} {'streamed':>12} {'lex stream':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for lines in args.sizes:
+            path = os.path.join(tmp, f"corpus{lines}.oxy")
+            with open(path, "w") as f:
+                f.write(corpus(lines))
+            print(f"{lines:>8} {peak(lambda: materialized(path)) / 1e6:>10.1f}MB "
+                  f"{peak(lambda: streamed(path)) / 1e6:>10.1f}MB "
+                  f"{peak(lambda: lex_only(path)) / 1e6:>10.1f}MB")
+
+
+def count_nodes(node):
+    total = 1
+    for child in node.children:
+        if child is not None:
+            total += count_nodes(child)
+    return total
+
+
+def bench_nodes(args):
+    text = corpus(args.lines)
+
+    tracemalloc.start()
+    tokens = TableLexer(text).tokenize()
+    token_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    parse_time, ast = timed(lambda: Parser(iter(tokens)).parse(), args.repeat)
+    del ast
+
+    tracemalloc.start()
+    ast = Parser(iter(tokens)).parse()
+    node_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    nodes = count_nodes(ast)
+
+    print(f"corpus: {text.count(chr(10))} lines, {len(tokens)} tokens, {nodes} nodes")
+    print(f"token: {token_bytes / len(tokens):.0f} bytes")
+    print(f"node:  {node_bytes / nodes:.0f} bytes")
+    print(f"parse: {parse_time * 1000:.0f}ms")
+
+
+def write_project(directory, modules, lines):
+    unit = corpus(lines)
+    includes = "".join(f'include "mod{i}.oxy";\n' for i in range(modules))
+    with open(os.path.join(directory, "main.oxy"), "w") as f:
+        f.write(includes + "fn main() -> int {\n    ret 0;\n}\n")
+    for i in range(modules):
+        with open(os.path.join(directory, f"mod{i}.oxy"), "w") as f:
+            f.write(f"// module {i}\n" + unit)
+
+
+def bench_cache(args):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        write_project(tmp, args.modules, args.lines)
+        cache_dir = os.path.join(tmp, "cache")
+        os.chdir(tmp)
+        try:
+            uncached, _ = timed(lambda: Preprocessor().process("main.oxy"), 1)
+            cold, _ = timed(lambda: Preprocessor(ParseCache(cache_dir)).process("main.oxy"), 1)
+            warm, _ = timed(lambda: Preprocessor(ParseCache(cache_dir)).process("main.oxy"), args.repeat)
+        finally:
+            os.chdir(cwd)
+
+    print(f"project: {args.modules} modules x ~{args.lines} lines")
+    print(f"{'no cache':<12} {uncached * 1000:>8.0f}ms")
+    print(f"{'cold cache':<12} {cold * 1000:>8.0f}ms")
+    print(f"{'warm cache':<12} {warm * 1000:>8.0f}ms  ({uncached / warm:.1f}x)")
+
+
+def bench_jobs(args):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        write_project(tmp, args.modules, args.lines)
+        os.chdir(tmp)
+        try:
+            serial, ast = timed(lambda: Preprocessor().process("main.oxy"), args.repeat)
+            parallel, par_ast = timed(lambda: Preprocessor(jobs=args.jobs).process("main.oxy"), args.repeat)
+        finally:
+            os.chdir(cwd)
+
+    if repr(ast) != repr(par_ast):
+        print("error: parallel front end produced a different program")
+        sys.exit(1)
+
+    print(f"project: {args.modules} modules x ~{args.lines} lines")
+    print(f"{'serial':<12} {serial * 1000:>8.0f}ms")
+    print(f"{f'--jobs {args.jobs}':<12} {parallel * 1000:>8.0f}ms  ({serial / parallel:.1f}x)")
+
+
+def build(source, directory, tag, passes):
+    manager = PassManager(passes)
+    ast = Preprocessor().process(source)
+    SemanticAnalyzer(ast).analyze()
+    ast = manager.run_ast(ast)
+    module = manager.run_ir(Lowering(ast).run())
+    asm = x86_64_Linux(module, **manager.backend_options()).generate()
+
+    base = os.path.join(directory, f"{os.path.splitext(os.path.basename(source))[0]}_{tag}")
+    with open(base + ".asm", "w") as f:
+        f.write(asm)
+    subprocess.run(["nasm", "-felf64", base + ".asm", "-o", base + ".o"], check=True)
+    subprocess.run(["gcc", base + ".o", "-no-pie", "-o", base], check=True)
+    return base, asm.count("\n") + 1
+
+
+def run_binary(path, repeat):
+    return timed(lambda: subprocess.run([path], capture_output=True, check=True).stdout, repeat)
+
+
+def bench_codegen(args):
+    # each mode is an -O level, the first one is the baseline
+    modes = [(f"-O{level}", pipeline(level)) for level in args.levels]
+    programs = args.programs or sorted(
+        os.path.join(BENCH_DIR, name) for name in os.listdir(BENCH_DIR) if name.endswith(".oxy"))
+
+    header = "".join(f" {name:>16}" for name, _ in modes)
+    print(f"{'program':<12}{header}  speedup")
+    with tempfile.TemporaryDirectory() as tmp:
+        for source in programs:
+            results = []
+            for tag, passes in modes:
+                binary, lines = build(source, tmp, tag, passes)
+                elapsed, output = run_binary(binary, args.repeat)
+                results.append((elapsed, lines, output))
+
+            name = os.path.splitext(os.path.basename(source))[0]
+            if any(output != results[0][2] for _, _, output in results):
+                print(f"error: {name} output differs between modes")
+                sys.exit(1)
+
+            cells = "".join(f" {t * 1000:>7.1f}ms {n:>5}L" for t, n, _ in results)
+            print(f"{name:<12}{cells}  {results[0][0] / results[-1][0]:.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Oxylang compiler benchmarks")
+    subparsers = parser.add_subparsers(dest="command")
+
+    lexer_parser = subparsers.add_parser("lexer", help="Compare lexer throughput")
+    lexer_parser.add_argument("--lines", type=int, default=50000, help="Approximate corpus size in lines")
+    lexer_parser.add_argument("--repeat", type=int, default=3, help="Runs per lexer, best time is reported")
+
+    memory_parser = subparsers.add_parser("memory", help="Compare front end peak memory, materialized vs streamed")
+    memory_parser.add_argument("--sizes", type=int, nargs="+", default=[5000, 20000, 80000], help="Corpus sizes in lines")
+
+    nodes_parser = subparsers.add_parser("nodes", help="Report token/AST memory and parse time")
+    nodes_parser.add_argument("--lines", type=int, default=50000, help="Approximate corpus size in lines")
+    nodes_parser.add_argument("--repeat", type=int, default=3, help="Parse runs, best time is reported")
+
+    cache_parser = subparsers.add_parser("cache", help="Compare cold and warm front end with the parse cache")
+    cache_parser.add_argument("--modules", type=int, default=40, help="Number of included modules")
+    cache_parser.add_argument("--lines", type=int, default=500, help="Approximate lines per module")
+    cache_parser.add_argument("--repeat", type=int, default=3, help="Warm runs, best time is reported")
+
+    jobs_parser = subparsers.add_parser("jobs", help="Compare serial and parallel front end")
+    jobs_parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Worker processes (default: cpu count)")
+    jobs_parser.add_argument("--modules", type=int, default=40, help="Number of included modules")
+    jobs_parser.add_argument("--lines", type=int, default=2000, help="Approximate lines per module")
+    jobs_parser.add_argument("--repeat", type=int, default=3, help="Runs per mode, best time is reported")
+
+    codegen_parser = subparsers.add_parser("codegen", help="Compare generated binaries across optimization levels")
+    codegen_parser.add_argument("programs", nargs="*", help="Programs to build (default: src/benchmarks/*.oxy)")
+    codegen_parser.add_argument("--levels", type=int, nargs="+", default=[0, 1, 2], help="-O levels to compare, the first is the baseline")
+    codegen_parser.add_argument("--repeat", type=int, default=5, help="Runs per binary, best time is reported")
+
+    args = parser.parse_args()
+    if args.command == "lexer":
+        bench_lexer(args)
+    elif args.command == "memory":
+        bench_memory(args)
+    elif args.command == "nodes":
+        bench_nodes(args)
+    elif args.command == "cache":
+        bench_cache(args)
+    elif args.command == "jobs":
+        bench_jobs(args)
+    elif args.command == "codegen":
+        bench_codegen(args)
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import gc
+import os
+import sys
+import marshal
+import hashlib
+from parser.parser import ASTNode
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "oxylang")
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+# modules whose output is what gets cached, any edit to them invalidates entries
+FRONTEND_SOURCES = ("lexer/lexer.py", "parser/parser.py", "cache.py")
+
+
+def frontend_version():
+    h = hashlib.sha256()
+    h.update(f"{sys.version_info[:2]} marshal {marshal.version}".encode())
+    root = os.path.dirname(os.path.abspath(__file__))
+    for name in FRONTEND_SOURCES:
+        with open(os.path.join(root, name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def dump_ast(node, out=None):
+    """Flatten a tree into a postorder tuple of (type, value, pos, child count) records"""
+    if out is None:
+        out = []
+        dump_ast(node, out)
+        return tuple(out)
+    if node is None:
+        out.append(None)
+        return
+    for child in node.children:
+        dump_ast(child, out)
+    out.extend((node.type, node.value, node.pos, len(node.children)))
+
+
+def load_ast(data):
+    # the tree is acyclic, collector passes while rebuilding it are pure overhead
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return build_ast(data)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def build_ast(data):
+    stack = []
+    push = stack.append
+    i = 0
+    end = len(data)
+    while i < end:
+        type_ = data[i]
+        if type_ is None:
+            push(None)
+            i += 1
+            continue
+        count = data[i + 3]
+        children = None
+        if count:
+            children = stack[-count:]
+            del stack[-count:]
+        push(ASTNode(type_, data[i + 1], children, data[i + 2]))
+        i += 4
+    return stack[0]
+
+
+class ParseCache:
+    """On-disk cache of parsed modules keyed by source content hash"""
+
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = frontend_version()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, path):
+        h = hashlib.sha256(self.version.encode())
+        with open(path, "rb") as f:
+            while chunk := f.read(self.CHUNK_SIZE):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.directory, key + ".ast")
+
+    def load(self, key):
+        path = self.entry(key)
+        try:
+            with open(path, "rb") as f:
+                data = marshal.loads(f.read())
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (EOFError, ValueError, TypeError):
+            # truncated or foreign entry, drop it and reparse
+            self.misses += 1
+            self.discard(path)
+            return None
+
+        ast = load_ast(data)
+
+        # mtime doubles as the last-use stamp for eviction, another process may have evicted it since
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return ast
+
+    def store(self, key, ast):
+        path = self.entry(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(marshal.dumps(dump_ast(ast)))
+        os.replace(tmp, path)
+        self.evict()
+
+    def discard(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for e in it:
+                if e.name.endswith(".ast"):
+                    try:
+                        st = e.stat()
+                    except FileNotFoundError:
+                        # evicted by a concurrent compile
+                        continue
+                    entries.append((st.st_mtime, st.st_size, e.path))
+                    total += st.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self.discard(path)
+            total -= size
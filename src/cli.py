@@ -2,7 +2,12 @@ import os
 import sys
 import argparse
 import compiler.x86_64_linux
+import optimizer.passes
+import optimizer.inline
+import ir.lower
+import ir.ir
 import lexer, parser, preprocessor, semantic # core
+import cache
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Oxylang Compiler CLI")
@@ -18,12 +23,29 @@ def parse_args():
     compile_parser.add_argument("-f", type=str, help="Oxylang source file to compile")
     compile_parser.add_argument("-o", type=str, help="Output file name for the compiled assembly code")
     compile_parser.add_argument("-arch", type=str, default="x86_64-linux", help="Target architecture (default: x86_64-linux)")
+    compile_parser.add_argument("--stats", action="store_true", help="Print optimization statistics")
+    compile_parser.add_argument("-O", dest="opt_level", type=int, choices=sorted(optimizer.passes.LEVELS), default=1, help="Optimization level (default: 1)")
+    compile_parser.add_argument("--enable-pass", action="append", default=[], metavar="PASS", help="Run PASS on top of the -O level")
+    compile_parser.add_argument("--disable-pass", action="append", default=[], metavar="PASS", help="Skip PASS even if the -O level runs it")
+    compile_parser.add_argument("--list-passes", action="store_true", help="Print the passes each -O level runs and exit")
+    compile_parser.add_argument("--inline-budget", type=int, default=optimizer.inline.DEFAULT_BUDGET, metavar="N", help=f"Inline functions of up to N IR instructions (default: {optimizer.inline.DEFAULT_BUDGET}, 0 disables)")
+    compile_parser.add_argument("--no-regalloc", action="store_true", help="Keep locals and temporaries on the stack (same as --disable-pass regalloc)")
+    compile_parser.add_argument("--dump-ir", action="store_true", help="Print the SSA intermediate representation")
+    compile_parser.add_argument("-I", dest="include_dirs", action="append", default=[], metavar="DIR", help="Add a directory to the include search path")
+    compile_parser.add_argument("-j", "--jobs", type=int, default=1, help="Lex and parse included modules in N worker processes (default: 1)")
+    compile_parser.add_argument("--cache-dir", type=str, default=cache.DEFAULT_CACHE_DIR, help="Directory for cached parsed modules (default: ~/.cache/oxylang)")
+    compile_parser.add_argument("--cache-size", type=int, default=cache.DEFAULT_CACHE_SIZE // (1024 * 1024), help="Parse cache size limit in MB (default: 64)")
+    compile_parser.add_argument("--no-cache", action="store_true", help="Always lex and parse every module")
 
     return parser.parse_args()
 
 def main():
     args = parse_args()
     if args.command == "compile":
+        if args.list_passes:
+            for level in sorted(optimizer.passes.LEVELS):
+                print(f"-O{level}: {' '.join(optimizer.passes.pipeline(level)) or '(none)'}")
+            return
         if not args.f:
             print("error: no source file specified")
             sys.exit(1)
@@ -32,10 +54,46 @@ def main():
             sys.exit(1)
 
         if args.arch == "x86_64-linux":
-            pp = preprocessor.Preprocessor()
+            disabled = args.disable_pass + (["regalloc"] if args.no_regalloc else [])
+            if args.inline_budget <= 0:
+                disabled.append("inline")
+            try:
+                passes = optimizer.passes.pipeline(args.opt_level, args.enable_pass, disabled)
+            except optimizer.passes.PassError as e:
+                print(f"error: {e}")
+                sys.exit(1)
+            manager = optimizer.passes.PassManager(passes, {"inline": {"budget": args.inline_budget}})
+
+            parse_cache = None
+            if not args.no_cache:
+                try:
+                    parse_cache = cache.ParseCache(args.cache_dir, args.cache_size * 1024 * 1024)
+                except OSError as e:
+                    print(f"warning: parse cache disabled, cannot use '{args.cache_dir}': {e.strerror}")
+            pp = preprocessor.Preprocessor(parse_cache, args.include_dirs, args.jobs)
             ast = pp.process(args.f)
             semantic.SemanticAnalyzer(ast).analyze()
-            asm = compiler.x86_64_linux.x86_64_Linux(ast).generate()
+            ast = manager.run_ast(ast)
+            module = ir.lower.Lowering(ast).run()
+            lowered = module.size()
+            module = manager.run_ir(module)
+            optimized = module.size()
+            if args.dump_ir:
+                print(ir.ir.format_module(module))
+            backend = compiler.x86_64_linux.x86_64_Linux(module, **manager.backend_options())
+            asm = backend.generate()
+            if args.stats:
+                for line in manager.reports:
+                    print(line)
+                print(f"ir: {len(module.functions)} functions, {lowered} instructions lowered, {optimized} after passes")
+                print(manager.report())
+                print(f"regalloc: {backend.allocated} values in registers, {backend.spilled} on the stack")
+                print(f"frames: {backend.frameless} of {len(module.functions)} functions without a frame")
+                for name, before, after in backend.shrunk:
+                    print(f"stack slots: {name} {before} -> {after} bytes")
+                if backend.use_peephole:
+                    print(backend.peephole.report())
+                print(f"asm: {asm.count(chr(10)) + 1} lines")
             if not args.o.endswith((".o", ".out", ".asm")):
                 print("error: output file must end with .o, .out, or .asm; check capitalization or file format; will be handled as raw assembly")
                 args.o = args.o.split(".")[0] + ".asm"
@@ -0,0 +1,381 @@
+import re
+
+GPRS = ["rax", "rbx", "rcx", "rdx", "rsi", "rdi", "rbp", "rsp", *[f"r{i}" for i in range(8, 16)]]
+# 64-bit register -> its low 32 bits, writing those clears the upper half
+REG32 = {
+    "rax": "eax", "rbx": "ebx", "rcx": "ecx", "rdx": "edx",
+    "rsi": "esi", "rdi": "edi", "rbp": "ebp", "rsp": "esp",
+    **{f"r{i}": f"r{i}d" for i in range(8, 16)},
+}
+REG8 = {
+    "rax": "al", "rbx": "bl", "rcx": "cl", "rdx": "dl",
+    "rsi": "sil", "rdi": "dil", "rbp": "bpl", "rsp": "spl",
+    **{f"r{i}": f"r{i}b" for i in range(8, 16)},
+}
+REG16 = {
+    "rax": "ax", "rbx": "bx", "rcx": "cx", "rdx": "dx",
+    "rsi": "si", "rdi": "di", "rbp": "bp", "rsp": "sp",
+    **{f"r{i}": f"r{i}w" for i in range(8, 16)},
+}
+# every register name -> the register it is part of
+FAMILY = {r: r for r in GPRS}
+FAMILY.update({low: r for r, low in REG32.items()})
+FAMILY.update({low: r for r, low in REG16.items()})
+FAMILY.update({low: r for r, low in REG8.items()})
+FAMILY.update({f"xmm{i}": f"xmm{i}" for i in range(16)})
+# writing these replaces the whole register
+FULL = {*GPRS, *REG32.values(), *(f"xmm{i}" for i in range(16))}
+
+FLAGS = "flags"
+CALL_READS = {"rax", "rdi", "rsi", "rdx", "rcx", "r8", "r9", *[f"xmm{i}" for i in range(8)]}
+CALL_CLOBBERS = {"rax", "rcx", "rdx", "rsi", "rdi", "r8", "r9", "r10", "r11", *[f"xmm{i}" for i in range(16)], FLAGS}
+RET_READS = {"rax", "xmm0", "rbx", "rbp", "rsp", "r12", "r13", "r14", "r15"}
+
+# dest only written
+MOVES = {"mov", "movzx", "movsx", "movsxd", "lea", "movsd", "movapd", "movq", "cvtsi2sd", "cvttsd2si"}
+# dest read and written, flags written
+ARITH = {"add", "sub", "imul", "and", "or", "xor", "shl", "sar", "shr", "neg", "inc", "dec"}
+FLOAT_ARITH = {"addsd", "subsd", "mulsd", "divsd", "xorpd", "andpd"}
+COMPARES = {"cmp", "test", "ucomisd", "comisd"}
+INVERT_JCC = {
+    "je": "jne", "jne": "je", "jl": "jge", "jge": "jl", "jle": "jg", "jg": "jle",
+    "jb": "jae", "jae": "jb", "jbe": "ja", "ja": "jbe",
+}
+# how far the liveness scans look before assuming a value is needed
+SCAN_LIMIT = 64
+
+WORD = re.compile(r"[a-z][a-z0-9]*")
+
+
+def regs_in(operand):
+    return {FAMILY[w] for w in WORD.findall(operand) if w in FAMILY}
+
+
+def is_reg(operand):
+    return operand in FAMILY
+
+
+class Line:
+    """One line of assembly, parsed into a mnemonic and operands when it is an instruction"""
+
+    __slots__ = ("text", "op", "operands", "label")
+
+    def __init__(self, text, op=None, operands=(), label=None):
+        self.text = text
+        self.op = op
+        self.operands = list(operands)
+        self.label = label
+
+    @classmethod
+    def parse(cls, text):
+        stripped = text.strip()
+        if text and not text[0].isspace() and stripped.endswith(":") and " " not in stripped:
+            return cls(text, label=stripped[:-1])
+        if not text.startswith("    ") or not stripped or stripped.startswith(";"):
+            return cls(text)
+        op, _, rest = stripped.partition(" ")
+        operands = [o.strip() for o in rest.split(",")] if rest else []
+        return cls(text, op, operands)
+
+    @classmethod
+    def instr(cls, op, *operands):
+        return cls(f"    {op} {', '.join(operands)}".rstrip(), op, operands)
+
+    def effects(self):
+        """(registers read, registers written), None when the instruction is not understood"""
+        op, ops = self.op, self.operands
+        if op in MOVES and len(ops) == 2:
+            if "[" in ops[0]:
+                return regs_in(ops[0]) | regs_in(ops[1]), set()
+            if ops[0] not in FULL:
+                # a byte write keeps the rest of the register
+                return regs_in(ops[0]) | regs_in(ops[1]), regs_in(ops[0])
+            return regs_in(ops[1]), regs_in(ops[0])
+        if op in ("idiv", "div", "imul", "mul") and len(ops) == 1:
+            # rdx:rax is the implicit operand and result
+            return {"rax", "rdx"} | regs_in(ops[0]), {"rax", "rdx", FLAGS}
+        if op in ARITH and 1 <= len(ops) <= 3:
+            if op == "xor" and ops[0] == ops[1] and is_reg(ops[0]):
+                return set(), regs_in(ops[0]) | {FLAGS}
+            if op == "imul" and len(ops) == 3:
+                return regs_in(ops[1]), regs_in(ops[0]) | {FLAGS}
+            if "[" in ops[0]:
+                return set().union(*map(regs_in, ops)), {FLAGS}
+            return set().union(*map(regs_in, ops)), regs_in(ops[0]) | {FLAGS}
+        if op in FLOAT_ARITH and len(ops) == 2:
+            return regs_in(ops[0]) | regs_in(ops[1]), regs_in(ops[0])
+        if op in COMPARES:
+            return set().union(*map(regs_in, ops)), {FLAGS}
+        if op.startswith("set") and len(ops) == 1:
+            # only the low byte changes
+            return regs_in(ops[0]) | {FLAGS}, regs_in(ops[0])
+        if op == "cqo":
+            return {"rax"}, {"rdx"}
+        if op == "push":
+            return regs_in(ops[0]), set()
+        if op == "pop":
+            return set(), regs_in(ops[0])
+        if op == "call":
+            return set(CALL_READS), set(CALL_CLOBBERS)
+        return None
+
+    def __repr__(self):
+        return self.text
+
+
+def reads_flags(op):
+    return (op.startswith("j") and op != "jmp") or op.startswith("set") or op.startswith("cmov") or op in ("adc", "sbb")
+
+
+class Peephole:
+    """Rewrites short instruction sequences by a table of rules until none applies
+
+    Rules look at a window of parsed instructions. A rule that deletes or
+    changes a write asks the liveness scan whether the register or the
+    flags are still needed, following jumps forward along every path.
+    Hit counts are kept per rule for --stats.
+    """
+
+    def __init__(self):
+        self.code = []
+        self.labels = {}
+        self.scopes = []
+        self.hits = {}
+        self.rules = [
+            ("self-move", 1, self.self_move),
+            ("push-pop", 2, self.push_pop),
+            ("jump-to-next", 1, self.jump_to_next),
+            ("branch-over-jump", 3, self.branch_over_jump),
+            ("jump-to-jump", 1, self.jump_to_jump),
+            ("unreachable", 2, self.unreachable),
+            ("move-back", 2, self.move_back),
+            ("store-reload", 2, self.store_reload),
+            ("op-through-temp", 3, self.op_through_temp),
+            ("dead-write", 1, self.dead_write),
+            ("add-zero", 1, self.add_zero),
+            ("mul-one", 1, self.mul_one),
+            ("zero-idiom", 1, self.zero_idiom),
+        ]
+        for name, _, _ in self.rules:
+            self.hits[name] = 0
+
+    def run(self, lines):
+        self.code = [Line.parse(line) for line in lines]
+        while self.sweep():
+            self.code = [line for line in self.code if line is not None]
+        return [line.text for line in self.code]
+
+    def sweep(self):
+        """One pass of every rule over the code, deleted lines become None"""
+        self.index_labels()
+        changed = False
+        for i in range(len(self.code)):
+            if self.code[i] is None or self.code[i].op is None:
+                continue
+            for name, size, rule in self.rules:
+                window = self.window(i, size)
+                if len(window) < size:
+                    continue
+                replacement = rule([self.code[j] for j in window], window)
+                if replacement is None:
+                    continue
+                self.hits[name] += 1
+                changed = True
+                for k, j in enumerate(window):
+                    self.code[j] = replacement[k] if k < len(replacement) else None
+                break
+        return changed
+
+    def index_labels(self):
+        self.labels = {}
+        self.scopes = []
+        scope = ""
+        for i, line in enumerate(self.code):
+            if line is not None and line.label is not None:
+                if not line.label.startswith("."):
+                    scope = line.label
+                self.labels[self.label_key(line.label, scope)] = i
+            self.scopes.append(scope)
+
+    def label_key(self, name, scope):
+        # local labels belong to the global label before them
+        return scope + name if name.startswith(".") else name
+
+    def window(self, i, size):
+        """Indices of the next size lines from i that are still there, labels included"""
+        found = []
+        j = i
+        while j < len(self.code) and len(found) < size:
+            if self.code[j] is not None:
+                found.append(j)
+            j += 1
+        return found
+
+    def dead_after(self, i, what):
+        """True when register family or FLAGS what is written before it is read on every path after line i"""
+        work = [i + 1]
+        seen = set()
+        budget = SCAN_LIMIT
+        while work:
+            j = work.pop()
+            while True:
+                if j >= len(self.code) or j in seen:
+                    break
+                budget -= 1
+                if budget < 0:
+                    return False
+                seen.add(j)
+                line = self.code[j]
+                if line is None or line.label is not None:
+                    j += 1
+                    continue
+                if line.op is None:
+                    return False
+                if line.op == "ret":
+                    if what in RET_READS:
+                        return False
+                    break
+                if line.op.startswith("j"):
+                    if what == FLAGS and reads_flags(line.op):
+                        return False
+                    target = self.labels.get(self.label_key(line.operands[0], self.scopes[j]))
+                    if target is None:
+                        return False
+                    if line.op == "jmp":
+                        j = target
+                        continue
+                    work.append(target)
+                    j += 1
+                    continue
+                if what == FLAGS and reads_flags(line.op):
+                    return False
+                effects = line.effects()
+                if effects is None:
+                    return False
+                reads, writes = effects
+                if what in reads:
+                    return False
+                if what in writes:
+                    break
+                j += 1
+        return True
+
+    # rules, each gets the window's lines and indices and returns their replacement or None
+
+    def self_move(self, w, at):
+        line = w[0]
+        if line.op in ("mov", "movapd") and len(line.operands) == 2 and line.operands[0] == line.operands[1]:
+            # mov eax, eax clears the upper half, only full registers are no-ops
+            if line.operands[0] in GPRS or line.operands[0].startswith("xmm"):
+                return []
+        return None
+
+    def push_pop(self, w, at):
+        a, b = w
+        if a.op == "push" and b.op == "pop" and a.operands == b.operands:
+            return []
+        return None
+
+    def jump_to_next(self, w, at):
+        a = w[0]
+        if a.op != "jmp":
+            return None
+        # any of the labels right after the jump
+        j = at[0] + 1
+        while j < len(self.code) and (self.code[j] is None or self.code[j].label is not None):
+            if self.code[j] is not None and self.code[j].label == a.operands[0]:
+                return []
+            j += 1
+        return None
+
+    def branch_over_jump(self, w, at):
+        a, b, c = w
+        if a.op in INVERT_JCC and b.op == "jmp" and c.label is not None and c.label == a.operands[0]:
+            return [Line.instr(INVERT_JCC[a.op], b.operands[0]), c]
+        return None
+
+    def jump_to_jump(self, w, at):
+        a = w[0]
+        if (a.op != "jmp" and a.op not in INVERT_JCC) or not a.operands[0].startswith("."):
+            return None
+        j = self.labels.get(self.label_key(a.operands[0], self.scopes[at[0]]))
+        if j is None:
+            return None
+        while j < len(self.code) and (self.code[j] is None or self.code[j].label is not None):
+            j += 1
+        # a block that only jumps on is skipped, labels of other functions are left alone
+        if j < len(self.code) and self.code[j].op == "jmp":
+            target = self.code[j].operands[0]
+            if target.startswith(".") and target != a.operands[0]:
+                return [Line.instr(a.op, target)]
+        return None
+
+    def unreachable(self, w, at):
+        a, b = w
+        if a.op in ("jmp", "ret") and b.op is not None:
+            return [a]
+        return None
+
+    def move_back(self, w, at):
+        a, b = w
+        if (a.op == b.op and a.op in ("mov", "movapd", "movsd") and len(a.operands) == 2
+                and a.operands == b.operands[::-1]):
+            return [a]
+        return None
+
+    def store_reload(self, w, at):
+        a, b = w
+        if a.op not in ("mov", "movsd") or b.op != a.op or "[" not in a.operands[0]:
+            return None
+        mem, value = a.operands
+        dest, src = b.operands
+        if src != mem or value not in FULL or dest not in FULL:
+            return None
+        return [a, Line.instr("mov" if a.op == "mov" else "movapd", dest, value)]
+
+    def op_through_temp(self, w, at):
+        """mov t, a / op t, x / mov a, t becomes op a, x when t is dead afterwards"""
+        a, b, c = w
+        if a.op != "mov" or c.op != "mov" or b.op not in ARITH or len(b.operands) != 2:
+            return None
+        t, src = a.operands
+        if not (t in GPRS and src in GPRS and c.operands == [src, t] and b.operands[0] == t):
+            return None
+        if t in regs_in(b.operands[1]) or not self.dead_after(at[2], t):
+            return None
+        return [Line.instr(b.op, src, b.operands[1])]
+
+    def dead_write(self, w, at):
+        line = w[0]
+        if line.op not in MOVES or len(line.operands) != 2 or not is_reg(line.operands[0]):
+            return None
+        reg = FAMILY[line.operands[0]]
+        if reg in ("rsp", "rbp") or not self.dead_after(at[0], reg):
+            return None
+        return []
+
+    def add_zero(self, w, at):
+        line = w[0]
+        if line.op in ("add", "sub") and len(line.operands) == 2 and line.operands[1] == "0":
+            if self.dead_after(at[0], FLAGS):
+                return []
+        return None
+
+    def mul_one(self, w, at):
+        line = w[0]
+        if line.op == "imul" and len(line.operands) == 2 and line.operands[1] == "1":
+            if self.dead_after(at[0], FLAGS):
+                return []
+        return None
+
+    def zero_idiom(self, w, at):
+        line = w[0]
+        if line.op == "mov" and len(line.operands) == 2 and line.operands[1] == "0" and line.operands[0] in REG32:
+            if self.dead_after(at[0], FLAGS):
+                low = REG32[line.operands[0]]
+                return [Line.instr("xor", low, low)]
+        return None
+
+    def report(self):
+        hits = ", ".join(f"{name} {n}" for name, n in self.hits.items() if n) or "none"
+        return f"peephole: {hits}"
@@ -0,0 +1,114 @@
+class Interval:
+    """Live range of one value over linear program positions"""
+
+    __slots__ = ("name", "kind", "start", "end", "weight", "crosses_call", "reg")
+
+    def __init__(self, name, kind, start, end, weight=1, crosses_call=False):
+        self.name = name
+        self.kind = kind              # register class, "int" or "float"
+        self.start = start
+        self.end = end
+        self.weight = weight          # spill cost, uses scaled by loop depth
+        self.crosses_call = crosses_call
+        self.reg = None
+
+    def __repr__(self):
+        return f"Interval({self.name} [{self.start}, {self.end}] -> {self.reg})"
+
+
+class LinearScan:
+    """Linear scan register allocation (Poletto and Sarkar) with weighted spilling
+
+    pools maps a register class to its registers in order of preference,
+    callee_saved lists the registers that survive a call. Intervals that
+    cross a call only get callee-saved registers, intervals that get no
+    register keep reg None and live in memory.
+    """
+
+    def __init__(self, pools, callee_saved=()):
+        self.pools = pools
+        self.callee_saved = set(callee_saved)
+        self.allocated = 0
+        self.spilled = 0
+
+    def allowed(self, interval):
+        pool = self.pools.get(interval.kind, ())
+        if interval.crosses_call:
+            return [r for r in pool if r in self.callee_saved]
+        return pool
+
+    def allocate(self, intervals):
+        active = []
+        free = set()
+        for pool in self.pools.values():
+            free.update(pool)
+
+        for current in sorted(intervals, key=lambda iv: (iv.start, iv.end)):
+            # expire intervals that ended before this one starts
+            for iv in list(active):
+                if iv.end < current.start:
+                    active.remove(iv)
+                    free.add(iv.reg)
+
+            allowed = self.allowed(current)
+            reg = next((r for r in allowed if r in free), None)
+            if reg is not None:
+                current.reg = reg
+                free.discard(reg)
+                active.append(current)
+                continue
+
+            # no free register, evict the cheapest conflicting interval if it is cheaper than this one
+            victims = [iv for iv in active if iv.reg in allowed]
+            victim = min(victims, key=lambda iv: (iv.weight, -iv.end), default=None)
+            if victim is not None and (victim.weight, -victim.end) < (current.weight, -current.end):
+                current.reg = victim.reg
+                victim.reg = None
+                active.remove(victim)
+                active.append(current)
+
+        used = set()
+        for iv in intervals:
+            if iv.reg is None:
+                self.spilled += 1
+            else:
+                self.allocated += 1
+                used.add(iv.reg)
+        return used
+
+
+class StackColoring:
+    """Frame offsets for stack slots, slots that are never live at the same time share bytes
+
+    ranges maps a slot to {block: (start, end)}, the positions within each
+    block where it is live, or None when it may be live anywhere. Slots go
+    biggest first to the lowest offset that overlaps no conflicting slot.
+    """
+
+    def conflict(self, a, b):
+        if a is None or b is None:
+            return True
+        if len(b) < len(a):
+            a, b = b, a
+        for block, (start, end) in a.items():
+            other = b.get(block)
+            if other is not None and start <= other[1] and other[0] <= end:
+                return True
+        return False
+
+    def assign(self, slots, ranges):
+        """Set every slot's offset below the frame base and return the bytes they take"""
+        placed = []     # (slot, low, high), the slot covers [base - high, base - low)
+        top = 0
+        for slot in sorted(slots, key=lambda s: -s.size):
+            busy = [(lo, hi) for other, lo, hi in placed if self.conflict(ranges[slot], ranges[other])]
+            best = None
+            for lo in [0, *(hi for _, hi in busy)]:
+                high = (lo + slot.size + slot.align - 1) // slot.align * slot.align
+                low = high - slot.size
+                if all(high <= b_lo or b_hi <= low for b_lo, b_hi in busy) and (best is None or high < best):
+                    best = high
+            slot.offset = -best
+            placed.append((slot, best - slot.size, best))
+            top = max(top, best)
+        return top
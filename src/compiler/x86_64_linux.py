@@ -1,28 +1,161 @@
+from ir.ir import Instr, Const, F64
+from ir.cfg import block_order, find_loops, split_critical_edges, loop_depths
+from ir.alias import AliasInfo, root_of
+from compiler.regalloc import Interval, LinearScan, StackColoring
+from compiler.peephole import Peephole
+
+
+def reachable(blocks, edges):
+    """blocks and every block reached from them along edges"""
+    seen = set(blocks)
+    work = list(blocks)
+    while work:
+        for b in edges(work.pop()):
+            if b not in seen:
+                seen.add(b)
+                work.append(b)
+    return seen
+
+
 class CodegenError(Exception):
     pass
 
+
+def fits_imm32(value):
+    return -(1 << 31) <= value < (1 << 31)
+
+
 class x86_64_Linux:
-    """Linux codegen for x86_64 arch using NASM syntax"""
+    """Linux codegen for x86_64 arch using NASM syntax, selects instructions from the IR"""
 
     ARG_REGS = ["rdi", "rsi", "rdx", "rcx", "r8", "r9"]
+    RUNTIME = ("display_number", "display_number_nonl", "print_char")
     FLOAT_REGS = [f"xmm{i}" for i in range(8)]
 
-    def __init__(self, ast):
-        self.ast = ast
+    CALLEE_SAVED = ["rbx", "r12", "r13", "r14", "r15"]
+    # values crossing a call only get callee-saved registers, there are no callee-saved xmm registers.
+    # rax, rcx, rdx and r11 stay scratch for instruction sequences, so do xmm0, xmm1 and xmm15
+    POOLS = {
+        "int": ["rsi", "rdi", "r8", "r9", "r10", *CALLEE_SAVED],
+        "float": [f"xmm{i}" for i in range(2, 15)],
+    }
+    BYTE_REGS = {
+        "rax": "al", "rbx": "bl", "rcx": "cl", "rdx": "dl", "rsi": "sil", "rdi": "dil",
+        "r8": "r8b", "r9": "r9b", "r10": "r10b", "r11": "r11b",
+        "r12": "r12b", "r13": "r13b", "r14": "r14b", "r15": "r15b",
+    }
+    WORD_REGS = {
+        "rax": "ax", "rbx": "bx", "rcx": "cx", "rdx": "dx", "rsi": "si", "rdi": "di",
+        **{f"r{i}": f"r{i}w" for i in range(8, 16)},
+    }
+    DWORD_REGS = {
+        "rax": "eax", "rbx": "ebx", "rcx": "ecx", "rdx": "edx", "rsi": "esi", "rdi": "edi",
+        **{f"r{i}": f"r{i}d" for i in range(8, 16)},
+    }
+    # narrow memory width -> operand size, the low part of each register and its bits
+    NARROW = {"i8": ("byte", BYTE_REGS, 8), "i16": ("word", WORD_REGS, 16), "i32": ("dword", DWORD_REGS, 32)}
+    # (extension, width) -> instruction, loads extend like IR loads do
+    EXTEND = {
+        ("zext", "i8"): "movzx", ("zext", "i16"): "movzx",
+        ("sext", "i8"): "movsx", ("sext", "i16"): "movsx", ("sext", "i32"): "movsxd",
+    }
+    LOAD_EXTEND = {"i8": "zext", "i16": "sext", "i32": "sext"}
+    # index scales a memory operand can apply
+    SCALES = (1, 2, 4, 8)
+    # address values are rematerialized at each use instead of taking a register
+    ADDRESS_OPS = ("slot", "global", "str")
+    # data directive for a scalar of each size
+    DATA = {1: "db", 2: "dw", 4: "dd", 8: "dq"}
+    # bytes below rsp a function that makes no calls may use without moving rsp (System V)
+    RED_ZONE = 128
+
+    INT_OPS = {"add": "add", "sub": "sub", "mul": "imul", "and": "and", "or": "or", "xor": "xor"}
+    LEA_SCALES = (3, 5, 9)
+    SHIFT_OPS = {"shl": "shl", "sar": "sar", "shr": "shr"}
+    FLOAT_OPS = {"fadd": "addsd", "fsub": "subsd", "fmul": "mulsd", "fdiv": "divsd"}
+    SETCC = {"eq": "sete", "ne": "setne", "lt": "setl", "le": "setle", "gt": "setg", "ge": "setge"}
+    # ucomisd sets the flags like an unsigned compare
+    FLOAT_SETCC = {"eq": "sete", "ne": "setne", "lt": "setb", "le": "setbe", "gt": "seta", "ge": "setae"}
+    JCC = {"eq": "je", "ne": "jne", "lt": "jl", "le": "jle", "gt": "jg", "ge": "jge"}
+    FLOAT_JCC = {"eq": "je", "ne": "jne", "lt": "jb", "le": "jbe", "gt": "ja", "ge": "jae"}
+    # condition that holds when the original does not, and with the operands swapped
+    INVERTED = {"eq": "ne", "ne": "eq", "lt": "ge", "ge": "lt", "le": "gt", "gt": "le"}
+    SWAPPED = {"eq": "eq", "ne": "ne", "lt": "gt", "gt": "lt", "le": "ge", "ge": "le"}
+
+    def __init__(self, module, regalloc=True, peephole=True):
+        self.module = module
+        self.regalloc = regalloc
+        self.use_peephole = peephole
+        self.peephole = Peephole()
         self.lines = []
         self.label_id = 0
-        self.locals = {}
-        self.stack_size = 0
         self.strings = {}
         self.rodata = []
-        self.loop_stack = []
-        self.globals = {}
+        self.floats = {}
         self.data = []
-        self.structs = {}
-
-    def mangle(self, name, params):
-        sig = "_".join(p.children[0].value for p in params)
-        return f"{name}__{sig}"
+        self.called = set()
+        self.allocated = 0
+        self.spilled = 0
+        self.frameless = 0
+        self.coloring = StackColoring()
+        # (function, bytes of stack slots laid out one after another, bytes once they share)
+        self.shrunk = []
+
+        self.fn = None
+        self.loc = {}
+        self.fused = set()
+        # address add -> (base, index, scale, displacement) of the memory operand it became
+        self.folded = {}
+        self.live_in = {}
+        # block only holding phi moves on a back edge -> loop block the branch goes to instead
+        self.bypass = {}
+        self.labels = {}
+        self.saved = []
+        self.frame_size = 0
+        # frame base register, rsp when a leaf keeps everything in the red zone
+        self.base = "rbp"
+        self.next_block = None
+
+        self.handlers = {
+            "param": self.gen_nothing,
+            "phi": self.gen_nothing,
+            "slot": self.gen_nothing,
+            "global": self.gen_nothing,
+            "str": self.gen_nothing,
+            "copy": self.gen_copy,
+            "add": self.gen_int_op,
+            "sub": self.gen_int_op,
+            "mul": self.gen_int_op,
+            "mulhi": self.gen_mulhi,
+            "and": self.gen_int_op,
+            "or": self.gen_int_op,
+            "xor": self.gen_int_op,
+            "shl": self.gen_shift,
+            "sar": self.gen_shift,
+            "shr": self.gen_shift,
+            "div": self.gen_div,
+            "mod": self.gen_div,
+            "pow": self.gen_pow,
+            "neg": self.gen_neg,
+            "cmp": self.gen_cmp,
+            "fadd": self.gen_float_op,
+            "fsub": self.gen_float_op,
+            "fmul": self.gen_float_op,
+            "fdiv": self.gen_float_op,
+            "fneg": self.gen_fneg,
+            "fcmp": self.gen_fcmp,
+            "itof": self.gen_itof,
+            "ftoi": self.gen_ftoi,
+            "zext": self.gen_extend,
+            "sext": self.gen_extend,
+            "load": self.gen_load,
+            "store": self.gen_store,
+            "call": self.gen_call,
+            "tailcall": self.gen_tailcall,
+            "ret": self.gen_ret,
+            "jmp": self.gen_jmp,
+            "br": self.gen_br,
+        }
 
     def emit(self, line=""):
         self.lines.append(line)
@@ -37,35 +170,14 @@ class x86_64_Linux:
             self.strings[value] = lbl
             self.rodata.append((lbl, value))
         return self.strings[value]
-    
-    def sizeof(self, type_node):
-        if type_node.value == "CHAR":
-            return 1
-        if type_node.value == "CHAR_PTR":
-            return 8
-        
-        # array size
-        if type_node.children and type_node.children[0].type == "ARRAY_SIZE":
-            base_size = 8 if type_node.value.endswith("_PTR") else (1 if type_node.value == "CHAR" else 8)
-            array_size = type_node.children[0].value
-            return base_size * array_size
-        return 8
-
-    def alloc_local(self, name, size, typ):
-        self.stack_size += size
-        self.locals[name] = (-self.stack_size, size, typ)
-
-    def collect_locals(self, node):
-        if node.type == "VAR_DECL":
-            if node.value not in self.locals:
-                typ = node.children[0].value
-                size = self.sizeof(node.children[0])
-                self.alloc_local(node.value, size, typ)
-
-        if node.type in ("IF", "WHILE", "FOR", "UNSAFE_BLOCK", "BODY", "THEN", "ELSE"):
-            for child in node.children:
-                if child:
-                    self.collect_locals(child)
+
+    def float_label(self, value):
+        key = Const(value, F64).key()
+        if key not in self.floats:
+            lbl = self.new_label("float")
+            self.floats[key] = lbl
+            self.data.append((lbl, 8, 8, f"__float64__({value!r})"))
+        return self.floats[key]
 
     def generate(self):
         self.emit("global main")
@@ -74,25 +186,51 @@ class x86_64_Linux:
         #self.emit("extern atoi")
         self.emit()
         self.emit("section .text")
+        for name in self.module.externs:
+            self.emit(f"extern {name}")
+
+        for fn in self.module.functions:
+            self.gen_function(fn)
+
+        # runtime helpers are only emitted when something calls them
+        for name in self.RUNTIME:
+            if name in self.called:
+                getattr(self, f"emit_{name}")()
+
+        if self.rodata:
+            self.emit()
+            self.emit("section .rodata")
+            for lbl, s in self.rodata:
+                escaped = s.replace("\\", "\\\\").replace('"', '\\"')
+
+                db_parts = []
+                for c in escaped:
+                    if c == "\n":
+                        db_parts.append("10")
+                    else:
+                        db_parts.append(f'"{c}"')
+
+                self.emit(f"{lbl}: db {', '.join(db_parts)}, 0")
 
-        for node in self.ast.children:
-            if node.type == "VAR_DECL":
-                self.gen_global(node)
-            elif node.type == "FUNCTION":
-                self.gen_function(node)
-            elif node.type == "EXTERN":
-                self.emit(f"extern {node.value}")
-            elif node.type == "STRUCT_DEF":
-                offset = 0
-                fields = {}
-                for field in node.children:
-                    field_type = field.children[0].value
-                    fields[field.value] = (offset, field_type)
-                    offset += self.sizeof(field.children[0])
-                self.structs[node.value] = fields
+        self.emit()
+        self.emit("section .data")
+        self.emit("    buffer times 20 db 0")
+
+        for name, size, align, val in self.module.globals + self.data:
+            if align > 1:
+                self.emit(f"align {align}, db 0")
+            if isinstance(val, float):
+                val = f"__float64__({val!r})"
+            if size in self.DATA:
+                self.emit(f"{name}: {self.DATA[size]} {val}")
             else:
-                self.gen_stmt(node)
+                self.emit(f"    {name} times {size} db 0")
+
+        if self.use_peephole:
+            self.lines = self.peephole.run(self.lines)
+        return "\n".join(self.lines)
 
+    def emit_display_number(self):
         self.emit("display_number:")
         self.emit("    push rax")
         self.emit("    push rbx")
@@ -118,13 +256,19 @@ class x86_64_Linux:
         self.emit("    mov rax, rbx")
 
         self.emit(".convert_loop:")
-        self.emit("    xor rdx, rdx") 
-        self.emit("    mov rsi, 10")
-        self.emit("    div rsi")   
-        self.emit("    add dl, '0'")
-        self.emit("    mov [rcx], dl")
+        # n / 10 as a multiply by the reciprocal, the digit is n - q*10
+        self.emit("    mov rsi, rax")
+        self.emit("    mov rdx, 0xCCCCCCCCCCCCCCCD")
+        self.emit("    mul rdx")
+        self.emit("    shr rdx, 3")
+        self.emit("    lea rax, [rdx+rdx*4]")
+        self.emit("    add rax, rax")
+        self.emit("    sub rsi, rax")
+        self.emit("    add sil, '0'")
+        self.emit("    mov [rcx], sil")
         self.emit("    dec rcx")
-        self.emit("    cmp rax, 0")
+        self.emit("    mov rax, rdx")
+        self.emit("    test rax, rax")
         self.emit("    jne .convert_loop")
 
         self.emit("    inc rcx")  
@@ -142,6 +286,7 @@ class x86_64_Linux:
         self.emit("    pop rax")
         self.emit("    ret")
 
+    def emit_display_number_nonl(self):
         self.emit("display_number_nonl:")
         self.emit("    push rax")
         self.emit("    push rbx")
@@ -167,20 +312,27 @@ class x86_64_Linux:
         self.emit("    mov rax, rbx")
 
         self.emit(".convert_loop_nl:")
-        self.emit("    xor rdx, rdx") 
-        self.emit("    mov rsi, 10")
-        self.emit("    div rsi")   
-        self.emit("    add dl, '0'")
-        self.emit("    mov [rcx], dl")
+        # n / 10 as a multiply by the reciprocal, the digit is n - q*10
+        self.emit("    mov rsi, rax")
+        self.emit("    mov rdx, 0xCCCCCCCCCCCCCCCD")
+        self.emit("    mul rdx")
+        self.emit("    shr rdx, 3")
+        self.emit("    lea rax, [rdx+rdx*4]")
+        self.emit("    add rax, rax")
+        self.emit("    sub rsi, rax")
+        self.emit("    add sil, '0'")
+        self.emit("    mov [rcx], sil")
         self.emit("    dec rcx")
-        self.emit("    cmp rax, 0")
+        self.emit("    mov rax, rdx")
+        self.emit("    test rax, rax")
         self.emit("    jne .convert_loop_nl")
 
         self.emit("    inc rcx")  
         self.emit("    mov rax, 1")
         self.emit("    mov rdi, 1")
         self.emit("    lea rsi, [rcx]")
-        self.emit("    mov rdx, buffer+20")
+        # the terminator at buffer+19 is not part of the output
+        self.emit("    mov rdx, buffer+19")
         self.emit("    sub rdx, rcx") 
         self.emit("    syscall")
 
@@ -190,7 +342,8 @@ class x86_64_Linux:
         self.emit("    pop rbx")
         self.emit("    pop rax")
         self.emit("    ret")
-        
+
+    def emit_print_char(self):
         self.emit("print_char:")
         self.emit("    mov [buffer], al")
         self.emit("    mov rax, 1")
@@ -200,734 +353,830 @@ class x86_64_Linux:
         self.emit("    syscall")
         self.emit("    ret")
 
-        if self.rodata:
-            self.emit()
-            self.emit("section .rodata")
-            for lbl, s in self.rodata:
-                escaped = s.replace("\\", "\\\\").replace('"', '\\"')
-           
-                db_parts = []
-                for c in escaped:
-                    if c == "\n":
-                        db_parts.append("10")
-                    else:
-                        db_parts.append(f'"{c}"')
-                
-                self.emit(f"{lbl}: db {', '.join(db_parts)}, 0")
-
-        self.emit()
-        self.emit("section .data")
-        self.emit("    buffer times 20 db 0")
-
-        for name, size, val in self.data:
-            if size == 1:
-                self.emit(f"{name}: db {val}")
-            else:
-                self.emit(f"{name}: dq {val}")
-        
-        peepholed = self.peephole(self.lines)
-        self.lines = peepholed
-        return "\n".join(self.lines)
-    
-    def gen_global(self, node):
-        name = node.value
-        size = self.sizeof(node.children[0])
-        self.globals[name] = size
-
-        if len(node.children) > 1:
-            val = node.children[1].value
+    # register allocation
+
+    def layout(self, fn, loops):
+        """Linear positions for every instruction in block order, phis sit at their block start"""
+        self.order = block_order(fn, loops)
+        self.pos = {}
+        self.block_start = {}
+        self.block_end = {}
+        self.calls = []
+        p = 0
+        for block in self.order:
+            self.block_start[block] = p
+            for instr in block.instrs:
+                if instr.op != "phi":
+                    p += 1
+                self.pos[instr] = p
+                if instr.op == "call":
+                    self.calls.append(p)
+            self.block_end[block] = p
+            p += 1
+
+    def fuse_compares(self, fn):
+        """Compares only used by their block's branch set the flags for it instead of a register
+
+        The compare moves down next to the branch, it is pure and its
+        operands are already defined, so nothing else changes.
+        """
+        uses = fn.uses()
+        fused = set()
+        for block in fn.blocks:
+            term = block.terminator
+            if term is None or term.op != "br":
+                continue
+            cond = term.args[0]
+            if isinstance(cond, Instr) and cond.op in ("cmp", "fcmp") and cond.block is block and uses[cond] == 1:
+                block.instrs.remove(cond)
+                block.instrs.insert(len(block.instrs) - 1, cond)
+                fused.add(cond)
+        return fused
+
+    def fold_addresses(self, fn):
+        """Address arithmetic only used by one load or store becomes its [base + index*scale + disp] operand
+
+        The add and the shift or multiply scaling its index move down next
+        to the access, like fused compares, so their operands stay live up
+        to the instruction that reads them.
+        """
+        uses = fn.uses()
+        folded = {}
+        for block in fn.blocks:
+            for instr in list(block.instrs):
+                if instr.op not in ("load", "store"):
+                    continue
+                addr = instr.args[0]
+                if not (isinstance(addr, Instr) and addr.op == "add" and addr.block is block and uses[addr] == 1):
+                    continue
+                parts = self.address_parts(addr, block, uses)
+                if parts is None:
+                    continue
+                operand, scaled = parts
+                moved = [addr] if scaled is None else [scaled, addr]
+                for m in moved:
+                    block.instrs.remove(m)
+                    folded[m] = operand
+                at = block.instrs.index(instr)
+                block.instrs[at:at] = moved
+        return folded
+
+    def address_parts(self, addr, block, uses):
+        """((base, index, scale, disp), scaling instr or None) for an address add, None when no operand fits"""
+        a, b = addr.args
+        if isinstance(b, Const):
+            if isinstance(a, Instr) and fits_imm32(b.value):
+                return (a, None, 1, b.value), None
+            return None
+        for base, index in ((a, b), (b, a)):
+            if not isinstance(base, Instr) or not isinstance(index, Instr):
+                continue
+            scaled = None
+            scale = 1
+            if (index.op in ("shl", "mul") and index.block is block and uses[index] == 1
+                    and isinstance(index.args[1], Const) and isinstance(index.args[0], Instr)):
+                k = index.args[1].value
+                if index.op == "shl" and 0 <= k <= 3:
+                    scaled, scale = index, 1 << k
+                elif index.op == "mul" and k in self.SCALES:
+                    scaled, scale = index, k
+            if scaled is not None:
+                index = scaled.args[0]
+            # address values have no register, a slot base is rbp or rsp plus an offset and can take an index
+            if index.op in self.ADDRESS_OPS or base.op in ("global", "str"):
+                continue
+            return (base, index, scale, 0), scaled
+        return None
+
+    def needs_location(self, value):
+        return (isinstance(value, Instr) and value.ty is not None
+                and value.op not in self.ADDRESS_OPS and value not in self.fused and value not in self.folded)
+
+    def liveness(self):
+        """Values live into and out of each block, phi arguments are used on the incoming edge"""
+        gen = {}
+        kill = {}
+        for block in self.order:
+            g = set()
+            k = set()
+            for instr in block.instrs:
+                if instr.op != "phi":
+                    for a in instr.args:
+                        if self.needs_location(a) and a not in k:
+                            g.add(a)
+                k.add(instr)
+            gen[block] = g
+            kill[block] = k
+
+        live_in = {b: set() for b in self.order}
+        live_out = {b: set() for b in self.order}
+        changed = True
+        while changed:
+            changed = False
+            for block in reversed(self.order):
+                out = set()
+                for succ in block.succs:
+                    out |= live_in[succ]
+                    for phi in succ.phis():
+                        for arg, pred in zip(phi.args, phi.blocks):
+                            if pred is block and self.needs_location(arg):
+                                out.add(arg)
+                new_in = gen[block] | (out - kill[block])
+                if out != live_out[block] or new_in != live_in[block]:
+                    live_out[block] = out
+                    live_in[block] = new_in
+                    changed = True
+        return live_in, live_out
+
+    def live_intervals(self, fn):
+        live_in, live_out = self.liveness()
+        self.live_in = live_in
+        spans = {}
+        weight = {}
+
+        def touch(value, p, depth=None):
+            lo, hi = spans.get(value, (p, p))
+            spans[value] = (min(lo, p), max(hi, p))
+            if depth is not None:
+                weight[value] = weight.get(value, 0) + 10 ** min(depth, 4)
+
+        for param in fn.params:
+            # parameters all arrive at once, before the first instruction
+            touch(param, 0)
+        for block in self.order:
+            for instr in block.instrs:
+                if self.needs_location(instr):
+                    touch(instr, self.pos[instr], block.depth)
+                if instr.op == "phi":
+                    for arg, pred in zip(instr.args, instr.blocks):
+                        # the phi is written and its argument read at the end of each incoming block
+                        touch(instr, self.block_end[pred])
+                        if self.needs_location(arg):
+                            touch(arg, self.block_end[pred], pred.depth)
+                    continue
+                for a in instr.args:
+                    if self.needs_location(a):
+                        touch(a, self.pos[instr], block.depth)
+            for value in live_in[block]:
+                touch(value, self.block_start[block])
+            for value in live_out[block]:
+                touch(value, self.block_end[block])
+
+        intervals = []
+        for value, (start, end) in spans.items():
+            crosses = any(start < p < end for p in self.calls)
+            kind = "float" if value.ty == F64 else "int"
+            intervals.append(Interval(value, kind, start, end, weight.get(value, 1), crosses))
+        return intervals
+
+    def allocate(self, fn):
+        intervals = self.live_intervals(fn)
+        if self.regalloc:
+            allocator = LinearScan(self.POOLS, self.CALLEE_SAVED)
+            used = allocator.allocate(intervals)
+            self.allocated += allocator.allocated
+            self.spilled += allocator.spilled
         else:
-            val = 0
-
-        self.data.append((name, size, val))
+            used = set()
+            self.spilled += len(intervals)
+        self.saved = [r for r in self.CALLEE_SAVED if r in used]
+
+        offset = self.stack_slots(fn.slots)
+        if self.regalloc and len(fn.slots) > 1:
+            shared = self.coloring.assign(fn.slots, self.slot_ranges(fn))
+            if shared < offset:
+                self.shrunk.append((fn.name, offset, shared))
+                offset = shared
+            else:
+                self.stack_slots(fn.slots)
+        spills = {}
+        for iv in intervals:
+            if iv.reg is None:
+                offset = (offset + 7) // 8 * 8 + 8
+                spills[iv.name] = offset
+        saves = {}
+        for reg in self.saved:
+            offset = (offset + 7) // 8 * 8 + 8
+            saves[reg] = offset
+        self.frame_size = (offset + 15) // 16 * 16
+
+        # a function that calls nothing never needs rsp aligned, its frame can live in the red zone
+        leaf = not any(i.op in ("call", "tailcall") for i in fn.instrs())
+        self.base = "rsp" if leaf and offset <= self.RED_ZONE else "rbp"
+        self.loc = {}
+        for iv in intervals:
+            self.loc[iv.name] = iv.reg if iv.reg is not None else f"qword [{self.base}-{spills[iv.name]}]"
+        self.save_area = {reg: f"qword [{self.base}-{off}]" for reg, off in saves.items()}
+
+    def stack_slots(self, slots):
+        """Give each slot bytes of its own, in declaration order"""
+        offset = 0
+        for slot in slots:
+            offset = (offset + slot.size + slot.align - 1) // slot.align * slot.align
+            slot.offset = -offset
+        return offset
+
+    def slot_ranges(self, fn):
+        """Where each slot may hold a value, None for slots whose address escapes
+
+        A slot only reached through loads and stores of its own address is
+        live from its accesses on to any access reachable from them. One
+        whose address is passed or stored somewhere could be read at any time.
+        """
+        alias = AliasInfo(fn)
+        accesses = {slot: {} for slot in fn.slots}
+        for block in self.order:
+            for instr in block.instrs:
+                if instr.op in ("load", "store"):
+                    root = root_of(instr.args[0])
+                    if alias.private(root):
+                        accesses[root.slot].setdefault(block, []).append(self.pos[instr])
+
+        ranges = {}
+        for slot, at in accesses.items():
+            if slot in alias.escaped:
+                ranges[slot] = None
+                continue
+            after = reachable(at, lambda b: b.succs)
+            before = reachable(at, lambda b: b.preds)
+            ranges[slot] = {}
+            for block in after & before:
+                here = at.get(block, ())
+                start = self.block_start[block] if any(p in after for p in block.preds) else min(here)
+                end = self.block_end[block] if any(s in before for s in block.succs) else max(here)
+                ranges[slot][block] = (start, end)
+        return ranges
+
+    # functions
 
     def gen_function(self, fn):
-        base = fn.value
-        params = fn.children[1].children
-        if base in ["main", "puts", "display_number", "display_number_nonl", "print_char"]:
-            name = base
-        else:
-            name = self.mangle(base, params)
-        #eoc
-        body = fn.children[2].children
-
-        self.locals = {}
-        self.stack_size = 0
-
-        for param in params:
-            typ = param.children[0].value
-            size = self.sizeof(param.children[0])
-            self.alloc_local(param.value, size, typ)
-
-        for stmt in body:
-            self.collect_locals(stmt)
-        aligned = ((self.stack_size + 15) // 16) * 16
+        self.fn = fn
+        # phi moves go on the incoming edge
+        split_critical_edges(fn, phis_only=True)
+        loops = find_loops(fn)
+        loop_depths(fn, loops)
+        self.fused = self.fuse_compares(fn)
+        self.folded = self.fold_addresses(fn)
+        self.layout(fn, loops)
+        self.allocate(fn)
+        self.bypass = self.back_edge_moves()
+        self.order = [b for b in self.order if b not in self.bypass]
+        self.labels = {block: self.new_label(f".L{block.name}") for block in self.order}
 
         self.emit()
-        self.emit(f"{name}:")
-        self.emit("    push rbp")
-        self.emit("    mov rbp, rsp")
-
-        if aligned:
-            self.emit(f"    sub rsp, {aligned}")
-        for i, param in enumerate(params):
-            offset, size, typ = self.locals[param.value]
-            if typ == "FLOAT":
-                self.emit(f"    movsd [rbp{offset}], {self.FLOAT_REGS[i]}")
-            else:
-                self.emit(f"    mov [rbp{offset}], {self.ARG_REGS[i]}")
-
-        for stmt in body:
-            self.gen_stmt(stmt)
+        self.emit(f"{fn.name}:")
+        if self.base == "rbp":
+            self.emit("    push rbp")
+            self.emit("    mov rbp, rsp")
+            if self.frame_size:
+                self.emit(f"    sub rsp, {self.frame_size}")
+        else:
+            self.frameless += 1
+        for reg in self.saved:
+            self.emit(f"    mov {self.save_area[reg]}, {reg}")
 
-        self.emit("    mov rsp, rbp")
-        self.emit("    pop rbp")
+        # parameters arrive in the argument registers, all at once
+        moves = []
+        int_i = 0
+        float_i = 0
+        for param in fn.params:
+            if param.ty == F64:
+                src = self.FLOAT_REGS[float_i]
+                float_i += 1
+            else:
+                src = self.ARG_REGS[int_i]
+                int_i += 1
+            if param in self.loc:
+                moves.append((self.loc[param], src, param.ty))
+        self.parallel_move(moves)
+
+        for i, block in enumerate(self.order):
+            self.next_block = self.order[i + 1] if i + 1 < len(self.order) else None
+            if i:
+                self.emit(f"{self.labels[block]}:")
+            for instr in block.instrs:
+                if instr not in self.folded:
+                    self.handlers[instr.op](instr)
+
+    def emit_epilogue(self):
+        self.emit_teardown()
         self.emit("    ret")
 
-    def gen_stmt(self, node):
-        t = node.type
-
-        if t == "STRUCT_DEF":
-            return
-
-        if t == "INCLUDE":
-            return
-        
-        if t == "EXTERN":
-            return
-
-        if t == "VAR_DECL":
-            if len(node.children) > 1:
-                val_type = self.gen_expr(node.children[1])
-                offset, size, typ = self.locals[node.value]
-
-                if typ == "FLOAT":
-                    self.emit(f"    movsd [rbp{offset}], xmm0")
-                elif val_type == "FLOAT" and typ == "INT":
-                    self.emit("    cvttsd2si rax, xmm0")
-                    self.emit(f"    mov [rbp{offset}], rax")
-                elif size == 1:
-                    self.emit(f"    mov byte [rbp{offset}], al")
-                else:
-                    self.emit(f"    mov [rbp{offset}], rax")
-
-        elif t == "RETURN":
-            if node.children:
-                ret_type = self.gen_expr(node.children[0])
+    def emit_teardown(self):
+        """Restores the caller's registers and frame, leaving the return address on top"""
+        for reg in self.saved:
+            self.emit(f"    mov {reg}, {self.save_area[reg]}")
+        if self.base == "rbp":
             self.emit("    mov rsp, rbp")
             self.emit("    pop rbp")
-            self.emit("    ret")
-
-        elif t == "IF":
-            self.gen_if(node)
-
-        elif t == "WHILE":
-            self.gen_while(node)
-
-        elif t == "FOR":
-            self.gen_for(node)
-
-        elif t == "UNSAFE_BLOCK":
-            for s in node.children:
-                self.gen_stmt(s)
-
-        elif t == "BREAK":
-            if not self.loop_stack:
-                raise CodegenError("break outside loop")
-            _, end = self.loop_stack[-1]
-            self.emit(f"    jmp {end}")
-
-        elif t == "CONTINUE":
-            if not self.loop_stack:
-                raise CodegenError("continue outside loop")
-            start, _ = self.loop_stack[-1]
-            self.emit(f"    jmp {start}")
 
+    # operands
+
+    def is_reg(self, loc):
+        return not loc.startswith("qword")
+
+    def address_of(self, value):
+        """Memory operand for a slot, global or string address value"""
+        if value.op == "slot":
+            return f"[{self.base}{value.slot.offset}]"
+        if value.op == "global":
+            return f"[{value.target}]"
+        return f"[{self.string_label(value.target)}]"
+
+    def mem(self, addr, scratch="r11"):
+        """Memory operand at the address held by an IR value"""
+        if addr in self.folded:
+            return self.folded_operand(*self.folded[addr], scratch)
+        if isinstance(addr, Instr) and addr.op in self.ADDRESS_OPS:
+            return self.address_of(addr)
+        if isinstance(addr, Const):
+            return f"[{addr.value}]"
+        loc = self.loc[addr]
+        if self.is_reg(loc):
+            return f"[{loc}]"
+        self.emit(f"    mov {scratch}, {loc}")
+        return f"[{scratch}]"
+
+    def folded_operand(self, base, index, scale, disp, scratch):
+        if base.op in self.ADDRESS_OPS:
+            parts = [self.address_of(base)[1:-1]]
         else:
-            self.gen_expr(node)
-
-    def gen_if(self, node):
-        cond, then, els = node.children
-        else_lbl = self.new_label("else")
-        end_lbl = self.new_label("endif")
-
-        self.gen_expr(cond)
-        self.emit("    cmp rax, 0")
-        self.emit(f"    je {else_lbl}")
-
-        for s in then.children:
-            self.gen_stmt(s)
-
-        self.emit(f"    jmp {end_lbl}")
-        self.emit(f"{else_lbl}:")
-
-        for s in els.children:
-            self.gen_stmt(s)
-
-        self.emit(f"{end_lbl}:")
-
-    def gen_while(self, node):
-        start = self.new_label("while")
-        end = self.new_label("endwhile")
-
-        self.loop_stack.append((start, end))
-
-        self.emit(f"{start}:")
-        self.gen_expr(node.children[0])
-        self.emit("    cmp rax, 0")
-        self.emit(f"    je {end}")
-
-        for s in node.children[1].children:
-            self.gen_stmt(s)
-
-        self.emit(f"    jmp {start}")
-        self.emit(f"{end}:")
-
-        self.loop_stack.pop()
-
-    def gen_for(self, node):
-        init, cond, step, body = node.children
-        start = self.new_label("for")
-        end = self.new_label("endfor")
-
-        if init:
-            self.gen_expr(init)
-
-        self.loop_stack.append((start, end))
-
-        self.emit(f"{start}:")
-        if cond:
-            self.gen_expr(cond)
-            self.emit("    cmp rax, 0")
-            self.emit(f"    je {end}")
-
-        for s in body.children:
-            self.gen_stmt(s)
-
-        if step:
-            self.gen_expr(step)
-
-        self.emit(f"    jmp {start}")
-        self.emit(f"{end}:")
-
-        self.loop_stack.pop()
-    
-    def gen_assign(self, node):
-        op = node.value
-        lhs, rhs = node.children
-
-        if lhs.type == "IDENTIFIER":
-            name = lhs.value
-            if name in self.locals:
-                offset, size, typ = self.locals[name]
-                self.emit(f"    lea rdx, [rbp{offset}]")
-            elif name in self.globals:
-                size = self.globals[name]
-                self.emit(f"    lea rdx, [{name}]")
+            parts = [self.in_reg(base, scratch)]
+        if index is not None:
+            reg = self.in_reg(index, "rdx")
+            parts.append(f"{reg}*{scale}" if scale != 1 else reg)
+        text = " + ".join(parts)
+        if disp:
+            text += f" + {disp}" if disp > 0 else f" - {-disp}"
+        return f"[{text}]"
+
+    def in_reg(self, value, scratch):
+        """A register holding value, scratch when it lives in memory"""
+        loc = self.loc[value]
+        if self.is_reg(loc):
+            return loc
+        self.emit(f"    mov {scratch}, {loc}")
+        return scratch
+
+    def src(self, value, scratch):
+        """Integer source operand, a register, memory or a 32-bit immediate"""
+        if isinstance(value, Const):
+            if fits_imm32(value.value):
+                return str(value.value)
+            self.emit(f"    mov {scratch}, {value.value}")
+            return scratch
+        if value.op in self.ADDRESS_OPS:
+            self.emit(f"    lea {scratch}, {self.address_of(value)}")
+            return scratch
+        return self.loc[value]
+
+    def to_reg(self, value, reg):
+        if isinstance(value, Const):
+            self.emit(f"    mov {reg}, {value.value}")
+        elif value.op in self.ADDRESS_OPS:
+            self.emit(f"    lea {reg}, {self.address_of(value)}")
+        elif self.loc[value] != reg:
+            self.emit(f"    mov {reg}, {self.loc[value]}")
+        return reg
+
+    def fsrc(self, value):
+        """Float source operand, an xmm register or memory"""
+        if isinstance(value, Const):
+            return f"qword [{self.float_label(value.value)}]"
+        return self.loc[value]
+
+    def fto_reg(self, value, reg):
+        operand = self.fsrc(value)
+        if operand != reg:
+            self.move(reg, operand, F64)
+        return reg
+
+    def result_reg(self, instr, scratch):
+        """Register to compute instr into, its own when it has one"""
+        loc = self.loc.get(instr)
+        if loc is not None and self.is_reg(loc):
+            return loc
+        return scratch
+
+    def store_result(self, instr, reg):
+        loc = self.loc.get(instr)
+        if loc is not None and loc != reg:
+            mov = "movsd" if instr.ty == F64 else "mov"
+            self.emit(f"    {mov} {loc}, {reg}")
+
+    def move(self, dst, src, ty):
+        if dst == src:
+            return
+        if ty == F64:
+            if not self.is_reg(dst) and not self.is_reg(src):
+                self.emit(f"    mov rax, {src}")
+                self.emit(f"    mov {dst}, rax")
+            elif self.is_reg(dst) and self.is_reg(src):
+                # a register copy, movsd would merge into the old upper half
+                self.emit(f"    movapd {dst}, {src}")
             else:
-                raise CodegenError(f"Undefined variable {name}")
-
-        elif lhs.type == "DEREF":
-            self.gen_expr(lhs.children[0])
-            self.emit("    mov rdx, rax")
-            size = 8 # by default
-
-        elif lhs.type == "ARRAY_INDEX":
-            #array[index] - compute address
-            base = lhs.children[0]
-            index_node = lhs.children[1]
-            
-            self.gen_expr(index_node)
-            self.emit("    push rax")
-            self.gen_expr(base)
-            self.emit("    pop rcx")
-            self.emit("    add rax, rcx")
-            self.emit("    mov rdx, rax")
-            size = 8
-        elif lhs.type == "FIELD_ACCESS":
-            base = lhs.children[0]
-            field = lhs.value
-
-            name = base.value
-            offset, size, typ = self.locals[name]
-
-            field_offset, field_type = self.structs[typ][field]
-
-            self.emit(f"    lea rdx, [rbp{offset + field_offset}]")
-            size = self.sizeof(type("T", (), {"value": field_type, "children": []})())
-        elif lhs.type == "PTR_FIELD_ACCESS":
-            self.gen_expr(lhs.children[0])  # ptr @ rax
-            field = lhs.value
-
-            struct_name = self.locals[lhs.children[0].value][2].replace("_PTR", "")
-            field_offset = self.structs[struct_name][field]
-
-            self.emit(f"    add rax, {field_offset}")
-            self.emit("    mov rdx, rax")
-            size = 8
-        else:
-            raise CodegenError("error: invalid assignment target")
-
-        #RHS
-        rhs_type = self.gen_expr(rhs)
-
-        if rhs_type == "FLOAT" and typ == "INT":
-            self.emit("    cvttsd2si rax, xmm0")
-            self.emit("    mov rcx, rax")
+                self.emit(f"    movsd {dst}, {src}")
+        elif not self.is_reg(dst) and not self.is_reg(src):
+            self.emit(f"    mov rax, {src}")
+            self.emit(f"    mov {dst}, rax")
         else:
-            self.emit("    mov rcx, rax")
-
-        if op == "ASSIGN":
-            self.emit("    mov rax, rcx")
-
-        elif op == "PLUS_ASSIGN":
-            if size == 1:
-                self.emit("    movzx rax, byte [rdx]")
-            else:
-                self.emit("    mov rax, [rdx]")
-            self.emit("    add rax, rcx")
-
-        elif op == "MINUS_ASSIGN":
-            if size == 1:
-                self.emit("    movzx rax, byte [rdx]")
-            else:
-                self.emit("    mov rax, [rdx]")
-            self.emit("    sub rax, rcx")
-
-        elif op == "MULT_ASSIGN":
-            if size == 1:
-                self.emit("    movzx rax, byte [rdx]")
-            else:
-                self.emit("    mov rax, [rdx]")
-            self.emit("    imul rax, rcx")
+            self.emit(f"    mov {dst}, {src}")
 
-        elif op == "DIV_ASSIGN":
-            if size == 1:
-                self.emit("    movzx rax, byte [rdx]")
+    def move_value(self, dst, value, ty):
+        """Materialize a constant or address value into dst"""
+        if ty == F64:
+            if self.is_reg(dst):
+                self.fto_reg(value, dst)
             else:
-                self.emit("    mov rax, [rdx]")
-            self.emit("    cqo")
-            self.emit("    idiv rcx")
-
-        else:
-            raise CodegenError(f"error: unsupported assignment op {op}")
-
-        if typ == "FLOAT":
-            self.emit("    movsd [rdx], xmm0")
-        elif size == 1:
-            self.emit("    mov byte [rdx], al")
+                self.move(dst, self.fsrc(value), F64)
+        elif isinstance(value, Const) and fits_imm32(value.value):
+            self.emit(f"    mov {dst}, {value.value}")
+        elif self.is_reg(dst):
+            self.to_reg(value, dst)
         else:
-            self.emit("    mov [rdx], rax")
-
-    def gen_expr(self, node):
-        t = node.type
-
-        if t == "INCLUDE":
-            return
-        
-        if t == "EXTERN":
-            return
-        
-        if t == "NUMBER":
-            if isinstance(node.value, float):
-                lbl = self.new_label("float")
-                self.data.append((lbl, 8, f"__float64__({node.value})"))
-                self.emit(f"    movsd xmm0, [{lbl}]")
-                return "FLOAT"
-            else:
-                self.emit(f"    mov rax, {node.value}")
-                return "INT"
-
-        elif t == "DEREF":
-            self.gen_expr(node.children[0])
-            self.emit("    movzx rax, byte [rax]")
-
-        elif t == "ADDROF":
-            expr = node.children[0]
-            if expr.type == "IDENTIFIER":
-                name = expr.value
-                if name in self.locals:
-                    offset, _ = self.locals[name]
-                    self.emit(f"    lea rax, [rbp{offset}]")
-                elif name in self.globals:
-                    self.emit(f"    lea rax, [{name}]")
-                else:
-                    raise CodegenError(f"Undefined variable {name}")
-            elif expr.type == "ARRAY_INDEX":
-                # &arr[i]; compute array base + index
-                base = expr.children[0]
-                index_node = expr.children[1]
-                
-                self.gen_expr(index_node)
-                self.emit("    push rax")
-                self.gen_expr(base)
-                self.emit("    pop rcx")
-                self.emit("    add rax, rcx")
-            else:
-                raise CodegenError("error: can only take address of identifiers and array elements")
-        elif t == "FIELD_ACCESS":
-            base = node.children[0] 
-            field = node.value #name
-
-            # addr of struct
-            if base.type == "IDENTIFIER":
-                name = base.value
-                if name in self.locals:
-                    offset, _, typ = self.locals[name]
-                    struct_name = typ
-                    self.emit(f"    lea rax, [rbp{offset}]")
-                elif name in self.globals:
-                    struct_name = None
-                    self.emit(f"    lea rax, [{name}]")
+            self.to_reg(value, "rax")
+            self.emit(f"    mov {dst}, rax")
+
+    def parallel_move(self, moves):
+        """Perform moves (dst, src, ty) as if all at once
+
+        src is a location or an IR value, constants and addresses are
+        materialized after every location has been read.
+        """
+        pending = []
+        late = []
+        for dst, src, ty in moves:
+            if not isinstance(src, str):
+                if self.needs_location(src):
+                    src = self.loc[src]
                 else:
-                    raise CodegenError("unknown struct variable")
-            else:
-                self.gen_expr(base)   # adr. in rax
-
-            struct = struct_name if struct_name else base.value
-            field_offset, field_type = self.structs[struct][field]
-
-            self.emit(f"    add rax, {field_offset}")
-
-            if field_type == "CHAR":
-                self.emit("    movzx rax, byte [rax]")
-                return "INT"
+                    late.append((dst, src, ty))
+                    continue
+            if dst != src:
+                pending.append((dst, src, ty))
+
+        while pending:
+            sources = {src for _, src, _ in pending}
+            for i, (dst, src, ty) in enumerate(pending):
+                if dst not in sources:
+                    self.move(dst, src, ty)
+                    del pending[i]
+                    break
             else:
-                self.emit("    mov rax, [rax]")
-                return field_type
-        elif t == "PTR_FIELD_ACCESS":
-            base = node.children[0]
-            field = node.value
-
-            self.gen_expr(base)  # ptr @ rax
-            struct_name = None
-
-            if base.type == "IDENTIFIER":
-                struct_name = self.locals[base.value][2].replace("_PTR", "")
-
-            field_offset, field_type = self.structs[struct_name][field]
-
-            self.emit(f"    add rax, {field_offset}")
+                # every destination is still needed, park one source to break the cycle
+                dst, src, ty = pending[0]
+                temp = "xmm15" if ty == F64 else "r11"
+                self.move(temp, src, ty)
+                pending = [(d, temp if s == src else s, t) for d, s, t in pending]
+
+        for dst, value, ty in late:
+            self.move_value(dst, value, ty)
+
+    def back_edge_moves(self):
+        """Back edges whose phi moves can go before the branch in the latch
+
+        A rotated loop ends in a branch back to its top, with the moves
+        for the top's phis in a block of their own on that edge. Movs
+        leave the flags alone, so when they write nothing the exit path
+        reads, they run before the jump and the loop takes one branch per
+        iteration instead of a branch and a jump.
+        """
+        index = {b: i for i, b in enumerate(self.order)}
+        bypass = {}
+        for block in self.order:
+            term = block.terminator
+            if term is None or term.op != "br" or isinstance(term.args[0], Const):
+                continue
+            for edge, other in (term.blocks, term.blocks[::-1]):
+                if len(edge.instrs) != 1 or edge.instrs[0].op != "jmp" or edge.preds != [block]:
+                    continue
+                target = edge.instrs[0].blocks[0]
+                if index[target] > index[block]:
+                    continue
+                written = {self.loc[phi] for phi in target.phis() if phi in self.loc}
+                read = {self.loc[v] for v in self.live_in[other] if v in self.loc}
+                for phi in other.phis():
+                    read.update(self.loc[a] for a, b in zip(phi.args, phi.blocks) if b is block and a in self.loc)
+                if not written & read:
+                    bypass[edge] = target
+                    break
+        return bypass
+
+    def phi_moves(self, block, succ):
+        moves = []
+        for phi in succ.phis():
+            if phi not in self.loc:
+                continue
+            for arg, pred in zip(phi.args, phi.blocks):
+                if pred is block:
+                    moves.append((self.loc[phi], arg, phi.ty))
+        self.parallel_move(moves)
+
+    # instructions
+
+    def gen_nothing(self, instr):
+        return
+
+    def gen_copy(self, instr):
+        if instr in self.loc:
+            self.parallel_move([(self.loc[instr], instr.args[0], instr.ty)])
+
+    def gen_int_op(self, instr):
+        a, b = instr.args
+        reg = self.result_reg(instr, "rax")
+        if instr.op == "mul" and isinstance(b, Const) and b.value in self.LEA_SCALES:
+            # x*3, x*5 and x*9 are one lea
+            base = self.src(a, reg)
+            if not self.is_reg(base) or base[0] in "-0123456789":
+                base = self.to_reg(a, reg)
+            self.emit(f"    lea {reg}, [{base}+{base}*{b.value - 1}]")
+            self.store_result(instr, reg)
+            return
+        self.to_reg(a, reg)
+        self.emit(f"    {self.INT_OPS[instr.op]} {reg}, {self.src(b, 'rcx')}")
+        self.store_result(instr, reg)
+
+    def gen_mulhi(self, instr):
+        a, b = instr.args
+        self.to_reg(a, "rax")
+        factor = self.src(b, "rcx")
+        if factor[0] in "-0123456789":
+            factor = self.to_reg(b, "rcx")
+        # one-operand imul leaves the high half of the product in rdx
+        self.emit(f"    imul {factor}")
+        self.store_result(instr, "rdx")
+
+    def gen_shift(self, instr):
+        a, b = instr.args
+        reg = self.result_reg(instr, "rax")
+        if isinstance(b, Const):
+            count = b.value & 63
+        else:
+            self.to_reg(b, "rcx")
+            count = "cl"
+        self.to_reg(a, reg)
+        self.emit(f"    {self.SHIFT_OPS[instr.op]} {reg}, {count}")
+        self.store_result(instr, reg)
+
+    def gen_div(self, instr):
+        a, b = instr.args
+        self.to_reg(a, "rax")
+        self.emit("    cqo")
+        divisor = self.src(b, "rcx")
+        if divisor[0] in "-0123456789":
+            divisor = self.to_reg(b, "rcx")
+        self.emit(f"    idiv {divisor}")
+        self.store_result(instr, "rax" if instr.op == "div" else "rdx")
+
+    def gen_pow(self, instr):
+        a, b = instr.args
+        self.to_reg(b, "rcx")
+        self.to_reg(a, "rdx")
+        self.emit("    mov rax, 1")
 
-            if field_type == "CHAR":
-                self.emit("    movzx rax, byte [rax]")
-                return "INT"
-            else:
-                self.emit("    mov rax, [rax]")
-                return field_type
-
-        elif t == "ARRAY_INDEX":
-            #array[index] = *(array + index)
-            base = node.children[0]
-            index_node = node.children[1]
-            
-            self.gen_expr(index_node)
-            self.emit("    push rax")
-            self.gen_expr(base)
-            self.emit("    pop rcx")
-            self.emit("    add rax, rcx")
-            self.emit("    movzx rax, byte [rax]")
-
-        elif t == "PRE_INC":
-            if node.children[0].type == "IDENTIFIER":
-                name = node.children[0].value
-                offset, size, typ = self.locals[name]
-                if size == 1:
-                    self.emit(f"    movzx rax, byte [rbp{offset}]")
-                    self.emit("    add al, 1")
-                    self.emit(f"    mov byte [rbp{offset}], al")
-                    self.emit(f"    movzx rax, byte [rbp{offset}]")
-                else:
-                    self.emit(f"    mov rax, [rbp{offset}]")
-                    self.emit("    add rax, 1")
-                    self.emit(f"    mov [rbp{offset}], rax")
-            else:
-                raise CodegenError("error: invalid increment target")
-
-        elif t == "PRE_DEC":
-            if node.children[0].type == "IDENTIFIER":
-                name = node.children[0].value
-                offset, size, typ = self.locals[name]
-                if size == 1:
-                    self.emit(f"    movzx rax, byte [rbp{offset}]")
-                    self.emit("    sub al, 1")
-                    self.emit(f"    mov byte [rbp{offset}], al")
-                    self.emit(f"    movzx rax, byte [rbp{offset}]")
-                else:
-                    self.emit(f"    mov rax, [rbp{offset}]")
-                    self.emit("    sub rax, 1")
-                    self.emit(f"    mov [rbp{offset}], rax")
+        # square and multiply over the bits of the exponent, a negative
+        # exponent counts as its unsigned value like the old repeat loop did
+        pow_loop = self.new_label(".Lpow_loop")
+        pow_skip = self.new_label(".Lpow_skip")
+        end_pow = self.new_label(".Lend_pow")
+
+        self.emit(f"{pow_loop}:")
+        self.emit("    test rcx, rcx")
+        self.emit(f"    je {end_pow}")
+        self.emit("    test cl, 1")
+        self.emit(f"    je {pow_skip}")
+        self.emit("    imul rax, rdx")
+        self.emit(f"{pow_skip}:")
+        self.emit("    imul rdx, rdx")
+        self.emit("    shr rcx, 1")
+        self.emit(f"    jmp {pow_loop}")
+        self.emit(f"{end_pow}:")
+        self.store_result(instr, "rax")
+
+    def gen_neg(self, instr):
+        reg = self.result_reg(instr, "rax")
+        self.to_reg(instr.args[0], reg)
+        self.emit(f"    neg {reg}")
+        self.store_result(instr, reg)
+
+    def gen_cmp(self, instr):
+        if instr not in self.fused:
+            self.set_flag(instr, self.SETCC[self.compare(instr)])
+
+    def compare(self, instr):
+        """Set the flags for an integer compare, returns the condition to test them with"""
+        a, b = instr.args
+        cond = instr.cond
+        if isinstance(a, Const) and not isinstance(b, Const):
+            a, b = b, a
+            cond = self.SWAPPED[cond]
+        left = self.src(a, "rax")
+        if left[0] in "-0123456789":
+            left = self.to_reg(a, "rax")
+        right = self.src(b, "rcx")
+        if isinstance(b, Const) and b.value == 0 and self.is_reg(left):
+            self.emit(f"    test {left}, {left}")
+            return cond
+        if not self.is_reg(left) and not self.is_reg(right):
+            left = self.to_reg(a, "rax")
+        self.emit(f"    cmp {left}, {right}")
+        return cond
+
+    def set_flag(self, instr, setcc):
+        reg = self.result_reg(instr, "rax")
+        self.emit(f"    {setcc} al")
+        self.emit(f"    movzx {reg}, al")
+        self.store_result(instr, reg)
+
+    def gen_float_op(self, instr):
+        a, b = instr.args
+        reg = self.result_reg(instr, "xmm0")
+        self.fto_reg(a, reg)
+        self.emit(f"    {self.FLOAT_OPS[instr.op]} {reg}, {self.fsrc(b)}")
+        self.store_result(instr, reg)
+
+    def gen_fneg(self, instr):
+        reg = self.result_reg(instr, "xmm0")
+        self.fto_reg(instr.args[0], reg)
+        # flip the sign bit
+        self.emit(f"    movq rax, {reg}")
+        self.emit("    btc rax, 63")
+        self.emit(f"    movq {reg}, rax")
+        self.store_result(instr, reg)
+
+    def gen_fcmp(self, instr):
+        if instr not in self.fused:
+            self.set_flag(instr, self.FLOAT_SETCC[self.float_compare(instr)])
+
+    def float_compare(self, instr):
+        a, b = instr.args
+        cond = instr.cond
+        if isinstance(a, Const) and not isinstance(b, Const):
+            a, b = b, a
+            cond = self.SWAPPED[cond]
+        self.emit(f"    ucomisd {self.fto_reg_if_needed(a)}, {self.fsrc(b)}")
+        return cond
+
+    def gen_itof(self, instr):
+        value = instr.args[0]
+        reg = self.result_reg(instr, "xmm0")
+        operand = self.src(value, "rax")
+        if operand[0] in "-0123456789":
+            operand = self.to_reg(value, "rax")
+        self.emit(f"    cvtsi2sd {reg}, {operand}")
+        self.store_result(instr, reg)
+
+    def gen_ftoi(self, instr):
+        reg = self.result_reg(instr, "rax")
+        self.emit(f"    cvttsd2si {reg}, {self.fsrc(instr.args[0])}")
+        self.store_result(instr, reg)
+
+    def gen_extend(self, instr):
+        """zext and sext, the low bytes of a value widened back to 64 bits"""
+        value = instr.args[0]
+        width = instr.mem
+        reg = self.result_reg(instr, "rax")
+        size, low, bits = self.NARROW[width]
+        if isinstance(value, Const):
+            v = value.value & ((1 << bits) - 1)
+            if instr.op == "sext" and v >> (bits - 1):
+                v -= 1 << bits
+            self.emit(f"    mov {reg}, {v}")
+        elif instr.op == "zext" and width == "i32":
+            # writing a 32-bit register clears the upper half
+            self.emit(f"    mov {self.DWORD_REGS[reg]}, {self.low_source(value, 'dword', self.DWORD_REGS, reg)}")
+        else:
+            self.emit(f"    {self.EXTEND[instr.op, width]} {reg}, {self.low_source(value, size, low, reg)}")
+        self.store_result(instr, reg)
+
+    def low_source(self, value, size, low, reg):
+        """The low bytes of value as a register or memory operand"""
+        if self.needs_location(value) and not self.is_reg(self.loc[value]):
+            return f"{size} {self.loc[value][6:]}"
+        self.to_reg(value, reg)
+        return low[reg]
+
+    def gen_load(self, instr):
+        operand = self.mem(instr.args[0])
+        if instr.mem == "f64":
+            reg = self.result_reg(instr, "xmm0")
+            self.emit(f"    movsd {reg}, qword {operand}")
+        else:
+            reg = self.result_reg(instr, "rax")
+            if instr.mem in self.NARROW:
+                size = self.NARROW[instr.mem][0]
+                self.emit(f"    {self.EXTEND[self.LOAD_EXTEND[instr.mem], instr.mem]} {reg}, {size} {operand}")
             else:
-                raise CodegenError("error: invalid decrement target")
-
-        elif t == "POST_INC":
-            if node.children[0].type == "IDENTIFIER":
-                name = node.children[0].value
-                offset, size, typ = self.locals[name]
-                if size == 1:
-                    self.emit(f"    movzx rax, byte [rbp{offset}]")
-                    self.emit("    push rax")
-                    self.emit("    add al, 1")
-                    self.emit(f"    mov byte [rbp{offset}], al")
-                    self.emit("    pop rax")
-                else:
-                    self.emit(f"    mov rax, [rbp{offset}]")
-                    self.emit("    push rax")
-                    self.emit("    add rax, 1")
-                    self.emit(f"    mov [rbp{offset}], rax")
-                    self.emit("    pop rax")
+                self.emit(f"    mov {reg}, qword {operand}")
+        self.store_result(instr, reg)
+
+    def gen_store(self, instr):
+        addr, value = instr.args
+        operand = self.mem(addr)
+        if instr.mem == "f64":
+            self.emit(f"    movsd qword {operand}, {self.fto_reg_if_needed(value)}")
+        elif isinstance(value, Const) and fits_imm32(value.value):
+            if instr.mem in self.NARROW:
+                size, _, bits = self.NARROW[instr.mem]
+                self.emit(f"    mov {size} {operand}, {value.value & ((1 << bits) - 1)}")
             else:
-                raise CodegenError("error: invalid increment target")
-
-        elif t == "POST_DEC":
-            if node.children[0].type == "IDENTIFIER":
-                name = node.children[0].value
-                offset, size, typ = self.locals[name]
-                if size == 1:
-                    self.emit(f"    movzx rax, byte [rbp{offset}]")
-                    self.emit("    push rax")
-                    self.emit("    sub al, 1")
-                    self.emit(f"    mov byte [rbp{offset}], al")
-                    self.emit("    pop rax")
-                else:
-                    self.emit(f"    mov rax, [rbp{offset}]")
-                    self.emit("    push rax")
-                    self.emit("    sub rax, 1")
-                    self.emit(f"    mov [rbp{offset}], rax")
-                    self.emit("    pop rax")
-            else:
-                raise CodegenError("error: invalid decrement target")
-
-        elif t == "IDENTIFIER":
-            if node.value in self.locals:
-                offset, size, typ = self.locals[node.value]
-                if typ == "FLOAT":
-                    self.emit(f"    movsd xmm0, [rbp{offset}]")
-                    return "FLOAT"
-                elif size == 1:
-                    self.emit(f"    movzx rax, byte [rbp{offset}]")
-                    return "INT"
-                else:
-                    self.emit(f"    mov rax, [rbp{offset}]")
-                    return "INT"
-            elif node.value in self.globals:
-                size = self.globals[node.value]
-                if size == 1:
-                    self.emit(f"    movzx rax, byte [{node.value}]")
-                else:
-                    self.emit(f"    mov rax, [{node.value}]")
+                self.emit(f"    mov qword {operand}, {value.value}")
+        else:
+            reg = self.src(value, "rax")
+            if not self.is_reg(reg):
+                reg = self.to_reg(value, "rax")
+            if instr.mem in self.NARROW:
+                size, low, _ = self.NARROW[instr.mem]
+                self.emit(f"    mov {size} {operand}, {low[reg]}")
             else:
-                raise CodegenError(f"Undefined variable {node.value}")
-
-        elif t == "BIN_OP" and (node.value == "ASSIGN" or node.value.endswith("_ASSIGN")):
-            self.gen_assign(node)
-
-        elif t == "BIN_OP":
-            lt = self.gen_expr(node.children[0])
-
-            if lt == "FLOAT":
-                self.emit("    sub rsp, 8")
-                self.emit("    movsd [rsp], xmm0")
+                self.emit(f"    mov qword {operand}, {reg}")
+
+    def fto_reg_if_needed(self, value):
+        operand = self.fsrc(value)
+        if self.is_reg(operand):
+            return operand
+        return self.fto_reg(value, "xmm0")
+
+    def gen_call(self, instr):
+        self.call_args(instr)
+        self.emit(f"    call {instr.target}")
+        if instr in self.loc:
+            self.store_result(instr, "xmm0" if instr.ty == F64 else "rax")
+
+    def gen_tailcall(self, instr):
+        # arguments only travel in registers, the frame can go before the jump
+        self.call_args(instr)
+        self.emit_teardown()
+        self.emit(f"    jmp {instr.target}")
+
+    def call_args(self, instr):
+        name = instr.target
+        self.called.add(name)
+        # the runtime helpers take their argument in rax
+        int_regs = ["rax"] if name in self.RUNTIME else self.ARG_REGS
+
+        moves = []
+        int_i = 0
+        float_i = 0
+        for arg in instr.args:
+            if arg.ty == F64:
+                moves.append((self.FLOAT_REGS[float_i], arg, F64))
+                float_i += 1
             else:
-                self.emit("    push rax")
-
-            rt = self.gen_expr(node.children[1])
-
-            if lt == "FLOAT" or rt == "FLOAT":
-                if rt == "INT":
-                    self.emit("    cvtsi2sd xmm0, rax")
-                self.emit("    movsd xmm1, xmm0")
-
-                if lt == "FLOAT":
-                    self.emit("    movsd xmm0, [rsp]")
-                    self.emit("    add rsp, 8")
-                else:
-                    self.emit("    pop rax")
-                    self.emit("    cvtsi2sd xmm0, rax")
+                moves.append((int_regs[int_i], arg, None))
+                int_i += 1
+        self.parallel_move(moves)
 
-                if node.value in ("EQ", "NE", "LT", "LE", "GT", "GE"):
-                    self.gen_float_cmp(node.value)
-                    return "INT"
-                else:
-                    self.gen_float_binop(node.value)
-                    return "FLOAT"
+    def gen_ret(self, instr):
+        if instr.args:
+            value = instr.args[0]
+            if self.fn.ret == F64:
+                self.fto_reg(value, "xmm0")
             else:
-                self.emit("    mov rcx, rax")
-                self.emit("    pop rax")
-                self.gen_binop(node.value)
-                return "INT"
-
-        elif t == "CALL":
-            self.gen_call(node)
-
-        elif t == "STRING":
-            lbl = self.string_label(node.value)
-            self.emit(f"    lea rax, [{lbl}]")
-
-        elif t == "CHAR_LIT":
-            self.emit(f"    mov rax, {node.value}")
-
-        elif t == "UNARY_MINUS":
-            self.gen_expr(node.children[0])
-            self.emit("    neg rax")
-
-        else:
-            raise CodegenError(f"error: unsupported expr {t}")
-        
-    def gen_float_binop(self, op):
-        ops = {
-            "PLUS": "addsd",
-            "MINUS": "subsd",
-            "MULTIPLY": "mulsd",
-            "DIVIDE": "divsd",
-        }
-
-        if op in ops:
-            self.emit(f"    {ops[op]} xmm0, xmm1")
+                self.to_reg(value, "rax")
+        self.emit_epilogue()
+
+    def gen_jmp(self, instr):
+        target = instr.blocks[0]
+        self.phi_moves(instr.block, target)
+        if target is not self.next_block:
+            self.emit(f"    jmp {self.labels[target]}")
+
+    def gen_br(self, instr):
+        cond = instr.args[0]
+        then, els = instr.blocks
+        if isinstance(cond, Const):
+            target = then if cond.value else els
+            if target is not self.next_block:
+                self.emit(f"    jmp {self.labels[target]}")
             return
 
-        raise CodegenError(f"unsupported float operator {op}")
-    
-    def gen_float_cmp(self, op):
-        #xmm0 left, xmm1 right
-        self.emit("    ucomisd xmm0, xmm1")
-
-        setcc = {
-            "EQ": "sete",
-            "NE": "setne",
-            "LT": "setb",   # <
-            "LE": "setbe",  # <=
-            "GT": "seta",   # >
-            "GE": "setae",  # >=
-        }[op]
-
-        self.emit(f"    {setcc} al")
-        self.emit("    movzx rax, al")
-
-    def gen_binop(self, op):
-        ops = {
-            "PLUS": "add",
-            "MINUS": "sub",
-            "MULTIPLY": "imul",
-        }
-
-        if op in ops:
-            self.emit(f"    {ops[op]} rax, rcx")
-            return
-
-        if op == "DIVIDE":
-            self.emit("    cqo")
-            self.emit("    idiv rcx")
-            return
-
-        if op == "MOD":
-            self.emit("    cqo")
-            self.emit("    idiv rcx")
-            self.emit("    mov rax, rdx")
-            return
-        
-        if op == "POW":
-            self.emit("    mov rbx, rax")
-            self.emit("    mov rax, 1")
-
-            pow_loop = self.new_label("pow_loop")
-            end_pow = self.new_label("end_pow")
-
-            self.emit(f"{pow_loop}:")
-            self.emit("    cmp rcx, 0")
-            self.emit(f"    je {end_pow}")
-            self.emit("    imul rax, rbx")
-            self.emit("    dec rcx")
-            self.emit(f"    jmp {pow_loop}")
-            self.emit(f"{end_pow}:")
-            return
-
-        if op in ("EQ", "NE", "LT", "LE", "GT", "GE"):
-            self.emit("    cmp rax, rcx")
-            setcc = {
-                "EQ": "sete",
-                "NE": "setne",
-                "LT": "setl",
-                "LE": "setle",
-                "GT": "setg",
-                "GE": "setge",
-            }[op]
-            self.emit(f"    {setcc} al")
-            self.emit("    movzx rax, al")
-            return
-
-        raise CodegenError(f"error: unsupported operator {op}")
-
-    def gen_call(self, node):
-        argc = len(node.children)
-        func_base = node.value
-
-        if func_base in ["main", "puts", "display_number", "display_number_nonl", "print_char"]:
-            func_name = func_base
+        if cond in self.fused and cond.op == "fcmp":
+            jcc = self.FLOAT_JCC
+            code = self.float_compare(cond)
+        elif cond in self.fused:
+            jcc = self.JCC
+            code = self.compare(cond)
         else:
-            arg_types = []
-            for arg in node.children:
-                if arg.type == "STRING":
-                    arg_types.append("CHAR_PTR")
-
-                elif arg.type == "CHAR_LIT":
-                    arg_types.append("CHAR")
-
-                elif arg.type == "IDENTIFIER":
-                    if arg.value in self.locals:
-                        _, size, typ = self.locals[arg.value]
-                        arg_types.append("FLOAT" if typ == "FLOAT" else typ)
-                    else:
-                        arg_types.append("INT")
-
-                elif arg.type == "NUMBER" and isinstance(arg.value, float):
-                    arg_types.append("FLOAT")
-
-                elif arg.type == "FIELD_ACCESS":
-                    struct_base = arg.children[0]
-                    field = arg.value
-                    _, _, struct_type = self.locals[struct_base.value]
-                    field_type = self.structs[struct_type][field][1]
-                    arg_types.append(field_type)
-
-                elif arg.type == "PTR_FIELD_ACCESS":
-                    struct_base = arg.children[0]
-                    struct_type = self.locals[struct_base.value][2].replace("_PTR", "")
-                    field = arg.value
-                    field_type = self.structs[struct_type][field][1]
-                    arg_types.append(field_type)
-
-                else:
-                    arg_types.append("INT")
-
-            func_name = func_base + "__" + "_".join(arg_types)
-
-        int_i = 0
-        float_i = 0
-
-        for arg in node.children:
-            t = self.gen_expr(arg)
-            if t == "FLOAT":
-                self.emit(f"    movsd {self.FLOAT_REGS[float_i]}, xmm0")
-                float_i += 1
+            jcc = self.JCC
+            code = "ne"
+            loc = self.src(cond, "rax")
+            if self.is_reg(loc):
+                self.emit(f"    test {loc}, {loc}")
             else:
-                self.emit(f"    mov {self.ARG_REGS[int_i]}, rax")
-                int_i += 1
+                self.emit(f"    cmp {loc}, 0")
 
-        self.emit("    sub rsp, 16")
-        self.emit(f"    call {func_name}")
-        self.emit("    add rsp, 16")
+        for edge in (then, els):
+            if edge in self.bypass:
+                self.phi_moves(edge, self.bypass[edge])
+        then = self.bypass.get(then, then)
+        els = self.bypass.get(els, els)
+
+        # fall through into whichever successor comes next
+        if then is self.next_block:
+            self.emit(f"    {jcc[self.INVERTED[code]]} {self.labels[els]}")
+        else:
+            self.emit(f"    {jcc[code]} {self.labels[then]}")
+            if els is not self.next_block:
+                self.emit(f"    jmp {self.labels[els]}")
 
-    def peephole(self, lines):
-        out = []
-        i = 0
-        while i < len(lines):
-            if i+1 < len(lines) and lines[i] == "    push rax" and lines[i+1] == "    pop rax":
-                i += 2
-                continue
-            if i+1 < len(lines) and lines[i].startswith("    mov rax, rax"):
-                i += 1
-                continue
-            out.append(lines[i])
-            i += 1
-        return out
\ No newline at end of file
@@ -0,0 +1,79 @@
+from ir.ir import Instr, Const
+
+# instructions whose value is the address of a whole object
+ROOTS = ("slot", "global", "str")
+
+
+def root_of(addr):
+    """The slot, global or string an address points into, None for an unknown pointer"""
+    while isinstance(addr, Instr):
+        if addr.op in ROOTS:
+            return addr
+        if addr.op not in ("add", "sub") or not isinstance(addr.args[0], Instr):
+            return None
+        addr = addr.args[0]
+    return None
+
+
+def same_object(a, b):
+    if a is b:
+        return True
+    if a.op != b.op or a.op == "str":
+        return False
+    return a.slot is b.slot if a.op == "slot" else a.target == b.target
+
+
+def dereferenceable(addr):
+    """An address that points into its object whether or not the program would reach the access"""
+    if isinstance(addr, Instr) and addr.op == "add" and isinstance(addr.args[1], Const):
+        addr = addr.args[0]
+    return isinstance(addr, Instr) and addr.op in ROOTS
+
+
+class AliasInfo:
+    """Which memory accesses of a function may touch the same bytes
+
+    Objects are told apart by the slot, global or string an address is
+    derived from. A slot whose address only feeds loads, stores and
+    further address arithmetic cannot be reached through any other
+    pointer, nor by the functions this one calls.
+    """
+
+    def __init__(self, fn):
+        users = {}
+        for instr in fn.instrs():
+            for i, a in enumerate(instr.args):
+                if isinstance(a, Instr):
+                    users.setdefault(a, []).append((instr, i))
+        self.escaped = set()
+        for instr in fn.instrs():
+            if instr.op == "slot" and not self.addressing_only(instr, users):
+                self.escaped.add(instr.slot)
+
+    def addressing_only(self, slot, users):
+        work = [slot]
+        seen = set()
+        while work:
+            addr = work.pop()
+            if addr in seen:
+                continue
+            seen.add(addr)
+            for user, i in users.get(addr, ()):
+                if user.op in ("add", "sub") and i == 0:
+                    work.append(user)
+                elif user.op not in ("load", "store") or i != 0:
+                    return False
+        return True
+
+    def private(self, root):
+        return root is not None and root.op == "slot" and root.slot not in self.escaped
+
+    def may_alias(self, a, b):
+        ra, rb = root_of(a), root_of(b)
+        if ra is not None and rb is not None:
+            return same_object(ra, rb)
+        # an unknown pointer reaches anything but the private slots
+        return not (self.private(ra) or self.private(rb))
+
+    def clobbered_by_call(self, addr):
+        return not self.private(root_of(addr))
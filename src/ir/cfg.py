@@ -0,0 +1,236 @@
+from ir.ir import Instr
+
+
+def reverse_postorder(fn):
+    """Blocks in reverse postorder, the first successor of a branch is laid out first"""
+    order = []
+    seen = {fn.entry}
+    stack = [(fn.entry, iter(reversed(fn.entry.succs)))]
+    while stack:
+        block, succs = stack[-1]
+        for succ in succs:
+            if succ not in seen:
+                seen.add(succ)
+                stack.append((succ, iter(reversed(succ.succs))))
+                break
+        else:
+            stack.pop()
+            order.append(block)
+    order.reverse()
+    return order
+
+
+def dominators(fn):
+    """Immediate dominator of every reachable block (Cooper, Harvey and Kennedy)"""
+    order = reverse_postorder(fn)
+    index = {b: i for i, b in enumerate(order)}
+    idom = {fn.entry: fn.entry}
+
+    def intersect(a, b):
+        while a is not b:
+            while index[a] > index[b]:
+                a = idom[a]
+            while index[b] > index[a]:
+                b = idom[b]
+        return a
+
+    changed = True
+    while changed:
+        changed = False
+        for block in order[1:]:
+            new = None
+            for pred in block.preds:
+                if pred in idom:
+                    new = pred if new is None else intersect(pred, new)
+            if idom.get(block) is not new:
+                idom[block] = new
+                changed = True
+    return idom
+
+
+def dominates(idom, a, b):
+    while True:
+        if b is a:
+            return True
+        parent = idom.get(b)
+        if parent is None or parent is b:
+            return False
+        b = parent
+
+
+def dom_children(idom):
+    children = {b: [] for b in idom}
+    for block, parent in idom.items():
+        if parent is not block:
+            children[parent].append(block)
+    return children
+
+
+class Loop:
+    __slots__ = ("header", "blocks", "latches", "parent")
+
+    def __init__(self, header):
+        self.header = header
+        self.blocks = {header}
+        self.latches = []
+        self.parent = None
+
+    def exits(self):
+        """Blocks outside the loop that are branched to from inside it"""
+        out = []
+        for block in self.blocks:
+            for succ in block.succs:
+                if succ not in self.blocks and succ not in out:
+                    out.append(succ)
+        return out
+
+    def __repr__(self):
+        return f"Loop({self.header.label}, {len(self.blocks)} blocks)"
+
+
+def find_loops(fn, idom=None):
+    """Natural loops, innermost first, back edges to one header share a loop"""
+    if idom is None:
+        idom = dominators(fn)
+    loops = {}
+    for block in fn.blocks:
+        if block not in idom:
+            continue
+        for succ in block.succs:
+            if dominates(idom, succ, block):
+                loop = loops.get(succ)
+                if loop is None:
+                    loop = loops[succ] = Loop(succ)
+                loop.latches.append(block)
+                work = [block]
+                while work:
+                    b = work.pop()
+                    if b not in loop.blocks:
+                        loop.blocks.add(b)
+                        work.extend(b.preds)
+
+    ordered = sorted(loops.values(), key=lambda l: len(l.blocks))
+    for i, loop in enumerate(ordered):
+        for outer in ordered[i + 1:]:
+            if loop.header in outer.blocks and outer is not loop:
+                loop.parent = outer
+                break
+    return ordered
+
+
+def loop_depths(fn, loops=None):
+    if loops is None:
+        loops = find_loops(fn)
+    for block in fn.blocks:
+        block.depth = 0
+    for loop in loops:
+        for block in loop.blocks:
+            block.depth += 1
+
+
+def block_order(fn, loops=None):
+    """Reverse postorder with the blocks of every loop kept together
+
+    A loop is placed whole where its header falls, so the body runs
+    without jumping over unrelated code and the exit comes right after
+    the latch, where a bottom-tested loop falls through out of it.
+    """
+    if loops is None:
+        loops = find_loops(fn)
+    order = reverse_postorder(fn)
+    innermost = {}
+    for loop in loops:
+        for block in loop.blocks:
+            innermost.setdefault(block, loop)
+    placed = set()
+    out = []
+
+    def place(blocks, outer):
+        for block in blocks:
+            if block in placed:
+                continue
+            loop = innermost.get(block)
+            while loop is not None and loop is not outer and loop.parent is not outer:
+                loop = loop.parent
+            if loop is None or loop is outer:
+                placed.add(block)
+                out.append(block)
+            else:
+                place([b for b in order if b in loop.blocks], loop)
+
+    place(order, None)
+    return out
+
+
+def split_edge(fn, pred, succ):
+    """Put a new block on the edge pred -> succ and return it"""
+    mid = fn.new_block("split")
+    term = pred.terminator
+    term.blocks = [mid if b is succ else b for b in term.blocks]
+    jump = fn.number(Instr("jmp", blocks=[succ]))
+    jump.block = mid
+    mid.instrs.append(jump)
+    for phi in succ.phis():
+        phi.blocks = [mid if b is pred else b for b in phi.blocks]
+    mid.preds = [pred]
+    succ.preds = [mid if p is pred else p for p in succ.preds]
+    return mid
+
+
+def split_critical_edges(fn, phis_only=False):
+    """Edges from a branch into a block with several predecessors get their own block
+
+    With phis_only, only edges that need somewhere to put phi moves are split.
+    """
+    for block in list(fn.blocks):
+        term = block.terminator
+        if term is None or len(term.blocks) < 2:
+            continue
+        if term.blocks[0] is term.blocks[-1]:
+            # both arms go to the same place
+            term.op = "jmp"
+            term.args = []
+            term.blocks = term.blocks[:1]
+            continue
+        for succ in list(term.blocks):
+            if len(succ.preds) > 1 and not (phis_only and succ.instrs[0].op != "phi"):
+                split_edge(fn, block, succ)
+
+
+def preheader(fn, loop):
+    """The block every entry into loop comes from, created when there is none
+
+    Header phis take a single incoming value from it, merged in the new
+    block when several outside predecessors feed the loop.
+    """
+    header = loop.header
+    outside = [p for p in header.preds if p not in loop.blocks]
+    if len(outside) == 1 and len(outside[0].succs) == 1:
+        return outside[0]
+    if len(outside) == 1:
+        pre = split_edge(fn, outside[0], header)
+    else:
+        pre = fn.new_block("preheader")
+        for pred in outside:
+            term = pred.terminator
+            term.blocks = [pre if b is header else b for b in term.blocks]
+        for phi in header.phis():
+            incoming = [(a, b) for a, b in zip(phi.args, phi.blocks) if b in outside]
+            inside = [(a, b) for a, b in zip(phi.args, phi.blocks) if b not in outside]
+            value = incoming[0][0]
+            if any(a is not value for a, _ in incoming):
+                value = fn.number(Instr("phi", [a for a, _ in incoming], phi.ty, blocks=[b for _, b in incoming]))
+                value.block = pre
+                pre.instrs.append(value)
+            phi.args = [a for a, _ in inside] + [value]
+            phi.blocks = [b for _, b in inside] + [pre]
+        jump = fn.number(Instr("jmp", blocks=[header]))
+        jump.block = pre
+        pre.instrs.append(jump)
+        pre.preds = outside
+        header.preds = [p for p in header.preds if p not in outside] + [pre]
+    parent = loop.parent
+    while parent is not None:
+        parent.blocks.add(pre)
+        parent = parent.parent
+    return pre
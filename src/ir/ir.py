@@ -0,0 +1,287 @@
+import struct
+
+# value types, every register value is 64 bits wide
+I64 = "i64"
+F64 = "f64"
+
+# memory access widths
+MEM_TYPES = ("i8", "i16", "i32", "i64", "f64")
+
+# tailcall returns whatever the called function returns
+TERMINATORS = ("jmp", "br", "ret", "tailcall")
+# no side effects, an unused result can be dropped
+PURE = {
+    "copy", "add", "sub", "mul", "mulhi", "neg", "and", "or", "xor", "shl", "sar", "shr",
+    "cmp", "fadd", "fsub", "fmul", "fdiv", "fneg", "fcmp",
+    "itof", "ftoi", "zext", "sext", "slot", "global", "str", "phi", "param",
+}
+COMMUTATIVE = {"add", "mul", "mulhi", "and", "or", "xor", "fadd", "fmul"}
+CONDS = ("eq", "ne", "lt", "le", "gt", "ge")
+
+
+class Const:
+    """Immediate operand, ints are 64-bit two's complement and floats are doubles"""
+
+    __slots__ = ("value", "ty")
+
+    def __init__(self, value, ty=I64):
+        self.value = value
+        self.ty = ty
+
+    def key(self):
+        # floats compare by bit pattern so 0.0 and -0.0 stay distinct
+        if self.ty == F64:
+            return (F64, struct.pack("<d", self.value))
+        return (I64, self.value)
+
+    def __repr__(self):
+        return repr(self.value)
+
+
+class Slot:
+    """Stack memory for locals that can't live in SSA values: arrays, structs, address-taken scalars"""
+
+    __slots__ = ("name", "size", "align", "offset")
+
+    def __init__(self, name, size, align=8):
+        self.name = name
+        self.size = size
+        self.align = align
+        self.offset = None        # frame offset, set by the backend
+
+    def __repr__(self):
+        return f"${self.name}"
+
+
+class Instr:
+    """One three-address instruction, its result is the SSA value it defines"""
+
+    __slots__ = ("op", "args", "ty", "id", "block", "target", "cond", "mem", "slot", "blocks")
+
+    def __init__(self, op, args=(), ty=None, target=None, cond=None, mem=None, slot=None, blocks=None):
+        self.op = op
+        self.args = list(args)
+        self.ty = ty              # I64, F64 or None when there is no result
+        self.id = None
+        self.block = None
+        self.target = target      # call target, global name, string literal or param index
+        self.cond = cond          # comparison condition
+        self.mem = mem            # memory width of load, store, zext and sext
+        self.slot = slot
+        # successors of a terminator, incoming block of each phi argument
+        self.blocks = blocks if blocks is not None else []
+
+    def __repr__(self):
+        return f"%{self.id}"
+
+
+class Block:
+    __slots__ = ("id", "name", "instrs", "preds", "depth")
+
+    def __init__(self, id_, name):
+        self.id = id_
+        self.name = name
+        self.instrs = []
+        self.preds = []
+        self.depth = 0            # loop nesting, set by cfg.loop_depths
+
+    @property
+    def label(self):
+        return f"{self.name}{self.id}"
+
+    @property
+    def terminator(self):
+        if self.instrs and self.instrs[-1].op in TERMINATORS:
+            return self.instrs[-1]
+        return None
+
+    @property
+    def succs(self):
+        term = self.terminator
+        return term.blocks if term is not None else []
+
+    def phis(self):
+        for instr in self.instrs:
+            if instr.op != "phi":
+                break
+            yield instr
+
+    def __repr__(self):
+        return self.label
+
+
+class Function:
+    def __init__(self, name, ret=None):
+        self.name = name
+        self.ret = ret            # I64, F64 or None for void
+        self.params = []
+        self.blocks = []
+        self.slots = []
+        self.next_id = 0
+        self.next_block = 0
+
+    @property
+    def entry(self):
+        return self.blocks[0]
+
+    def new_block(self, name="b"):
+        block = Block(self.next_block, name)
+        self.next_block += 1
+        self.blocks.append(block)
+        return block
+
+    def number(self, instr):
+        instr.id = self.next_id
+        self.next_id += 1
+        return instr
+
+    def instrs(self):
+        for block in self.blocks:
+            yield from block.instrs
+
+    def compute_preds(self):
+        for block in self.blocks:
+            block.preds = []
+        for block in self.blocks:
+            for succ in block.succs:
+                if block not in succ.preds:
+                    succ.preds.append(block)
+
+    def replace_uses(self, mapping):
+        """Rewrite every operand through mapping, following chains of replacements"""
+        if not mapping:
+            return
+
+        def resolve(v):
+            while v in mapping:
+                v = mapping[v]
+            return v
+
+        for instr in self.instrs():
+            instr.args = [resolve(a) if a in mapping else a for a in instr.args]
+
+    def remove_unreachable(self):
+        seen = set()
+        work = [self.entry]
+        while work:
+            block = work.pop()
+            if block in seen:
+                continue
+            seen.add(block)
+            work.extend(block.succs)
+
+        if len(seen) == len(self.blocks):
+            return False
+        self.blocks = [b for b in self.blocks if b in seen]
+        for block in self.blocks:
+            for phi in block.phis():
+                keep = [i for i, b in enumerate(phi.blocks) if b in seen]
+                phi.args = [phi.args[i] for i in keep]
+                phi.blocks = [phi.blocks[i] for i in keep]
+        self.compute_preds()
+        return True
+
+    def simplify_phis(self):
+        """Drop phis whose arguments are all one value (or the phi itself)"""
+        while True:
+            mapping = {}
+            for block in self.blocks:
+                for phi in list(block.phis()):
+                    same = None
+                    for arg in phi.args:
+                        while arg in mapping:
+                            arg = mapping[arg]
+                        if arg is phi or arg is same:
+                            continue
+                        if same is not None:
+                            break
+                        same = arg
+                    else:
+                        if same is None:
+                            same = Const(0.0 if phi.ty == F64 else 0, phi.ty)
+                        mapping[phi] = same
+                        block.instrs.remove(phi)
+            if not mapping:
+                return
+            self.replace_uses(mapping)
+
+    def uses(self):
+        """Number of operand uses of each value"""
+        counts = {}
+        for instr in self.instrs():
+            for a in instr.args:
+                if isinstance(a, Instr):
+                    counts[a] = counts.get(a, 0) + 1
+        return counts
+
+    def size(self):
+        return sum(len(b.instrs) for b in self.blocks)
+
+
+class Module:
+    def __init__(self):
+        self.functions = []
+        self.globals = []         # (name, size, alignment, initial value)
+        self.externs = []
+
+    def function(self, name):
+        for fn in self.functions:
+            if fn.name == name:
+                return fn
+        return None
+
+    def size(self):
+        return sum(fn.size() for fn in self.functions)
+
+
+def format_operand(v):
+    if isinstance(v, Instr):
+        return f"%{v.id}"
+    return repr(v)
+
+
+def format_instr(instr):
+    op = instr.op
+    args = ", ".join(format_operand(a) for a in instr.args)
+    if op == "phi":
+        args = ", ".join(f"[{format_operand(a)}, {b.label}]" for a, b in zip(instr.args, instr.blocks))
+    elif op in ("jmp", "br"):
+        args = ", ".join([args] * bool(args) + [b.label for b in instr.blocks])
+    elif op in ("call", "tailcall"):
+        args = f"{instr.target}({args})"
+    elif op in ("global", "param"):
+        args = str(instr.target)
+    elif op == "str":
+        args = repr(instr.target)
+    elif op == "slot":
+        args = repr(instr.slot)
+
+    name = op
+    if instr.cond:
+        name += f" {instr.cond}"
+    if instr.mem:
+        name += f" {instr.mem}"
+    text = f"{name} {args}".rstrip()
+    if instr.ty is not None:
+        return f"%{instr.id} = {text} : {instr.ty}"
+    return text
+
+
+def format_function(fn):
+    params = ", ".join(f"%{p.id}: {p.ty}" for p in fn.params)
+    lines = [f"fn {fn.name}({params}) -> {fn.ret or 'void'} {{"]
+    for slot in fn.slots:
+        lines.append(f"  {slot!r} = slot {slot.size}, align {slot.align}")
+    for block in fn.blocks:
+        preds = ", ".join(p.label for p in block.preds)
+        lines.append(f"{block.label}:" + (f"  ; preds {preds}" if preds else ""))
+        for instr in block.instrs:
+            lines.append(f"  {format_instr(instr)}")
+    lines.append("}")
+    return "\n".join(lines)
+
+
+def format_module(module):
+    parts = [f"global {name}: {size} align {align} = {init}" for name, size, align, init in module.globals]
+    parts.extend(format_function(fn) for fn in module.functions)
+    return "\n\n".join(parts)
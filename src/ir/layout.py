@@ -0,0 +1,74 @@
+from semantic import is_pointer
+
+# scalars narrower than a register, everything else not a struct takes 8 bytes
+SIZES = {"CHAR": 1, "INT16": 2, "INT32": 4, "VOID": 1}
+
+
+def align_up(offset, align):
+    return (offset + align - 1) // align * align
+
+
+class Struct:
+    """Field offsets, size and alignment of one struct type"""
+
+    __slots__ = ("name", "fields", "size", "align")
+
+    def __init__(self, name, fields, size, align):
+        self.name = name
+        self.fields = fields      # field name -> (offset, type), in memory order
+        self.size = size
+        self.align = align
+
+    def __repr__(self):
+        return f"Struct({self.name}, {self.size} bytes, align {self.align})"
+
+
+class Layouts:
+    """Sizes and alignments of every type, with each struct laid out once when it is defined
+
+    Fields are placed like a C compiler would: each at the next offset
+    that is a multiple of its alignment, the struct aligned like its most
+    aligned field and padded to a multiple of that, so elements of an
+    array of structs stay aligned. A packed struct puts every field right
+    after the previous one and aligns to 1. A reordered one places fields
+    by decreasing alignment, which leaves no padding between them.
+    """
+
+    def __init__(self):
+        self.structs = {}
+
+    def define(self, name, fields, modifiers=()):
+        """Lay out struct name from its (field, type) pairs in declaration order"""
+        packed = "packed" in modifiers
+        if "reorder" in modifiers:
+            # sorted is stable, fields of equal alignment keep their order
+            fields = sorted(fields, key=lambda f: -self.alignof(f[1]))
+        offset = 0
+        align = 1
+        table = {}
+        for field, typ in fields:
+            a = 1 if packed else self.alignof(typ)
+            offset = align_up(offset, a)
+            table[field] = (offset, typ)
+            offset += self.sizeof(typ)
+            align = max(align, a)
+        struct = Struct(name, table, align_up(offset, align), align)
+        self.structs[name] = struct
+        return struct
+
+    def sizeof(self, typ, count=None):
+        if typ in self.structs:
+            size = self.structs[typ].size
+        elif is_pointer(typ):
+            size = 8
+        else:
+            size = SIZES.get(typ, 8)
+        return size * count if count else size
+
+    def alignof(self, typ):
+        if typ in self.structs:
+            return self.structs[typ].align
+        return self.sizeof(typ)
+
+    def field(self, struct, name):
+        return self.structs[struct].fields[name]
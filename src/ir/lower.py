@@ -0,0 +1,686 @@
+from ir.ir import Module, Function, Instr, Const, Slot, I64, F64
+from ir.layout import Layouts
+from optimizer.constfold import fold, convert, wrap
+from semantic import is_scalar, is_pointer, pointee, ASSIGN_OPS, COMPARISONS, LOGICAL
+
+
+class LoweringError(Exception):
+    pass
+
+
+def value_type(t):
+    return F64 if t == "FLOAT" else I64
+
+
+def mem_type(t):
+    if t == "FLOAT":
+        return "f64"
+    return INT_WIDTHS.get(t, "i64")
+
+
+# integer types narrower than a register, and the extension that rebuilds a full value from them
+INT_WIDTHS = {"CHAR": "i8", "INT16": "i16", "INT32": "i32"}
+EXTEND = {"CHAR": "zext", "INT16": "sext", "INT32": "sext"}
+
+
+INT_OPS = {"PLUS": "add", "MINUS": "sub", "MULTIPLY": "mul", "DIVIDE": "div", "MOD": "mod", "POW": "pow"}
+FLOAT_OPS = {"PLUS": "fadd", "MINUS": "fsub", "MULTIPLY": "fmul", "DIVIDE": "fdiv"}
+CONDS = {"EQ": "eq", "NE": "ne", "LT": "lt", "LE": "le", "GT": "gt", "GE": "ge"}
+COMPOUND_OPS = {
+    "PLUS_ASSIGN": "PLUS", "MINUS_ASSIGN": "MINUS",
+    "MULT_ASSIGN": "MULTIPLY", "DIV_ASSIGN": "DIVIDE", "MOD_ASSIGN": "MOD",
+}
+INCDEC = {"PRE_INC": ("add", False), "PRE_DEC": ("sub", False), "POST_INC": ("add", True), "POST_DEC": ("sub", True)}
+
+
+def operand_type(target, src):
+    """Type the right operand of a compound assignment to target counts as"""
+    if is_pointer(target) and not is_pointer(src):
+        return src
+    return target
+
+
+class Lowering:
+    """Lowers an analyzed AST to SSA form, one Function per FUNCTION node
+
+    Scalar locals whose address is never taken become SSA values directly,
+    phis are placed while lowering (Braun et al., "Simple and Efficient
+    Construction of Static Single Assignment Form"). Everything else lives
+    in a stack Slot and is reached through load and store.
+    """
+
+    def __init__(self, ast):
+        # expects an analyzed tree, types come from node.ty and names from node.sym
+        self.ast = ast
+        self.module = Module()
+        self.layouts = Layouts()
+        self.fn = None
+        self.block = None
+        self.slots = {}
+        self.promoted = set()
+        self.defs = {}
+        self.sealed = set()
+        self.incomplete = {}
+        self.forward = {}
+        self.loops = []
+        self.ret_type = None
+
+        self.stmt_handlers = {
+            "STRUCT_DEF": self.lower_nothing,
+            "INCLUDE": self.lower_nothing,
+            "EXTERN": self.lower_nothing,
+            "VAR_DECL": self.lower_var_decl,
+            "RETURN": self.lower_return,
+            "IF": self.lower_if,
+            "WHILE": self.lower_while,
+            "FOR": self.lower_for,
+            "UNSAFE_BLOCK": self.lower_unsafe,
+            "BREAK": self.lower_break,
+            "CONTINUE": self.lower_continue,
+        }
+        self.expr_handlers = {
+            "NUMBER": self.lower_number,
+            "CHAR_LIT": self.lower_number,
+            "STRING": self.lower_string,
+            "IDENTIFIER": self.lower_identifier,
+            "BIN_OP": self.lower_bin_op,
+            "UNARY_MINUS": self.lower_unary_minus,
+            "NOT": self.lower_not,
+            "DEREF": self.lower_load,
+            "ARRAY_INDEX": self.lower_load,
+            "FIELD_ACCESS": self.lower_load,
+            "PTR_FIELD_ACCESS": self.lower_load,
+            "ADDROF": self.lower_addrof,
+            "PRE_INC": self.lower_incdec,
+            "PRE_DEC": self.lower_incdec,
+            "POST_INC": self.lower_incdec,
+            "POST_DEC": self.lower_incdec,
+            "CALL": self.lower_call,
+        }
+
+    def run(self):
+        for node in self.ast.children:
+            if node.type == "STRUCT_DEF":
+                self.define_struct(node)
+            elif node.type == "VAR_DECL":
+                self.lower_global(node)
+            elif node.type == "EXTERN":
+                self.module.externs.append(node.value)
+        for node in self.ast.children:
+            if node.type == "FUNCTION":
+                self.module.functions.append(self.lower_function(node))
+        return self.module
+
+    # types and layout
+
+    def define_struct(self, node):
+        fields = [(f.value, f.children[0].value) for f in node.children if f.type == "FIELD"]
+        modifiers = [m.value for m in node.children if m.type == "LAYOUT"]
+        self.layouts.define(node.value, fields, modifiers)
+
+    def sizeof(self, typ, count=None):
+        return self.layouts.sizeof(typ, count)
+
+    def field(self, struct, name):
+        return self.layouts.field(struct, name)
+
+    def lower_global(self, node):
+        typ = node.children[0].value
+        size = self.sizeof(typ, node.sym.array_size)
+        init = 0
+        if len(node.children) > 1:
+            # data is written before the program runs, so the value is needed at every -O level
+            init = self.constant(node.children[1])
+            init = None if init is None else convert(init, typ)
+            if init is None:
+                raise LoweringError(f"Global '{node.value}' needs a constant initializer (line {node.line})")
+        self.module.globals.append((node.value, size, self.layouts.alignof(typ), init))
+
+    def constant(self, node):
+        """Value of a constant expression, None when it needs the program to run"""
+        t = node.type
+        if t in ("NUMBER", "CHAR_LIT"):
+            return node.value
+        args = [self.constant(child) for child in node.children]
+        if t not in ("UNARY_MINUS", "NOT", "BIN_OP") or None in args:
+            return None
+        if t == "UNARY_MINUS":
+            return -args[0] if isinstance(args[0], float) else wrap(-args[0])
+        if t == "NOT":
+            return int(args[0] == 0)
+        if node.value in ASSIGN_OPS:
+            return None
+        return fold(node.value, *args)
+
+    # SSA construction
+
+    def write_var(self, sym, block, value):
+        self.defs.setdefault(sym, {})[block] = value
+
+    def read_var(self, sym, block):
+        value = self.defs.get(sym, {}).get(block)
+        if value is not None:
+            return self.resolve(value)
+        return self.read_var_recursive(sym, block)
+
+    def read_var_recursive(self, sym, block):
+        ty = value_type(sym.type)
+        if block not in self.sealed:
+            # more predecessors are coming, fill the phi in when the block is sealed
+            value = self.new_phi(block, ty)
+            self.incomplete.setdefault(block, {})[sym] = value
+        elif len(block.preds) == 1:
+            value = self.read_var(sym, block.preds[0])
+        elif not block.preds:
+            # read before any write, or in unreachable code
+            value = Const(0.0 if ty == F64 else 0, ty)
+        else:
+            phi = self.new_phi(block, ty)
+            self.write_var(sym, block, phi)
+            value = self.add_phi_operands(sym, phi)
+        self.write_var(sym, block, value)
+        return value
+
+    def new_phi(self, block, ty):
+        phi = self.fn.number(Instr("phi", ty=ty))
+        phi.block = block
+        n = 0
+        while n < len(block.instrs) and block.instrs[n].op == "phi":
+            n += 1
+        block.instrs.insert(n, phi)
+        return phi
+
+    def add_phi_operands(self, sym, phi):
+        for pred in phi.block.preds:
+            phi.args.append(self.read_var(sym, pred))
+            phi.blocks.append(pred)
+        return self.try_remove_trivial_phi(phi)
+
+    def try_remove_trivial_phi(self, phi):
+        same = None
+        for arg in phi.args:
+            arg = self.resolve(arg)
+            if arg is same or arg is phi:
+                continue
+            if same is not None:
+                return phi
+            same = arg
+        if same is None:
+            same = Const(0.0 if phi.ty == F64 else 0, phi.ty)
+        # uses are rewritten once the function is complete
+        self.forward[phi] = same
+        phi.block.instrs.remove(phi)
+        return same
+
+    def resolve(self, value):
+        while value in self.forward:
+            value = self.forward[value]
+        return value
+
+    def seal(self, block):
+        for sym, phi in self.incomplete.pop(block, {}).items():
+            self.add_phi_operands(sym, phi)
+        self.sealed.add(block)
+
+    def new_block(self, name="b", seal=False):
+        block = self.fn.new_block(name)
+        if seal:
+            self.sealed.add(block)
+        return block
+
+    # emission
+
+    def emit(self, op, args=(), ty=None, **attrs):
+        if self.block is None:
+            # code after ret, break or continue, dropped with the unreachable blocks
+            self.block = self.new_block("dead", seal=True)
+        instr = self.fn.number(Instr(op, args, ty, **attrs))
+        instr.block = self.block
+        self.block.instrs.append(instr)
+        return instr
+
+    def jump(self, target):
+        if self.block is not None:
+            self.emit("jmp", blocks=[target])
+            target.preds.append(self.block)
+        self.block = None
+
+    def branch(self, cond, then, els):
+        if self.block is None:
+            self.block = self.new_block("dead", seal=True)
+        self.emit("br", [cond], blocks=[then, els])
+        then.preds.append(self.block)
+        els.preds.append(self.block)
+        self.block = None
+
+    # functions and statements
+
+    def lower_function(self, node):
+        self.fn = Function(node.sym.target, None if node.sym.type == "VOID" else value_type(node.sym.type))
+        self.ret_type = node.sym.type
+        self.slots = {}
+        self.defs = {}
+        self.sealed = set()
+        self.incomplete = {}
+        self.forward = {}
+        self.promoted = self.find_promoted(node)
+        self.block = self.new_block("entry", seal=True)
+
+        for i, param in enumerate(node.children[1].children):
+            typ = param.sym.type
+            value = self.fn.number(Instr("param", ty=value_type(typ), target=i))
+            value.block = self.block
+            self.block.instrs.append(value)
+            self.fn.params.append(value)
+            self.declare(param.sym)
+            # a narrow parameter keeps only its low bytes
+            self.assign(param.sym, value, "INT" if typ in INT_WIDTHS else typ)
+
+        for stmt in node.children[2].children:
+            self.stmt(stmt)
+
+        if self.block is not None:
+            # falling off the end returns zero
+            if self.fn.ret is None:
+                self.emit("ret")
+            else:
+                self.emit("ret", [Const(0.0 if self.fn.ret == F64 else 0, self.fn.ret)])
+            self.block = None
+
+        fn = self.fn
+        fn.replace_uses(self.forward)
+        fn.remove_unreachable()
+        fn.simplify_phis()
+        return fn
+
+    def find_promoted(self, fn):
+        """Scalar parameters and locals that are never address-taken become SSA values"""
+        decls = [p.sym for p in fn.children[1].children]
+        taken = set()
+        stack = [fn.children[2]]
+        while stack:
+            node = stack.pop()
+            if node.type == "VAR_DECL":
+                decls.append(node.sym)
+            elif node.type == "ADDROF" and node.children[0].type == "IDENTIFIER":
+                taken.add(node.children[0].sym)
+            stack.extend(c for c in node.children if c is not None)
+        return {s for s in decls if s not in taken and s.array_size is None and is_scalar(s.type)}
+
+    def declare(self, sym):
+        if sym not in self.promoted and sym not in self.slots:
+            typ = pointee(sym.type) if sym.array_size else sym.type
+            size = self.sizeof(typ, sym.array_size)
+            slot = Slot(f"{sym.name}.{len(self.fn.slots)}", size, self.layouts.alignof(typ))
+            self.fn.slots.append(slot)
+            self.slots[sym] = slot
+
+    def stmt(self, node):
+        handler = self.stmt_handlers.get(node.type)
+        if handler is not None:
+            handler(node)
+        else:
+            self.value(node)
+
+    def lower_nothing(self, node):
+        return
+
+    def lower_var_decl(self, node):
+        self.declare(node.sym)
+        if len(node.children) > 1:
+            init = node.children[1]
+            self.assign(node.sym, self.value(init), init.ty)
+
+    def lower_return(self, node):
+        if node.children:
+            value = node.children[0]
+            result = self.convert(self.value(value), value.ty, self.ret_type)
+            if self.ret_type in INT_WIDTHS and value.ty != self.ret_type:
+                result = self.extend(result, self.ret_type)
+            self.emit("ret", [result])
+        else:
+            self.emit("ret")
+        self.block = None
+
+    def lower_unsafe(self, node):
+        for stmt in node.children:
+            self.stmt(stmt)
+
+    def lower_break(self, node):
+        self.jump(self.loops[-1][1])
+
+    def lower_continue(self, node):
+        self.jump(self.loops[-1][0])
+
+    def lower_if(self, node):
+        cond, then, els = node.children
+        then_block = self.new_block("then")
+        else_block = self.new_block("else")
+        end = self.new_block("endif")
+
+        self.branch_on(cond, then_block, else_block)
+        self.seal(then_block)
+        self.seal(else_block)
+
+        self.block = then_block
+        for stmt in then.children:
+            self.stmt(stmt)
+        self.jump(end)
+
+        self.block = else_block
+        for stmt in els.children:
+            self.stmt(stmt)
+        self.jump(end)
+
+        self.seal(end)
+        self.block = end
+
+    def lower_loop(self, cond, body, step=None):
+        head = self.new_block("loop")
+        body_block = self.new_block("body")
+        latch = self.new_block("step") if step is not None else head
+        end = self.new_block("endloop")
+
+        self.jump(head)
+        self.block = head
+        if cond is not None:
+            self.branch_on(cond, body_block, end)
+        else:
+            self.jump(body_block)
+        self.seal(body_block)
+
+        self.block = body_block
+        self.loops.append((latch, end))
+        for stmt in body.children:
+            self.stmt(stmt)
+        self.loops.pop()
+        self.jump(latch)
+
+        if step is not None:
+            # continue lands here, so the step runs on every iteration
+            self.seal(latch)
+            self.block = latch
+            self.value(step)
+            self.jump(head)
+
+        self.seal(head)
+        self.seal(end)
+        self.block = end
+
+    def lower_while(self, node):
+        self.lower_loop(node.children[0], node.children[1])
+
+    def lower_for(self, node):
+        init, cond, step, body = node.children
+        if init is not None:
+            self.value(init)
+        if step is None:
+            self.lower_loop(cond, body)
+        else:
+            self.lower_loop(cond, body, step)
+
+    def branch_on(self, node, then, els):
+        """Branch on the truth of node, && || and ! jump straight to the targets"""
+        if node.type == "NOT":
+            self.branch_on(node.children[0], els, then)
+        elif node.type == "BIN_OP" and node.value in LOGICAL:
+            # the right operand only runs when the left one did not decide
+            rhs = self.new_block("rhs")
+            if node.value == "AND":
+                self.branch_on(node.children[0], rhs, els)
+            else:
+                self.branch_on(node.children[0], then, rhs)
+            self.seal(rhs)
+            self.block = rhs
+            self.branch_on(node.children[1], then, els)
+        else:
+            self.branch(self.condition(node), then, els)
+
+    def condition(self, node):
+        value = self.value(node)
+        if node.ty == "FLOAT":
+            return self.emit("fcmp", [value, Const(0.0, F64)], I64, cond="ne")
+        return value
+
+    # variables
+
+    def assign(self, sym, value, src_type):
+        """Store value of AST type src_type into a local or global, returns the stored value"""
+        typ = sym.type
+        value = self.convert(value, src_type, typ)
+        if sym in self.promoted:
+            if typ in INT_WIDTHS and src_type != typ:
+                # a narrow register holds the extended low bytes, like a narrow slot would
+                value = self.extend(value, typ)
+            self.write_var(sym, self.block_for_write(), value)
+        else:
+            self.emit("store", [self.var_address(sym), value], mem=mem_type(typ))
+        return value
+
+    def block_for_write(self):
+        if self.block is None:
+            self.block = self.new_block("dead", seal=True)
+        return self.block
+
+    def read(self, sym):
+        if sym in self.promoted:
+            return self.read_var(sym, self.block_for_write())
+        if sym.array_size:
+            # arrays decay to the address of their first element
+            return self.var_address(sym)
+        if not is_scalar(sym.type):
+            raise LoweringError(f"Struct value '{sym.name}' can only be used through its fields")
+        return self.emit("load", [self.var_address(sym)], value_type(sym.type), mem=mem_type(sym.type))
+
+    def extend(self, value, typ):
+        return self.emit(EXTEND[typ], [value], I64, mem=INT_WIDTHS[typ])
+
+    def var_address(self, sym):
+        if sym.kind == "global":
+            return self.emit("global", ty=I64, target=sym.name)
+        return self.emit("slot", ty=I64, slot=self.slots[sym])
+
+    def convert(self, value, src, dst):
+        if dst == "FLOAT" and src != "FLOAT":
+            if isinstance(value, Const):
+                return Const(float(value.value), F64)
+            return self.emit("itof", [value], F64)
+        if src == "FLOAT" and dst != "FLOAT" and dst != "VOID":
+            return self.emit("ftoi", [value], I64)
+        return value
+
+    # expressions
+
+    def value(self, node):
+        handler = self.expr_handlers.get(node.type)
+        if handler is None:
+            raise LoweringError(f"Unsupported expression {node.type} (line {node.line})")
+        return handler(node)
+
+    def lower_number(self, node):
+        if isinstance(node.value, float):
+            return Const(node.value, F64)
+        return Const(node.value, I64)
+
+    def lower_string(self, node):
+        return self.emit("str", ty=I64, target=node.value)
+
+    def lower_identifier(self, node):
+        return self.read(node.sym)
+
+    def address(self, node):
+        """Address of an lvalue, returns the address and the AST type stored there"""
+        t = node.type
+        if t == "IDENTIFIER":
+            return self.var_address(node.sym), node.sym.type
+        if t == "DEREF":
+            return self.value(node.children[0]), node.ty
+        if t == "ARRAY_INDEX":
+            base, index = node.children
+            return self.emit("add", [self.value(base), self.scaled(self.value(index), base.ty)], I64), node.ty
+        if t == "FIELD_ACCESS":
+            base = node.children[0]
+            addr, struct = self.address(base)
+            offset, typ = self.field(struct, node.value)
+            return self.offset(addr, offset), typ
+        if t == "PTR_FIELD_ACCESS":
+            base = node.children[0]
+            offset, typ = self.field(pointee(base.ty), node.value)
+            return self.offset(self.value(base), offset), typ
+        raise LoweringError(f"Expression is not assignable (line {node.line})")
+
+    def scaled(self, index, ptr_type):
+        """index in elements of ptr_type's pointee as a byte offset"""
+        size = self.sizeof(pointee(ptr_type))
+        if size == 1:
+            return index
+        if isinstance(index, Const):
+            return Const(index.value * size)
+        return self.emit("mul", [index, Const(size)], I64)
+
+    def offset(self, addr, offset):
+        if offset == 0:
+            return addr
+        return self.emit("add", [addr, Const(offset)], I64)
+
+    def lower_load(self, node):
+        addr, typ = self.address(node)
+        if not is_scalar(typ):
+            raise LoweringError(f"Struct value of type {typ} can only be used through its fields (line {node.line})")
+        return self.emit("load", [addr], value_type(typ), mem=mem_type(typ))
+
+    def lower_addrof(self, node):
+        return self.address(node.children[0])[0]
+
+    def lower_unary_minus(self, node):
+        value = self.value(node.children[0])
+        if node.ty == "FLOAT":
+            return self.emit("fneg", [value], F64)
+        return self.emit("neg", [value], I64)
+
+    def lower_not(self, node):
+        value = self.value(node.children[0])
+        if node.children[0].ty == "FLOAT":
+            return self.emit("fcmp", [value, Const(0.0, F64)], I64, cond="eq")
+        return self.emit("cmp", [value, Const(0)], I64, cond="eq")
+
+    def lower_logical(self, node):
+        yes = self.new_block("true")
+        no = self.new_block("false")
+        end = self.new_block("join")
+        self.branch_on(node, yes, no)
+        self.seal(yes)
+        self.seal(no)
+        self.block = yes
+        self.jump(end)
+        self.block = no
+        self.jump(end)
+        self.seal(end)
+        self.block = end
+        # the result is 1 or 0 depending on the way in
+        phi = self.new_phi(end, I64)
+        phi.args = [Const(1), Const(0)]
+        phi.blocks = [yes, no]
+        return phi
+
+    def lower_bin_op(self, node):
+        op = node.value
+        if op in ASSIGN_OPS:
+            return self.lower_assign(node)
+        if op in LOGICAL:
+            return self.lower_logical(node)
+
+        left, right = node.children
+        a = self.value(left)
+        b = self.value(right)
+        return self.arith(op, a, left.ty, b, right.ty, node)
+
+    def arith(self, op, a, lt, b, rt, node):
+        if op in COMPARISONS:
+            if lt == "FLOAT" or rt == "FLOAT":
+                a = self.convert(a, lt, "FLOAT")
+                b = self.convert(b, rt, "FLOAT")
+                return self.emit("fcmp", [a, b], I64, cond=CONDS[op])
+            return self.emit("cmp", [a, b], I64, cond=CONDS[op])
+
+        if lt == "FLOAT" or rt == "FLOAT":
+            if op not in FLOAT_OPS:
+                raise LoweringError(f"Unsupported float operator {op} (line {node.line})")
+            a = self.convert(a, lt, "FLOAT")
+            b = self.convert(b, rt, "FLOAT")
+            return self.emit(FLOAT_OPS[op], [a, b], F64)
+
+        if op not in INT_OPS:
+            raise LoweringError(f"Unsupported operator {op} (line {node.line})")
+        # pointer arithmetic counts elements
+        if is_pointer(lt) and is_pointer(rt):
+            return self.elements(self.emit("sub", [a, b], I64), lt)
+        if is_pointer(lt):
+            b = self.scaled(b, lt)
+        elif is_pointer(rt):
+            a = self.scaled(a, rt)
+        return self.emit(INT_OPS[op], [a, b], I64)
+
+    def elements(self, diff, ptr_type):
+        """Byte distance between two pointers as a count of their elements"""
+        size = self.sizeof(pointee(ptr_type))
+        if size == 1:
+            return diff
+        if size & (size - 1) == 0:
+            # pointers into one array are a whole number of elements apart, a shift divides exactly
+            return self.emit("sar", [diff, Const(size.bit_length() - 1)], I64)
+        return self.emit("div", [diff, Const(size)], I64)
+
+    def lower_assign(self, node):
+        op = node.value
+        lhs, rhs = node.children
+        typ = lhs.ty
+
+        if lhs.type == "IDENTIFIER" and lhs.sym in self.promoted:
+            value = self.value(rhs)
+            src = rhs.ty
+            if op != "ASSIGN":
+                value = self.convert(value, src, typ)
+                current = self.read(lhs.sym)
+                value = self.arith(COMPOUND_OPS[op], current, typ, value, operand_type(typ, src), node)
+                src = "FLOAT" if typ == "FLOAT" else "INT"
+            return self.assign(lhs.sym, value, src)
+
+        # the target address is computed before the right-hand side
+        addr, typ = self.address(lhs)
+        value = self.convert(self.value(rhs), rhs.ty, typ)
+        if op != "ASSIGN":
+            current = self.emit("load", [addr], value_type(typ), mem=mem_type(typ))
+            value = self.arith(COMPOUND_OPS[op], current, typ, value, operand_type(typ, rhs.ty), node)
+        self.emit("store", [addr, value], mem=mem_type(typ))
+        return value
+
+    def lower_incdec(self, node):
+        op, post = INCDEC[node.type]
+        target = node.children[0]
+        typ = target.ty
+
+        # a pointer steps by one element
+        step = Const(self.sizeof(pointee(typ)) if is_pointer(typ) else 1)
+        if target.type == "IDENTIFIER" and target.sym in self.promoted:
+            old = self.read(target.sym)
+            new = self.assign(target.sym, self.emit(op, [old, step], I64), "INT")
+            return old if post else new
+
+        addr, typ = self.address(target)
+        old = self.emit("load", [addr], I64, mem=mem_type(typ))
+        new = self.emit(op, [old, step], I64)
+        self.emit("store", [addr, new], mem=mem_type(typ))
+        if post:
+            return old
+        if typ in INT_WIDTHS:
+            return self.extend(new, typ)
+        return new
+
+    def lower_call(self, node):
+        sym = node.sym
+        # user functions take arguments converted to the declared parameter types
+        params = sym.params if sym.kind == "function" else [arg.ty for arg in node.children]
+        args = [self.convert(self.value(arg), arg.ty, typ) for arg, typ in zip(node.children, params)]
+        ty = None if sym.type == "VOID" else value_type(sym.type)
+        return self.emit("call", args, ty, target=sym.target)
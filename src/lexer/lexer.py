@@ -1,7 +1,30 @@
+import re
+import sys
+
+# source positions are packed into one int, line in the high bits
+COL_BITS = 16
+COL_MASK = (1 << COL_BITS) - 1
+
+
+def pack_pos(line, col):
+    return line << COL_BITS | min(col, COL_MASK)
+
+
 class Token:
-    def __init__(self, type_, value=None):
+    __slots__ = ("type", "value", "pos")
+
+    def __init__(self, type_, value=None, pos=0):
         self.type = type_
         self.value = value
+        self.pos = pos
+
+    @property
+    def line(self):
+        return self.pos >> COL_BITS
+
+    @property
+    def col(self):
+        return self.pos & COL_MASK
 
     def __repr__(self):
         return f"{self.type}" if self.value is None else f"({self.type}, {self.value})"
@@ -158,4 +181,164 @@ class Lexer:
             else:
                 tokens.append(self.lex_operator_or_symbol())
         tokens.append(Token("EOF"))
-        return tokens
\ No newline at end of file
+        return tokens
+
+
+class TableLexer(Lexer):
+    """Single-pass lexer driven by one compiled master pattern"""
+
+    OP_TYPES = {"->": "ARROW", **Lexer.OPERATORS, **Lexer.SYMBOLS}
+    KEYWORD_TYPES = {word: sys.intern(word.upper()) for word in Lexer.KEYWORDS}
+
+    PATTERN = re.compile(
+        r"(?P<ws>\s+)"
+        r"|(?P<word>[^\W\d]\w*)"
+        r"|(?P<comment>//[^\n]*|/\*[\s\S]*?(?:\*/|\Z))"
+        r"|(?P<op>" + "|".join(re.escape(op) for op in sorted(OP_TYPES, key=len, reverse=True)) + r")"
+        r"|(?P<number>\d[\d.]*)"
+        r'|(?P<string>"(?P<body>(?:[^"\\]|\\[\s\S])*)(?:"|\Z))'
+        r"|(?P<char>'[\s\S]')"
+    )
+    ESCAPE = re.compile(r"\\([\s\S])")
+    ESCAPES = {"n": "\n", "t": "    "}
+
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, text="", reader=None, chunk_size=CHUNK_SIZE):
+        super().__init__(text)
+        self.reader = reader
+        self.chunk_size = chunk_size
+
+    def unescape(self, m):
+        ch = m.group(1)
+        return self.ESCAPES.get(ch, ch)
+
+    def lex_fallback(self):
+        # anything the pattern rejects (malformed literals, stray or exotic
+        # characters) goes through the reference lexer so both engines
+        # agree on results and errors
+        ch = self.current_char()
+        if ch.isdigit():
+            return self.lex_number()
+        if ch == '"':
+            return self.lex_string()
+        if ch == "'":
+            return self.lex_char()
+        if ch.isalpha() or ch == '_':
+            return self.lex_identifier_or_keyword()
+        return self.lex_operator_or_symbol()
+
+    def tokenize(self):
+        return list(self.stream())
+
+    def stream(self):
+        """Yield tokens lazily, pulling source chunks from the reader as needed"""
+        text = self.text
+        end = len(text)
+        match = self.PATTERN.match
+        keywords = self.KEYWORD_TYPES
+        op_types = self.OP_TYPES
+        pos = 0
+        line = 1
+        line_pos = line << COL_BITS
+        line_start = 0
+        eof = self.reader is None
+        refill = not eof
+
+        while True:
+            if refill:
+                chunk = self.reader.read(self.chunk_size)
+                eof = not chunk
+                text = text[pos:] + chunk
+                end = len(text)
+                line_start -= pos
+                pos = 0
+                refill = False
+
+            if pos >= end:
+                if eof:
+                    break
+                refill = True
+                continue
+
+            m = match(text, pos)
+            if not eof and (m is None or m.end() == end):
+                # the token may continue in the next chunk
+                refill = True
+                continue
+
+            start = pos
+            tok_pos = line_pos | min(start - line_start + 1, COL_MASK)
+
+            if m is not None:
+                kind = m.lastgroup
+
+                if kind == "ws" or kind == "comment":
+                    pos = m.end()
+                    nl = text.count("\n", start, pos)
+                    if nl:
+                        line += nl
+                        line_pos = line << COL_BITS
+                        line_start = text.rfind("\n", start, pos) + 1
+                    continue
+                if kind == "word":
+                    word = m.group()
+                    if word in keywords:
+                        pos = m.end()
+                        yield Token(keywords[word], None, tok_pos)
+                        continue
+                    if word[0] < "\x80" or word[0].isalpha():
+                        pos = m.end()
+                        yield Token("IDENTIFIER", sys.intern(word), tok_pos)
+                        continue
+                elif kind == "op":
+                    pos = m.end()
+                    yield Token(op_types[m.group()], None, tok_pos)
+                    continue
+                elif kind == "number":
+                    # digits outside the decimal class take the slow path
+                    if m.end() == end or not text[m.end()].isdigit():
+                        pos = m.end()
+                        val = m.group()
+                        yield Token("NUMBER", float(val) if "." in val else int(val), tok_pos)
+                        continue
+                elif kind == "string" or kind == "char":
+                    pos = m.end()
+                    if kind == "string":
+                        body = m.group("body")
+                        if "\\" in body:
+                            body = self.ESCAPE.sub(self.unescape, body)
+                        yield Token("STRING", body, tok_pos)
+                    else:
+                        yield Token("CHAR_LIT", ord(text[start + 1]), tok_pos)
+                    nl = text.count("\n", start, pos)
+                    if nl:
+                        line += nl
+                        line_pos = line << COL_BITS
+                        line_start = text.rfind("\n", start, pos) + 1
+                    continue
+
+            if not eof:
+                # the reference methods scan freely, hand them the rest of the input
+                text = text[pos:] + self.reader.read()
+                end = len(text)
+                line_start -= pos
+                start = pos = 0
+                eof = True
+
+            self.text = text
+            self.pos = pos
+            self.ln = line
+            tok = self.lex_fallback()
+            tok.pos = tok_pos
+            yield tok
+            pos = self.pos
+            nl = text.count("\n", start, pos)
+            if nl:
+                line += nl
+                line_pos = line << COL_BITS
+                line_start = text.rfind("\n", start, pos) + 1
+
+        self.text = text
+        self.pos = pos
+        yield Token("EOF", None, line_pos | min(pos - line_start + 1, COL_MASK))
@@ -0,0 +1,267 @@
+import math
+import operator
+from parser.parser import ASTNode
+from semantic import ASSIGN_OPS, COMPARISONS
+
+INT_MIN = -(1 << 63)
+
+# locals whose stored value is known exactly
+PROPAGATED_TYPES = ("INT", "INT16", "INT32", "INT64", "CHAR", "FLOAT")
+# signed types narrower than a register
+NARROW_BITS = {"INT16": 16, "INT32": 32}
+
+COMPARE = {
+    "EQ": operator.eq, "NE": operator.ne,
+    "LT": operator.lt, "LE": operator.le,
+    "GT": operator.gt, "GE": operator.ge,
+}
+FLOAT_OPS = {
+    "PLUS": operator.add, "MINUS": operator.sub,
+    "MULTIPLY": operator.mul, "DIVIDE": operator.truediv,
+}
+
+
+def wrap(value):
+    """Wrap an integer to a signed 64-bit register value"""
+    return (value - INT_MIN) % (1 << 64) + INT_MIN
+
+
+def truncdiv(a, b):
+    # idiv rounds toward zero, python floors
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
+def fold_int(op, a, b):
+    if op == "PLUS":
+        return wrap(a + b)
+    if op == "MINUS":
+        return wrap(a - b)
+    if op == "MULTIPLY":
+        return wrap(a * b)
+    if op in ("DIVIDE", "MOD"):
+        # leave the runtime fault in place
+        if b == 0 or (a == INT_MIN and b == -1):
+            return None
+        q = truncdiv(a, b)
+        return q if op == "DIVIDE" else a - b * q
+    if op == "POW":
+        if b < 0:
+            return None
+        return wrap(pow(a, b, 1 << 64))
+    return None
+
+
+def fold_float(op, a, b):
+    if op not in FLOAT_OPS or (op == "DIVIDE" and b == 0.0):
+        return None
+    value = FLOAT_OPS[op](a, b)
+    return value if math.isfinite(value) else None
+
+
+def fold(op, a, b):
+    if op == "AND":
+        return int(bool(a) and bool(b))
+    if op == "OR":
+        return int(bool(a) or bool(b))
+    if isinstance(a, float) or isinstance(b, float):
+        a, b = float(a), float(b)
+        if op in COMPARISONS:
+            return int(COMPARE[op](a, b))
+        return fold_float(op, a, b)
+    if op in COMPARISONS:
+        return int(COMPARE[op](a, b))
+    return fold_int(op, a, b)
+
+
+def convert(value, typ):
+    """The value a local of type typ holds after storing value, or None if unknown"""
+    if typ == "FLOAT":
+        return float(value)
+    if isinstance(value, float):
+        # cvttsd2si truncates, out of range values are not folded
+        if abs(value) >= 2.0 ** 63:
+            return None
+        value = int(value)
+    if typ == "CHAR":
+        return value & 0xFF
+    if typ in NARROW_BITS:
+        bits = NARROW_BITS[typ]
+        value &= (1 << bits) - 1
+        return value - (1 << bits) if value >> (bits - 1) else value
+    return wrap(value)
+
+
+class ConstantFolder:
+    """Folds constant expressions, propagates constant locals and prunes decided branches"""
+
+    def __init__(self, ast):
+        # expects an analyzed tree, locals are tracked through their symbols
+        self.ast = ast
+        self.consts = {}
+        self.written = set()
+        self.folded = 0
+        self.propagated = 0
+        self.pruned = 0
+
+    def run(self):
+        for node in self.ast.children:
+            if node.type == "FUNCTION":
+                body = node.children[2]
+                self.written = self.find_writes(body)
+                self.consts = {}
+                body.children = self.block(body.children)
+            elif node.type == "VAR_DECL" and len(node.children) > 1:
+                node.children[1] = self.expr(node.children[1])
+        return self.ast
+
+    def find_writes(self, body):
+        written = set()
+        for node in self.walk(body):
+            if node.type == "BIN_OP" and node.value in ASSIGN_OPS:
+                target = node.children[0]
+            elif node.type in ("PRE_INC", "PRE_DEC", "POST_INC", "POST_DEC", "ADDROF"):
+                target = node.children[0]
+            else:
+                continue
+            if target.type == "IDENTIFIER":
+                written.add(target.sym)
+        return written
+
+    def walk(self, node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(c for c in node.children if c is not None)
+
+    def block(self, stmts):
+        out = []
+        for stmt in stmts:
+            self.stmt(stmt, out)
+        return out
+
+    def stmt(self, node, out):
+        t = node.type
+        if t == "VAR_DECL":
+            if len(node.children) > 1:
+                init = node.children[1] = self.expr(node.children[1])
+                sym = node.sym
+                if (init.type == "NUMBER" and sym not in self.written
+                        and sym.array_size is None and sym.type in PROPAGATED_TYPES):
+                    value = convert(init.value, sym.type)
+                    if value is not None:
+                        self.consts[sym] = value
+        elif t == "IF":
+            cond, then, els = node.children
+            known = self.truth(node.children, 0)
+            if known is not None:
+                # keep only the taken arm, spliced into the enclosing block
+                self.pruned += 1
+                out.extend(self.block((then if known else els).children))
+                return
+            then.children = self.block(then.children)
+            els.children = self.block(els.children)
+        elif t == "WHILE":
+            known = self.truth(node.children, 0)
+            if known is False:
+                self.pruned += 1
+                return
+            if known:
+                # an always-true loop needs no test
+                self.pruned += 1
+                node.children[0] = None
+            body = node.children[1]
+            body.children = self.block(body.children)
+        elif t == "FOR":
+            init, cond, step, body = node.children
+            if init is not None:
+                init = node.children[0] = self.expr(init)
+            if cond is not None:
+                known = self.truth(node.children, 1)
+                if known is False:
+                    self.pruned += 1
+                    if init is not None:
+                        out.append(init)
+                    return
+                if known:
+                    self.pruned += 1
+                    node.children[1] = None
+            if step is not None:
+                node.children[2] = self.expr(step)
+            body.children = self.block(body.children)
+        elif t == "RETURN":
+            if node.children:
+                node.children[0] = self.expr(node.children[0])
+        elif t == "UNSAFE_BLOCK":
+            node.children = self.block(node.children)
+        elif t not in ("BREAK", "CONTINUE", "STRUCT_DEF", "INCLUDE", "EXTERN"):
+            node = self.expr(node)
+            if node.type == "NUMBER":
+                # a constant expression statement has no effect
+                return
+        out.append(node)
+
+    def truth(self, children, i):
+        """Fold children[i] in place and return its truth value if it is constant"""
+        children[i] = self.expr(children[i])
+        value = self.constant(children[i])
+        if value is None:
+            return None
+        return value != 0
+
+    def constant(self, node):
+        if node.type in ("NUMBER", "CHAR_LIT"):
+            return node.value
+        return None
+
+    def number(self, value, node):
+        result = ASTNode("NUMBER", value, pos=node.pos)
+        result.ty = node.ty
+        return result
+
+    def expr(self, node):
+        children = node.children
+        for i, child in enumerate(children):
+            if child is not None:
+                children[i] = self.expr(child)
+
+        t = node.type
+        if t == "IDENTIFIER":
+            value = self.consts.get(node.sym)
+            if value is not None:
+                self.propagated += 1
+                return self.number(value, node)
+        elif t == "UNARY_MINUS":
+            value = self.constant(children[0])
+            if value is not None:
+                self.folded += 1
+                return self.number(-value if isinstance(value, float) else wrap(-value), node)
+        elif t == "NOT":
+            value = self.constant(children[0])
+            if value is not None:
+                self.folded += 1
+                return self.number(int(value == 0), node)
+        elif t == "BIN_OP" and node.value in ("AND", "OR"):
+            a = self.constant(children[0])
+            # a deciding left operand drops the right one, it would never run
+            if a is not None and bool(a) == (node.value == "OR"):
+                self.folded += 1
+                return self.number(int(bool(a)), node)
+            b = self.constant(children[1])
+            if a is not None and b is not None:
+                self.folded += 1
+                return self.number(fold(node.value, a, b), node)
+        elif t == "BIN_OP" and node.value not in ASSIGN_OPS:
+            a = self.constant(children[0])
+            b = self.constant(children[1])
+            if a is not None and b is not None:
+                value = fold(node.value, a, b)
+                if value is not None:
+                    self.folded += 1
+                    return self.number(value, node)
+        return node
+
+    def report(self):
+        return (f"constfold: folded {self.folded} expressions, propagated {self.propagated} constants, "
+                f"pruned {self.pruned} branches")
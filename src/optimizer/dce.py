@@ -0,0 +1,64 @@
+from parser.parser import ASTNode
+
+
+class DeadCodeEliminator:
+    """Drops functions and globals that are unreachable from main"""
+
+    def __init__(self, ast):
+        # expects an analyzed tree, calls and globals are matched through their symbols
+        self.ast = ast
+        self.removed_functions = []
+        self.removed_globals = []
+        self.total_functions = 0
+        self.total_globals = 0
+
+    def run(self):
+        functions = {}
+        for node in self.ast.children:
+            if node.type == "FUNCTION":
+                functions.setdefault(node.sym.target, []).append(node)
+
+        live_functions = set()
+        live_globals = set()
+        work = ["main"]
+        while work:
+            name = work.pop()
+            if name in live_functions:
+                continue
+            live_functions.add(name)
+
+            for fn in functions.get(name, ()):
+                for node in self.walk(fn.children[2]):
+                    if node.type == "CALL":
+                        work.append(node.sym.target)
+                    elif node.type == "IDENTIFIER" and node.sym.kind == "global":
+                        live_globals.add(node.value)
+
+        kept = []
+        for node in self.ast.children:
+            if node.type == "FUNCTION":
+                self.total_functions += 1
+                name = node.sym.target
+                if name not in live_functions:
+                    self.removed_functions.append(name)
+                    continue
+            elif node.type == "VAR_DECL":
+                self.total_globals += 1
+                if node.value not in live_globals:
+                    self.removed_globals.append(node.value)
+                    continue
+            kept.append(node)
+
+        return ASTNode("PROGRAM", children=kept, pos=self.ast.pos)
+
+    def walk(self, node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(c for c in node.children if c is not None)
+
+    def report(self):
+        removed = ", ".join(self.removed_functions) or "none"
+        return (f"dce: removed {len(self.removed_functions)}/{self.total_functions} functions ({removed}), "
+                f"{len(self.removed_globals)}/{self.total_globals} globals")
@@ -0,0 +1,215 @@
+from ir.ir import Const, I64, PURE, COMMUTATIVE
+from ir.cfg import dom_children
+from ir.alias import AliasInfo
+
+
+def wrap(value):
+    """Python int to 64-bit two's complement"""
+    value &= (1 << 64) - 1
+    return value - (1 << 64) if value >> 63 else value
+
+
+COMPARE = {
+    "eq": lambda a, b: a == b,
+    "ne": lambda a, b: a != b,
+    "lt": lambda a, b: a < b,
+    "le": lambda a, b: a <= b,
+    "gt": lambda a, b: a > b,
+    "ge": lambda a, b: a >= b,
+}
+
+# bits kept by narrow memory widths
+BITS = {"i8": 8, "i16": 16, "i32": 32}
+
+
+def sign_extend(value, bits):
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+
+# integer operations folded when every operand is a constant
+FOLD = {
+    "copy": lambda i, a: a[0],
+    "add": lambda i, a: a[0] + a[1],
+    "sub": lambda i, a: a[0] - a[1],
+    "mul": lambda i, a: a[0] * a[1],
+    "and": lambda i, a: a[0] & a[1],
+    "or": lambda i, a: a[0] | a[1],
+    "xor": lambda i, a: a[0] ^ a[1],
+    "shl": lambda i, a: a[0] << (a[1] & 63),
+    "sar": lambda i, a: a[0] >> (a[1] & 63),
+    "shr": lambda i, a: (a[0] & ((1 << 64) - 1)) >> (a[1] & 63),
+    "neg": lambda i, a: -a[0],
+    "cmp": lambda i, a: int(COMPARE[i.cond](a[0], a[1])),
+    "zext": lambda i, a: a[0] & ((1 << BITS[i.mem]) - 1),
+    "sext": lambda i, a: sign_extend(a[0], BITS[i.mem]),
+}
+
+# right operands that leave the left one unchanged
+IDENTITY = {"add": 0, "sub": 0, "or": 0, "xor": 0, "shl": 0, "sar": 0, "shr": 0, "mul": 1}
+
+
+class ValueNumbering:
+    """Reuses values already computed on every path to an instruction and drops redundant memory traffic
+
+    Pure instructions are numbered over the dominator tree, so an
+    expression is replaced by an identical one in a dominating block.
+    Integer operations on constants fold. Within a block, a load reuses
+    the last value loaded from or stored to the same address, a store of
+    the value already there goes, and so does a store overwritten before
+    anything could read it. Stores forget the addresses they may alias,
+    calls the memory a callee can reach.
+    """
+
+    # the CFG is untouched
+    preserves = ("dominators", "loops")
+
+    def __init__(self, analyses):
+        self.analyses = analyses
+        self.alias = None
+        self.mapping = None
+        self.numbered = 0
+        self.folded = 0
+        self.loads = 0
+        self.stores = 0
+
+    def run(self, module):
+        changed = False
+        for fn in module.functions:
+            if self.run_on_function(fn):
+                self.analyses.invalidate(fn, self.preserves)
+                changed = True
+        return changed
+
+    def run_on_function(self, fn):
+        children = dom_children(self.analyses.get("dominators", fn))
+        self.alias = AliasInfo(fn)
+        self.mapping = {}
+        table = {}
+        removed = 0
+        # scoped hash table, each block undoes its own entries when its subtree is done
+        stack = [(fn.entry, None)]
+        while stack:
+            block, added = stack.pop()
+            if added is not None:
+                for key in added:
+                    del table[key]
+                continue
+            added = []
+            removed += self.number_block(block, table, added)
+            stack.append((block, added))
+            stack.extend((child, None) for child in reversed(children.get(block, ())))
+        fn.replace_uses(self.mapping)
+        return bool(self.mapping) or removed > 0
+
+    def resolve(self, value):
+        while value in self.mapping:
+            value = self.mapping[value]
+        return value
+
+    def number_block(self, block, table, added):
+        memory = {}     # address -> (width, value known to be there)
+        pending = {}    # address -> store nothing has read yet
+        dead = set()
+        for instr in block.instrs:
+            instr.args = [self.resolve(a) if a in self.mapping else a for a in instr.args]
+            op = instr.op
+            if op == "load":
+                self.load(instr, memory, pending)
+            elif op == "store":
+                self.store(instr, memory, pending, dead)
+            elif op in ("call", "tailcall"):
+                for addr in [a for a in memory if self.alias.clobbered_by_call(a)]:
+                    del memory[addr]
+                for addr in [a for a in pending if self.alias.clobbered_by_call(a)]:
+                    del pending[addr]
+            elif op in PURE and op != "param":
+                value = self.fold(instr)
+                if value is not None:
+                    self.mapping[instr] = value
+                    self.folded += 1
+                    continue
+                key = self.key(instr)
+                known = table.get(key)
+                if known is not None:
+                    self.mapping[instr] = known
+                    self.numbered += 1
+                else:
+                    table[key] = instr
+                    added.append(key)
+        before = len(block.instrs)
+        block.instrs = [i for i in block.instrs if i not in self.mapping and i not in dead]
+        return before - len(block.instrs)
+
+    def key(self, instr):
+        args = tuple(a.key() if isinstance(a, Const) else a.id for a in instr.args)
+        if instr.op in COMMUTATIVE:
+            args = tuple(sorted(args, key=repr))
+        if instr.op == "phi":
+            # phis only match within their own block, in the same incoming order
+            return ("phi", instr.block.id, instr.ty, args, tuple(b.id for b in instr.blocks))
+        return (instr.op, instr.ty, instr.cond, instr.mem, instr.target, instr.slot, args)
+
+    def fold(self, instr):
+        handler = FOLD.get(instr.op)
+        if handler is None or not instr.args or instr.args[0].ty != I64:
+            return None
+        if not all(isinstance(a, Const) for a in instr.args):
+            return self.identity(instr)
+        return Const(wrap(handler(instr, [a.value for a in instr.args])))
+
+    def identity(self, instr):
+        """x + 0, x * 1 and the like are x, x * 0 and x & 0 are 0"""
+        if len(instr.args) != 2:
+            return None
+        x, c = instr.args
+        if instr.op in COMMUTATIVE and isinstance(x, Const):
+            x, c = c, x
+        if not isinstance(c, Const) or isinstance(x, Const):
+            return None
+        if c.value == IDENTITY.get(instr.op):
+            return x
+        if c.value == 0 and instr.op in ("mul", "and"):
+            return Const(0)
+        return None
+
+    def load(self, instr, memory, pending):
+        addr = instr.args[0]
+        known = memory.get(addr)
+        if known is not None and known[0] == instr.mem:
+            self.mapping[instr] = known[1]
+            self.loads += 1
+            return
+        for other in [a for a in pending if self.alias.may_alias(a, addr)]:
+            del pending[other]
+        memory[addr] = (instr.mem, instr)
+
+    def store(self, instr, memory, pending, dead):
+        addr, value = instr.args
+        known = memory.get(addr)
+        if known is not None and known[0] == instr.mem and same_value(known[1], value):
+            dead.add(instr)
+            self.stores += 1
+            return
+        earlier = pending.get(addr)
+        if earlier is not None and earlier.mem == instr.mem:
+            dead.add(earlier)
+            self.stores += 1
+        for other in [a for a in memory if self.alias.may_alias(a, addr)]:
+            del memory[other]
+        for other in [a for a in pending if self.alias.may_alias(a, addr)]:
+            del pending[other]
+        pending[addr] = instr
+        # a narrow store truncates, a later load would not see the full value
+        if instr.mem not in BITS:
+            memory[addr] = (instr.mem, value)
+
+    def report(self):
+        return (f"gvn: {self.numbered} values reused, {self.folded} folded, "
+                f"{self.loads} loads and {self.stores} stores removed")
+
+
+def same_value(a, b):
+    if isinstance(a, Const) and isinstance(b, Const):
+        return a.key() == b.key()
+    return a is b
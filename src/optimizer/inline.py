@@ -0,0 +1,175 @@
+from ir.ir import Instr, Const, Slot, F64
+
+# callees up to this many instructions are inlined
+DEFAULT_BUDGET = 40
+# a caller stops taking inlined bodies past this size
+MAX_CALLER_SIZE = 2000
+
+
+class Inliner:
+    """Inlines calls to small non-recursive functions, callees first
+
+    Runs on the whole module after overload resolution, so helpers from
+    included modules like minlib.oxy inline like any other function.
+    Functions left without callers are dropped afterwards.
+    """
+
+    def __init__(self, analyses, budget=DEFAULT_BUDGET):
+        self.analyses = analyses
+        self.budget = budget
+        self.inlined = 0
+        self.removed = []
+
+    def run(self, module):
+        functions = {fn.name: fn for fn in module.functions}
+        calls = {fn.name: {i.target for i in fn.instrs() if i.op == "call" and i.target in functions}
+                 for fn in module.functions}
+        recursive = self.recursive(calls)
+
+        changed = False
+        for name in self.bottom_up(calls):
+            fn = functions[name]
+            if self.inline_calls(fn, functions, recursive):
+                self.analyses.invalidate(fn)
+                changed = True
+
+        # main is the only entry point
+        live = set()
+        work = ["main"]
+        while work:
+            name = work.pop()
+            if name in live or name not in functions:
+                continue
+            live.add(name)
+            work.extend(i.target for i in functions[name].instrs() if i.op in ("call", "tailcall"))
+        for fn in list(module.functions):
+            if fn.name not in live:
+                module.functions.remove(fn)
+                self.removed.append(fn.name)
+                changed = True
+        return changed
+
+    def bottom_up(self, calls):
+        """Function names with callees before callers"""
+        order = []
+        seen = set()
+        for root in calls:
+            if root in seen:
+                continue
+            seen.add(root)
+            stack = [(root, iter(sorted(calls[root])))]
+            while stack:
+                name, succs = stack[-1]
+                for succ in succs:
+                    if succ not in seen:
+                        seen.add(succ)
+                        stack.append((succ, iter(sorted(calls[succ]))))
+                        break
+                else:
+                    stack.pop()
+                    order.append(name)
+        return order
+
+    def recursive(self, calls):
+        """Functions that can reach themselves through calls"""
+        found = set()
+        for root in calls:
+            seen = set()
+            work = list(calls[root])
+            while work:
+                name = work.pop()
+                if name == root:
+                    found.add(root)
+                    break
+                if name not in seen:
+                    seen.add(name)
+                    work.extend(calls[name])
+        return found
+
+    def inline_calls(self, fn, functions, recursive):
+        changed = False
+        work = list(fn.blocks)
+        while work:
+            block = work.pop()
+            for instr in block.instrs:
+                if instr.op != "call":
+                    continue
+                callee = functions.get(instr.target)
+                if (callee is None or callee is fn or callee.name in recursive
+                        or callee.size() - len(callee.params) > self.budget
+                        or fn.size() > MAX_CALLER_SIZE):
+                    continue
+                # the rest of the block moved to a new block, keep scanning there
+                work.append(self.inline(fn, instr, callee))
+                self.inlined += 1
+                changed = True
+                break
+        return changed
+
+    def inline(self, fn, call, callee):
+        """Replace call with a copy of callee's body, returns the block holding the code after it"""
+        block = call.block
+        index = block.instrs.index(call)
+        cont = fn.new_block("cont")
+        cont.instrs = block.instrs[index + 1:]
+        block.instrs = block.instrs[:index]
+        for instr in cont.instrs:
+            instr.block = cont
+        for succ in cont.succs:
+            for phi in succ.phis():
+                phi.blocks = [cont if b is block else b for b in phi.blocks]
+
+        values = dict(zip(callee.params, call.args))
+        slots = {}
+        for slot in callee.slots:
+            copy = Slot(f"{slot.name}.{callee.name}", slot.size, slot.align)
+            fn.slots.append(copy)
+            slots[slot] = copy
+        blocks = {b: fn.new_block(b.name) for b in callee.blocks}
+
+        # clone every instruction first, operands may refer to values defined later (phis)
+        returns = []
+        clones = []
+        for old_block in callee.blocks:
+            new_block = blocks[old_block]
+            for old in old_block.instrs:
+                if old.op == "param":
+                    continue
+                if old.op == "ret":
+                    new = fn.number(Instr("jmp", blocks=[cont]))
+                    returns.append((new_block, old.args[0] if old.args else None))
+                else:
+                    new = fn.number(Instr(old.op, old.args, old.ty, old.target, old.cond, old.mem,
+                                          slots.get(old.slot), [blocks[b] for b in old.blocks]))
+                    values[old] = new
+                    clones.append(new)
+                new.block = new_block
+                new_block.instrs.append(new)
+        for new in clones:
+            new.args = [values.get(a, a) for a in new.args]
+
+        jump = fn.number(Instr("jmp", blocks=[blocks[callee.entry]]))
+        jump.block = block
+        block.instrs.append(jump)
+
+        result = None
+        if call.ty is not None and not returns:
+            # the callee never returns, the code after the call is unreachable
+            result = Const(0.0 if call.ty == F64 else 0, call.ty)
+        elif call.ty is not None:
+            if len(returns) == 1:
+                result = values.get(returns[0][1], returns[0][1])
+            else:
+                result = fn.number(Instr("phi", [values.get(v, v) for _, v in returns], call.ty,
+                                         blocks=[b for b, _ in returns]))
+                result.block = cont
+                cont.instrs.insert(0, result)
+        if result is not None:
+            fn.replace_uses({call: result})
+
+        fn.compute_preds()
+        return cont
+
+    def report(self):
+        removed = ", ".join(self.removed) or "none"
+        return f"inline: inlined {self.inlined} calls, removed {len(self.removed)} functions ({removed})"
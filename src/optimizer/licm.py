@@ -0,0 +1,230 @@
+from ir.ir import Instr, Const, I64, PURE
+from ir.cfg import reverse_postorder, preheader
+from ir.alias import AliasInfo, dereferenceable
+
+# address constants are cheaper to rematerialize than to keep in a register,
+# and compares stay next to the branch the backend fuses them into
+PINNED = {"phi", "param", "slot", "global", "str", "cmp", "fcmp"}
+
+
+class LoopInvariantMotion:
+    """Hoists computations and loads that give the same value on every iteration into a preheader
+
+    Inner loops go first so an invariant climbs as far out as it can.
+    Pure instructions never fault and move freely. A load moves when
+    nothing in the loop can write its memory and either its address is
+    always valid or it sits in the header, which runs whenever the loop
+    is entered.
+    """
+
+    def __init__(self, analyses):
+        self.analyses = analyses
+        self.hoisted = 0
+        self.loads = 0
+
+    def run(self, module):
+        changed = False
+        for fn in module.functions:
+            if self.run_on_function(fn):
+                self.analyses.invalidate(fn)
+                changed = True
+        return changed
+
+    def run_on_function(self, fn):
+        loops = self.analyses.get("loops", fn)
+        if not loops:
+            return False
+        alias = AliasInfo(fn)
+        changed = False
+        for loop in loops:
+            if self.hoist(fn, loop, alias):
+                changed = True
+        return changed
+
+    def hoist(self, fn, loop, alias):
+        stores = []
+        calls = False
+        for block in loop.blocks:
+            for instr in block.instrs:
+                if instr.op == "store":
+                    stores.append(instr.args[0])
+                elif instr.op in ("call", "tailcall"):
+                    calls = True
+
+        moved = []
+        for block in reverse_postorder(fn):
+            if block not in loop.blocks:
+                continue
+            keep = []
+            for instr in block.instrs:
+                if self.invariant(instr, loop) and self.movable(instr, loop, alias, stores, calls):
+                    moved.append(instr)
+                    # operands that moved are now outside the loop
+                    instr.block = None
+                else:
+                    keep.append(instr)
+            block.instrs = keep
+        if not moved:
+            return False
+
+        pre = preheader(fn, loop)
+        for instr in moved:
+            instr.block = pre
+        pre.instrs[-1:-1] = moved
+        self.hoisted += len(moved)
+        return True
+
+    def invariant(self, instr, loop):
+        return all(not isinstance(a, Instr) or a.block not in loop.blocks for a in instr.args)
+
+    def movable(self, instr, loop, alias, stores, calls):
+        if instr.op in PURE:
+            return instr.op not in PINNED
+        if instr.op != "load":
+            return False
+        addr = instr.args[0]
+        if calls and alias.clobbered_by_call(addr):
+            return False
+        if any(alias.may_alias(addr, s) for s in stores):
+            return False
+        if not (dereferenceable(addr) or instr.block is loop.header):
+            return False
+        self.loads += 1
+        return True
+
+    def report(self):
+        return f"licm: hoisted {self.hoisted} instructions ({self.loads} loads)"
+
+
+class InductionVariableReducer:
+    """Replaces base + i and base + i * scale inside a loop with a pointer that steps along with i
+
+    i must be a header phi advanced by a constant once per iteration
+    through the loop's single latch. When indexing was the only other use
+    of i, the counter disappears and the loop keeps just the pointer.
+    """
+
+    def __init__(self, analyses):
+        self.analyses = analyses
+        self.reduced = 0
+        self.removed = 0
+
+    def run(self, module):
+        changed = False
+        for fn in module.functions:
+            if self.run_on_function(fn):
+                self.analyses.invalidate(fn)
+                changed = True
+        return changed
+
+    def run_on_function(self, fn):
+        changed = False
+        for loop in self.analyses.get("loops", fn):
+            if len(loop.latches) != 1 or len(loop.header.preds) != 2:
+                continue
+            if self.reduce_loop(fn, loop):
+                changed = True
+        return changed
+
+    def reduce_loop(self, fn, loop):
+        latch = loop.latches[0]
+        changed = False
+        for phi in list(loop.header.phis()):
+            if phi.ty != I64:
+                continue
+            step = self.step(phi, latch)
+            if step is None:
+                continue
+            derived = {}
+            for d, base, scale in self.derived(phi, loop, self.users(loop)):
+                key = (base, scale)
+                if key not in derived:
+                    pre = preheader(fn, loop)
+                    init = phi.args[phi.blocks.index(pre)]
+                    derived[key] = self.pointer(fn, loop, pre, latch, base, init, step, scale)
+                fn.replace_uses({d: derived[key]})
+                d.block.instrs.remove(d)
+                self.reduced += 1
+                changed = True
+            if derived:
+                self.drop_dead_counter(fn, phi, latch)
+        return changed
+
+    def step(self, phi, latch):
+        """Constant added to phi on the back edge, None when it is not a simple counter"""
+        nxt = phi.args[phi.blocks.index(latch)]
+        if (isinstance(nxt, Instr) and nxt.op == "add" and nxt.args[0] is phi
+                and isinstance(nxt.args[1], Const)):
+            return nxt.args[1].value
+        return None
+
+    def users(self, loop):
+        users = {}
+        for block in loop.blocks:
+            for instr in block.instrs:
+                for a in instr.args:
+                    if isinstance(a, Instr):
+                        users.setdefault(a, []).append(instr)
+        return users
+
+    def derived(self, phi, loop, users):
+        """(instr, base, scale) for each add in the loop of a loop-invariant base and phi * scale"""
+        found = []
+        seen = set()
+        scaled = [(phi, 1)]
+        for user in users.get(phi, ()):
+            if user.op in ("shl", "mul") and user.args[0] is phi and isinstance(user.args[1], Const):
+                k = user.args[1].value
+                scaled.append((user, 1 << k if user.op == "shl" else k))
+        for index, scale in scaled:
+            for user in users.get(index, ()):
+                if user.op != "add" or user in seen or index not in user.args:
+                    continue
+                base = user.args[1] if user.args[0] is index else user.args[0]
+                # a constant base is just another counter
+                if not isinstance(base, Instr) or base is index or base.block in loop.blocks:
+                    continue
+                seen.add(user)
+                found.append((user, base, scale))
+        return found
+
+    def pointer(self, fn, loop, pre, latch, base, init, step, scale):
+        start = self.emit(fn, pre, "mul", init, scale) if scale != 1 else init
+        start = self.emit(fn, pre, "add", base, start)
+        ptr = fn.number(Instr("phi", [start], I64, blocks=[pre]))
+        ptr.block = loop.header
+        loop.header.instrs.insert(0, ptr)
+        nxt = self.emit(fn, latch, "add", ptr, step * scale)
+        ptr.args.append(nxt)
+        ptr.blocks.append(latch)
+        return ptr
+
+    def emit(self, fn, block, op, a, b):
+        """op on a and b before block's terminator, folded when both are constants"""
+        b = b if isinstance(b, (Instr, Const)) else Const(b)
+        if isinstance(a, Const) and isinstance(b, Const):
+            return Const(a.value + b.value if op == "add" else a.value * b.value)
+        if op == "add" and isinstance(b, Const) and b.value == 0:
+            return a
+        if op == "add" and isinstance(a, Const) and a.value == 0:
+            return b
+        instr = fn.number(Instr(op, [a, b], I64))
+        instr.block = block
+        block.instrs.insert(len(block.instrs) - 1, instr)
+        return instr
+
+    def drop_dead_counter(self, fn, phi, latch):
+        """Remove scaled copies of phi left unused, and phi itself once only its increment reads it"""
+        uses = fn.uses()
+        nxt = phi.args[phi.blocks.index(latch)]
+        for instr in [i for b in fn.blocks for i in b.instrs if phi in i.args]:
+            if instr is not nxt and instr.op in ("shl", "mul") and phi in instr.args and not uses.get(instr):
+                instr.block.instrs.remove(instr)
+                uses[phi] -= 1
+        if uses.get(phi) == 1 and uses.get(nxt) == 1:
+            phi.block.instrs.remove(phi)
+            nxt.block.instrs.remove(nxt)
+            self.removed += 1
+
+    def report(self):
+        return f"iv: {self.reduced} indexed addresses turned into pointers, {self.removed} counters removed"
@@ -0,0 +1,141 @@
+import time
+from ir.cfg import dominators, find_loops
+from optimizer.constfold import ConstantFolder
+from optimizer.dce import DeadCodeEliminator
+from optimizer.simplify import SimplifyCFG, DeadValueEliminator
+from optimizer.strength import StrengthReducer
+from optimizer.inline import Inliner
+from optimizer.gvn import ValueNumbering
+from optimizer.tailcall import TailCallEliminator
+from optimizer.rotate import LoopRotator
+from optimizer.licm import LoopInvariantMotion, InductionVariableReducer
+
+
+class PassError(Exception):
+    pass
+
+
+# analysis name -> function computing it, later analyses may ask for earlier ones
+ANALYSES = {
+    "dominators": lambda fn, analyses: dominators(fn),
+    "loops": lambda fn, analyses: find_loops(fn, analyses.get("dominators", fn)),
+}
+
+
+class Analyses:
+    """Per-function analysis results, cached until a pass changes the function"""
+
+    def __init__(self):
+        self.cache = {}
+        self.computed = 0
+
+    def get(self, name, fn):
+        key = (name, fn)
+        result = self.cache.get(key)
+        if result is None:
+            result = ANALYSES[name](fn, self)
+            self.cache[key] = result
+            self.computed += 1
+        return result
+
+    def invalidate(self, fn, preserved=()):
+        for key in [k for k in self.cache if k[1] is fn and k[0] not in preserved]:
+            del self.cache[key]
+
+
+# pass name -> (stage, class), ast passes rewrite the tree, ir passes the module,
+# backend passes are switches for x86_64_Linux
+PASSES = {
+    "constfold": ("ast", ConstantFolder),
+    "dce": ("ast", DeadCodeEliminator),
+    "inline": ("ir", Inliner),
+    "simplify-cfg": ("ir", SimplifyCFG),
+    "gvn": ("ir", ValueNumbering),
+    "strength": ("ir", StrengthReducer),
+    "tailcall": ("ir", TailCallEliminator),
+    "loop-rotate": ("ir", LoopRotator),
+    "licm": ("ir", LoopInvariantMotion),
+    "iv": ("ir", InductionVariableReducer),
+    "dead-values": ("ir", DeadValueEliminator),
+    "regalloc": ("backend", None),
+    "peephole": ("backend", None),
+}
+
+# pipeline order, a pass may run more than once to clean up after the ones before it
+ORDER = [
+    "constfold",
+    "dce",
+    "inline",
+    "simplify-cfg",
+    "gvn",
+    "strength",
+    "tailcall",
+    "loop-rotate",
+    "gvn",
+    "licm",
+    "iv",
+    "dead-values",
+    "regalloc",
+    "peephole",
+]
+
+LEVELS = {
+    0: set(),
+    1: {"constfold", "dce", "simplify-cfg", "gvn", "strength", "regalloc", "peephole"},
+    2: {"constfold", "dce", "inline", "simplify-cfg", "gvn", "strength", "tailcall", "loop-rotate", "licm",
+        "iv", "dead-values", "regalloc", "peephole"},
+}
+
+
+def pipeline(level, enable=(), disable=()):
+    """Pass names to run for an -O level with passes switched on and off"""
+    for name in (*enable, *disable):
+        if name not in PASSES:
+            raise PassError(f"Unknown pass '{name}', available: {', '.join(PASSES)}")
+    selected = (LEVELS[level] | set(enable)) - set(disable)
+    return [name for name in ORDER if name in selected]
+
+
+class PassManager:
+    """Runs an ordered list of passes over the AST, then the IR, and hands the rest to the backend"""
+
+    def __init__(self, passes, options=None):
+        self.passes = passes
+        # pass name -> keyword arguments for that pass
+        self.options = options or {}
+        self.analyses = Analyses()
+        self.reports = []
+        self.timings = []
+
+    def stage(self, stage):
+        return [name for name in self.passes if PASSES[name][0] == stage]
+
+    def run_ast(self, ast):
+        for name in self.stage("ast"):
+            start = time.perf_counter()
+            p = PASSES[name][1](ast)
+            ast = p.run()
+            self.finish(name, p, start)
+        return ast
+
+    def run_ir(self, module):
+        for name in self.stage("ir"):
+            start = time.perf_counter()
+            p = PASSES[name][1](self.analyses, **self.options.get(name, {}))
+            p.run(module)
+            self.finish(name, p, start)
+        return module
+
+    def finish(self, name, p, start):
+        self.timings.append((name, time.perf_counter() - start))
+        self.reports.append(p.report())
+
+    def backend_options(self):
+        return {name: name in self.passes for name in self.stage_names("backend")}
+
+    def stage_names(self, stage):
+        return [name for name, (s, _) in PASSES.items() if s == stage]
+
+    def report(self):
+        timings = ", ".join(f"{name} {t * 1000:.1f}ms" for name, t in self.timings) or "none"
+        return f"passes: {timings}, {self.analyses.computed} analyses computed"
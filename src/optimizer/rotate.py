@@ -0,0 +1,159 @@
+from ir.ir import Instr, PURE
+
+# header instructions copied into the latch, beyond this the loop is left alone
+MAX_HEADER = 8
+
+
+class LoopRotator:
+    """Turns while loops into a guard followed by a loop that tests at the bottom
+
+    The header's test is copied into the latch, so each iteration ends in
+    one conditional branch back to the body instead of a jump to the top
+    and a branch out. The old header runs once as the guard. Values it
+    defines get a phi in the body for the loop and one in the exit block
+    for the code after it.
+    """
+
+    def __init__(self, analyses):
+        self.analyses = analyses
+        self.rotated = 0
+
+    def run(self, module):
+        changed = False
+        for fn in module.functions:
+            if self.run_on_function(fn):
+                self.analyses.invalidate(fn)
+                changed = True
+        return changed
+
+    def run_on_function(self, fn):
+        changed = False
+        for loop in self.analyses.get("loops", fn):
+            if self.rotate(fn, loop):
+                changed = True
+        if changed:
+            fn.compute_preds()
+            # guards entered from one place keep single-argument phis
+            fn.simplify_phis()
+        return changed
+
+    def shape(self, loop):
+        """(body, exit, latch) when loop is a rotatable while loop, else None"""
+        header = loop.header
+        term = header.terminator
+        if term is None or term.op != "br" or len(loop.latches) != 1:
+            return None
+        latch = loop.latches[0]
+        if latch is header or latch.terminator.op != "jmp":
+            return None
+        body, exit = term.blocks
+        if body not in loop.blocks:
+            body, exit = exit, body
+        if body not in loop.blocks or exit in loop.blocks or body is exit:
+            return None
+        if len(body.preds) != 1 or loop.exits() != [exit]:
+            return None
+        code = [i for i in header.instrs[:-1] if i.op != "phi"]
+        # loads repeat under the same condition, so the copy never faults where the original would not
+        if len(code) > MAX_HEADER or any(i.op not in PURE and i.op != "load" for i in code):
+            return None
+        return body, exit, latch
+
+    def rotate(self, fn, loop):
+        shape = self.shape(loop)
+        if shape is None:
+            return False
+        body, exit, latch = shape
+        header = loop.header
+        values = [i for i in header.instrs if i is not header.terminator]
+
+        # every header value gets a phi in the body, unused ones go at the end
+        inner = {v: self.phi(fn, body, v, []) for v in values}
+        # the value each header value would have on the next trip through the header
+        nxt = {}
+        for phi in header.phis():
+            i = phi.blocks.index(latch)
+            arg = phi.args[i]
+            nxt[phi] = inner.get(arg, arg)
+            del phi.args[i]
+            del phi.blocks[i]
+        jump = latch.instrs.pop()
+        clones = {jump}
+        for instr in values:
+            if instr.op == "phi":
+                continue
+            copy = fn.number(Instr(instr.op, [nxt.get(a, a) for a in instr.args], instr.ty,
+                                   instr.target, instr.cond, instr.mem, instr.slot))
+            copy.block = latch
+            latch.instrs.append(copy)
+            clones.add(copy)
+            nxt[instr] = copy
+        term = header.terminator
+        jump.op = "br"
+        jump.args = [nxt.get(term.args[0], term.args[0])]
+        jump.blocks = list(term.blocks)
+        latch.instrs.append(jump)
+        for v, phi in inner.items():
+            phi.args = [v, nxt[v]]
+            phi.blocks = [header, latch]
+
+        # phis already in the exit block see the latch's values on the new edge
+        for phi in exit.phis():
+            arg = phi.args[phi.blocks.index(header)]
+            phi.args = [inner[a] if a in inner and b is not header else a for a, b in zip(phi.args, phi.blocks)]
+            phi.args.append(nxt.get(arg, arg))
+            phi.blocks.append(latch)
+
+        # code after the loop sees whichever edge left it
+        outer = {}
+        exit_preds = list(exit.preds)
+
+        def after(v):
+            if v not in outer:
+                outer[v] = self.phi(fn, exit, v, [(v if pred is header else inner[v], pred) for pred in exit_preds])
+                outer[v].args.append(nxt[v])
+                outer[v].blocks.append(latch)
+            return outer[v]
+
+        created = set(inner.values())
+        for block in fn.blocks:
+            if block is header:
+                continue
+            for instr in list(block.instrs):
+                if instr in created or instr in clones or instr in outer.values():
+                    continue
+                if block is exit and instr.op == "phi":
+                    continue
+                if block in loop.blocks:
+                    instr.args = [inner.get(a, a) for a in instr.args]
+                else:
+                    instr.args = [after(a) if a in inner else a for a in instr.args]
+
+        body.preds.append(latch)
+        exit.preds.append(latch)
+        header.preds.remove(latch)
+        self.drop_unused(fn, body, created)
+        self.rotated += 1
+        return True
+
+    def drop_unused(self, fn, body, created):
+        live = set()
+        for instr in fn.instrs():
+            if instr not in created:
+                live.update(a for a in instr.args if a in created)
+        work = list(live)
+        while work:
+            for a in work.pop().args:
+                if a in created and a not in live:
+                    live.add(a)
+                    work.append(a)
+        body.instrs = [i for i in body.instrs if i not in created or i in live]
+
+    def phi(self, fn, block, like, incoming):
+        phi = fn.number(Instr("phi", [a for a, _ in incoming], like.ty, blocks=[b for _, b in incoming]))
+        phi.block = block
+        block.instrs.insert(0, phi)
+        return phi
+
+    def report(self):
+        return f"loop-rotate: rotated {self.rotated} loops"
@@ -0,0 +1,156 @@
+from ir.ir import Instr, Const, PURE
+
+
+class SimplifyCFG:
+    """Folds constant branches, forwards empty blocks and merges straight-line chains"""
+
+    def __init__(self, analyses):
+        self.analyses = analyses
+        self.folded = 0
+        self.merged = 0
+
+    def run(self, module):
+        changed = False
+        for fn in module.functions:
+            if self.run_on_function(fn):
+                self.analyses.invalidate(fn)
+                changed = True
+        return changed
+
+    def run_on_function(self, fn):
+        changed = False
+        while self.fold_branches(fn) | self.forward_empty(fn) | self.merge_chains(fn):
+            changed = True
+        return changed
+
+    def fold_branches(self, fn):
+        changed = False
+        for block in fn.blocks:
+            term = block.terminator
+            if term is None or term.op != "br" or not isinstance(term.args[0], Const):
+                continue
+            taken = term.blocks[0] if term.args[0].value else term.blocks[1]
+            dropped = term.blocks[1] if term.args[0].value else term.blocks[0]
+            if dropped is not taken:
+                remove_incoming(dropped, block)
+            term.op = "jmp"
+            term.args = []
+            term.blocks = [taken]
+            self.folded += 1
+            changed = True
+        if changed:
+            fn.compute_preds()
+            fn.remove_unreachable()
+            fn.simplify_phis()
+        return changed
+
+    def forward_empty(self, fn):
+        """Blocks holding only a jmp are skipped by their predecessors"""
+        changed = False
+        for block in list(fn.blocks):
+            if block is fn.entry or len(block.instrs) != 1 or block.instrs[0].op != "jmp":
+                continue
+            target = block.instrs[0].blocks[0]
+            if target is block or any(True for _ in target.phis()):
+                # phis would need an argument per forwarded predecessor
+                continue
+            for pred in block.preds:
+                term = pred.terminator
+                term.blocks = [target if b is block else b for b in term.blocks]
+                if pred not in target.preds:
+                    target.preds.append(pred)
+            target.preds.remove(block)
+            fn.blocks.remove(block)
+            self.merged += 1
+            changed = True
+        return changed
+
+    def merge_chains(self, fn):
+        """A block with a single predecessor that jumps only to it joins that predecessor"""
+        changed = False
+        merged = set()
+        for block in list(fn.blocks):
+            if block in merged:
+                continue
+            while True:
+                term = block.terminator
+                if term is None or term.op != "jmp":
+                    break
+                succ = term.blocks[0]
+                if succ is block or succ is fn.entry or len(succ.preds) != 1:
+                    break
+                mapping = {}
+                for phi in list(succ.phis()):
+                    mapping[phi] = phi.args[0]
+                    succ.instrs.remove(phi)
+                block.instrs.pop()
+                for instr in succ.instrs:
+                    instr.block = block
+                    block.instrs.append(instr)
+                fn.blocks.remove(succ)
+                merged.add(succ)
+                for other in succ.succs:
+                    other.preds = [block if b is succ else b for b in other.preds]
+                    for phi in other.phis():
+                        phi.blocks = [block if b is succ else b for b in phi.blocks]
+                fn.replace_uses(mapping)
+                self.merged += 1
+                changed = True
+        return changed
+
+    def report(self):
+        return f"simplify-cfg: folded {self.folded} branches, removed {self.merged} blocks"
+
+
+def remove_incoming(block, pred):
+    for phi in block.phis():
+        keep = [i for i, b in enumerate(phi.blocks) if b is not pred]
+        phi.args = [phi.args[i] for i in keep]
+        phi.blocks = [phi.blocks[i] for i in keep]
+
+
+class DeadValueEliminator:
+    """Removes instructions whose results are never used and that have no side effects"""
+
+    # the CFG is untouched
+    preserves = ("dominators", "loops")
+
+    def __init__(self, analyses):
+        self.analyses = analyses
+        self.removed = 0
+
+    def run(self, module):
+        changed = False
+        for fn in module.functions:
+            if self.run_on_function(fn):
+                self.analyses.invalidate(fn, self.preserves)
+                changed = True
+        return changed
+
+    def run_on_function(self, fn):
+        uses = fn.uses()
+        work = [i for i in fn.instrs() if self.removable(i) and not uses.get(i)]
+        dead = set()
+        while work:
+            instr = work.pop()
+            if instr in dead:
+                continue
+            dead.add(instr)
+            for a in instr.args:
+                if isinstance(a, Instr):
+                    uses[a] -= 1
+                    if not uses[a] and self.removable(a):
+                        work.append(a)
+        if not dead:
+            return False
+        for block in fn.blocks:
+            block.instrs = [i for i in block.instrs if i not in dead]
+        self.removed += len(dead)
+        return True
+
+    def removable(self, instr):
+        # parameters stay, the calling convention still delivers them
+        return (instr.op in PURE or instr.op == "load") and instr.op != "param"
+
+    def report(self):
+        return f"dead-values: removed {self.removed} instructions"
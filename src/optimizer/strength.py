@@ -0,0 +1,186 @@
+from ir.ir import Instr, Const, I64, COMMUTATIVE
+
+MASK = (1 << 64) - 1
+# exponents up to this many bits are unrolled into a multiply chain
+MAX_POW_BITS = 6
+
+
+def log2(value):
+    """k when value is 2**k with k >= 1, otherwise None"""
+    if value > 1 and value & (value - 1) == 0:
+        return value.bit_length() - 1
+    return None
+
+
+def signed_magic(d):
+    """Multiplier and shift for signed 64-bit division by d, |d| > 1 and not a power of two
+
+    Hacker's Delight, figure 10-1.
+    """
+    two63 = 1 << 63
+    ad = abs(d)
+    t = two63 + (1 if d < 0 else 0)
+    anc = t - 1 - t % ad
+    p = 63
+    q1, r1 = divmod(two63, anc)
+    q2, r2 = divmod(two63, ad)
+    while True:
+        p += 1
+        q1, r1 = 2 * q1, 2 * r1
+        if r1 >= anc:
+            q1, r1 = q1 + 1, r1 - anc
+        q2, r2 = 2 * q2, 2 * r2
+        if r2 >= ad:
+            q2, r2 = q2 + 1, r2 - ad
+        delta = ad - r2
+        if not (q1 < delta or (q1 == delta and r1 == 0)):
+            break
+    m = (q2 + 1) & MASK
+    if d < 0:
+        m = -m & MASK
+    if m >= two63:
+        m -= 1 << 64
+    return m, p - 64
+
+
+class StrengthReducer:
+    """Rewrites multiply, divide, modulo and pow by constants into cheaper instructions
+
+    Division keeps its truncating signed semantics: powers of two shift with
+    a bias for negative dividends, other divisors multiply by a magic
+    reciprocal. Division and modulo by 0 and by -1 are left alone so they
+    still fault.
+    """
+
+    # the CFG is untouched
+    preserves = ("dominators", "loops")
+
+    def __init__(self, analyses):
+        self.analyses = analyses
+        self.fn = None
+        self.out = None
+        self.block = None
+        self.shifts = 0
+        self.magic = 0
+        self.pows = 0
+
+        self.handlers = {
+            "mul": self.reduce_mul,
+            "div": self.reduce_div,
+            "mod": self.reduce_mod,
+            "pow": self.reduce_pow,
+        }
+
+    def run(self, module):
+        changed = False
+        for fn in module.functions:
+            if self.run_on_function(fn):
+                self.analyses.invalidate(fn, self.preserves)
+                changed = True
+        return changed
+
+    def run_on_function(self, fn):
+        self.fn = fn
+        mapping = {}
+        for block in fn.blocks:
+            self.block = block
+            self.out = []
+            for instr in block.instrs:
+                instr.args = [mapping.get(a, a) for a in instr.args]
+                handler = self.handlers.get(instr.op)
+                if instr.op in COMMUTATIVE and isinstance(instr.args[0], Const):
+                    # constants go on the right, where the rewrites and the backend look for them
+                    instr.args.reverse()
+                result = None
+                if handler is not None and isinstance(instr.args[1], Const):
+                    result = handler(instr.args[0], instr.args[1].value)
+                if result is None:
+                    self.out.append(instr)
+                else:
+                    mapping[instr] = result
+            block.instrs = self.out
+        fn.replace_uses(mapping)
+        return bool(mapping)
+
+    def emit(self, op, *args):
+        instr = self.fn.number(Instr(op, [a if isinstance(a, (Instr, Const)) else Const(a) for a in args], I64))
+        instr.block = self.block
+        self.out.append(instr)
+        return instr
+
+    def reduce_mul(self, x, c):
+        if c == 0:
+            return Const(0)
+        if c == 1:
+            return x
+        if c == -1:
+            return self.emit("neg", x)
+        k = log2(abs(c))
+        if k is None:
+            return None
+        self.shifts += 1
+        shifted = self.emit("shl", x, k)
+        return shifted if c > 0 else self.emit("neg", shifted)
+
+    def quotient(self, x, d):
+        k = log2(abs(d))
+        if k is not None:
+            # round towards zero: negative dividends get 2**k - 1 added before the shift
+            self.shifts += 1
+            sign = x if k == 1 else self.emit("sar", x, 63)
+            bias = self.emit("shr", sign, 64 - k)
+            q = self.emit("sar", self.emit("add", x, bias), k)
+        else:
+            self.magic += 1
+            m, s = signed_magic(d)
+            q = self.emit("mulhi", x, m)
+            if d > 0 and m < 0:
+                q = self.emit("add", q, x)
+            elif d < 0 and m > 0:
+                q = self.emit("sub", q, x)
+            if s:
+                q = self.emit("sar", q, s)
+            q = self.emit("add", q, self.emit("shr", q, 63))
+            return q
+        return q if d > 0 else self.emit("neg", q)
+
+    def reduce_div(self, x, d):
+        if d == 1:
+            return x
+        if d in (0, -1):
+            return None
+        return self.quotient(x, d)
+
+    def reduce_mod(self, x, d):
+        if d == 1:
+            return Const(0)
+        if d in (0, -1):
+            return None
+        k = log2(abs(d))
+        if k is not None:
+            # the remainder takes the sign of the dividend, whatever the sign of d
+            self.shifts += 1
+            sign = x if k == 1 else self.emit("sar", x, 63)
+            bias = self.emit("shr", sign, 64 - k)
+            low = self.emit("and", self.emit("add", x, bias), (1 << k) - 1)
+            return self.emit("sub", low, bias)
+        q = self.quotient(x, d)
+        return self.emit("sub", x, self.emit("mul", q, d))
+
+    def reduce_pow(self, x, e):
+        if e < 0 or e.bit_length() > MAX_POW_BITS:
+            return None
+        self.pows += 1
+        if e == 0:
+            return Const(1)
+        # square and multiply, from the high bit down
+        result = x
+        for bit in bin(e)[3:]:
+            result = self.emit("mul", result, result)
+            if bit == "1":
+                result = self.emit("mul", result, x)
+        return result
+
+    def report(self):
+        return (f"strength: {self.shifts} shifts, {self.magic} magic divisions, "
+                f"{self.pows} pows unrolled")
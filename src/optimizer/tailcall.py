@@ -0,0 +1,177 @@
+from ir.ir import Instr, Const, I64
+
+# operations an accumulator can carry across iterations, with their identity
+ACCUMULATORS = {"add": 0, "mul": 1}
+
+
+def escaping_slots(fn):
+    """True when a slot address is used for anything but a direct load or store
+
+    The caller's frame goes away on a tail call and is reused by a loop,
+    so neither is safe once a pointer into it can be held somewhere.
+    """
+    for instr in fn.instrs():
+        for i, a in enumerate(instr.args):
+            if isinstance(a, Instr) and a.op == "slot":
+                if not (instr.op in ("load", "store") and i == 0):
+                    return True
+    return False
+
+
+class TailCallEliminator:
+    """Turns self-recursion in tail position into a loop and other tail calls into jumps
+
+    A recursive call whose result is returned directly, or combined with
+    a value computed before the call by + or * (ret n * f(n - 1)), jumps
+    back to the top of the function with the arguments as the new
+    parameters, an accumulator phi collects the pending operations. Calls
+    to other functions directly followed by ret become tailcall, which
+    the backend emits as a jmp after tearing down the frame.
+    """
+
+    def __init__(self, analyses):
+        self.analyses = analyses
+        self.loops = 0
+        self.jumps = 0
+
+    def run(self, module):
+        changed = False
+        for fn in module.functions:
+            if escaping_slots(fn):
+                continue
+            if self.run_on_function(fn):
+                self.analyses.invalidate(fn)
+                changed = True
+        return changed
+
+    def run_on_function(self, fn):
+        sites = []
+        for block in fn.blocks:
+            site = self.recursive_site(fn, block)
+            if site is not None:
+                sites.append(site)
+        ops = {op.op for _, _, op in sites if op is not None}
+        changed = False
+        if sites and len(ops) <= 1:
+            self.make_loop(fn, sites, ops.pop() if ops else None)
+            changed = True
+
+        for block in fn.blocks:
+            if self.tail_call(fn, block):
+                changed = True
+        return changed
+
+    def recursive_site(self, fn, block):
+        """(block, call, op) for a return of a self call, op is the accumulator instruction or None"""
+        instrs = block.instrs
+        ret = block.terminator
+        if ret is None or ret.op != "ret" or len(instrs) < 2:
+            return None
+        value = ret.args[0] if ret.args else None
+
+        call = instrs[-2]
+        if call.op == "call" and call.target == fn.name and (value is call or value is None):
+            return block, call, None
+
+        if len(instrs) < 3:
+            return None
+        op, call = instrs[-2], instrs[-3]
+        if (call.op != "call" or call.target != fn.name or op.op not in ACCUMULATORS
+                or op.ty != I64 or value is not op or call not in op.args):
+            return None
+        other = op.args[1] if op.args[0] is call else op.args[0]
+        if other is call:
+            return None
+        if sum(1 for i in fn.instrs() for a in i.args if a is call or a is op) != 2:
+            # the call and the combined value must have no other uses
+            return None
+        return block, call, op
+
+    def make_loop(self, fn, sites, acc_op):
+        entry = fn.entry
+        params = [i for i in entry.instrs if i.op == "param"]
+        header = fn.new_block("tailrec")
+        fn.blocks.remove(header)
+        fn.blocks.insert(1, header)
+        header.instrs = [i for i in entry.instrs if i.op != "param"]
+        for instr in header.instrs:
+            instr.block = header
+        for succ in header.succs:
+            for phi in succ.phis():
+                phi.blocks = [header if b is entry else b for b in phi.blocks]
+        jump = fn.number(Instr("jmp", blocks=[header]))
+        jump.block = entry
+        entry.instrs = params + [jump]
+
+        # every use of a parameter now sees the value of the current iteration
+        phis = [fn.number(Instr("phi", ty=p.ty)) for p in fn.params]
+        fn.replace_uses(dict(zip(fn.params, phis)))
+        for param, phi in zip(fn.params, phis):
+            phi.args = [param]
+            phi.blocks = [entry]
+        acc = None
+        if acc_op is not None:
+            acc = fn.number(Instr("phi", [Const(ACCUMULATORS[acc_op])], I64, blocks=[entry]))
+            phis.append(acc)
+        for phi in phis:
+            phi.block = header
+        header.instrs[:0] = phis
+
+        site_blocks = set()
+        for block, call, op in sites:
+            site_blocks.add(block)
+            args = list(call.args)
+            if op is not None:
+                other = op.args[1] if op.args[0] is call else op.args[0]
+                op.args = [acc, other]
+                block.instrs[-3:] = [op]
+                next_acc = op
+            else:
+                block.instrs[-2:] = []
+                next_acc = acc
+            back = fn.number(Instr("jmp", blocks=[header]))
+            back.block = block
+            block.instrs.append(back)
+            for phi, arg in zip(phis, args):
+                phi.args.append(arg)
+                phi.blocks.append(block)
+            if acc is not None:
+                acc.args.append(next_acc)
+                acc.blocks.append(block)
+
+        if acc is not None:
+            # returns that end the recursion apply the pending operations
+            for block in fn.blocks:
+                ret = block.terminator
+                if block in site_blocks or ret is None or ret.op != "ret":
+                    continue
+                value = ret.args[0]
+                if isinstance(value, Const) and value.value == ACCUMULATORS[acc_op]:
+                    ret.args = [acc]
+                    continue
+                total = fn.number(Instr(acc_op, [acc, value], I64))
+                total.block = block
+                block.instrs.insert(len(block.instrs) - 1, total)
+                ret.args = [total]
+
+        fn.compute_preds()
+        self.loops += 1
+
+    def tail_call(self, fn, block):
+        instrs = block.instrs
+        ret = block.terminator
+        if ret is None or ret.op != "ret" or len(instrs) < 2 or instrs[-2].op != "call":
+            return False
+        call = instrs[-2]
+        if call.ty != fn.ret or (ret.args[0] if ret.args else None) is not (call if call.ty else None):
+            return False
+        if call.ty is not None and sum(1 for i in fn.instrs() for a in i.args if a is call) != 1:
+            return False
+        call.op = "tailcall"
+        call.ty = None
+        instrs.pop()
+        self.jumps += 1
+        return True
+
+    def report(self):
+        return f"tailcall: {self.loops} recursive functions turned into loops, {self.jumps} tail calls"
@@ -1,13 +1,60 @@
+from collections import deque
+from lexer.lexer import COL_BITS, COL_MASK
+
+
+# leaves share one immutable empty child list
+NO_CHILDREN = ()
+# words between a struct's name and its body that change how its fields are laid out
+STRUCT_MODIFIERS = ("packed", "reorder")
+
+
 class ASTNode:
-    def __init__(self, type_, value=None, children=None):
+    # node kinds are interned strings, so kind checks compare by identity
+    __slots__ = ("type", "value", "children", "pos", "ty", "sym")
+
+    def __init__(self, type_, value=None, children=None, pos=0):
         self.type = type_
         self.value = value
-        self.children = children or []
+        self.children = children or NO_CHILDREN
+        self.pos = pos
+        # filled in by the semantic pass: resolved type and referenced symbol
+        self.ty = None
+        self.sym = None
+
+    @property
+    def line(self):
+        return self.pos >> COL_BITS
+
+    @property
+    def col(self):
+        return self.pos & COL_MASK
 
     def __repr__(self):
         return f"{self.type}({self.value}, {self.children})"
 
 
+class TokenStream:
+    """Lookahead window over a token iterator, tokens are pulled on demand"""
+
+    def __init__(self, tokens):
+        self.it = iter(tokens)
+        self.ahead = deque()
+        self.current = next(self.it)
+
+    def peek(self, offset=1):
+        ahead = self.ahead
+        while len(ahead) < offset:
+            # past the end keep handing out the final EOF token
+            ahead.append(next(self.it, ahead[-1] if ahead else self.current))
+        return ahead[offset - 1]
+
+    def advance(self):
+        if self.ahead:
+            self.current = self.ahead.popleft()
+        else:
+            self.current = next(self.it, self.current)
+
+
 class Parser:
     TYPE_TOKENS = {
         "INT", "INT16", "INT32", "INT64",
@@ -25,23 +72,24 @@ class Parser:
     }
 
     def __init__(self, tokens):
-        self.tokens = tokens
+        self.tokens = TokenStream(tokens)
         self.pos = 0
         self.typedefs = set()
 
     def current(self):
-        return self.tokens[self.pos]
+        return self.tokens.current
 
     def peek(self, offset=1):
-        return self.tokens[self.pos + offset]
+        return self.tokens.peek(offset)
 
     def advance(self):
         self.pos += 1
+        self.tokens.advance()
 
     def eat(self, t):
         tok = self.current()
         if tok.type != t:
-            raise SyntaxError(f"error: expected {t}, got {tok}")
+            raise SyntaxError(f"error: expected {t}, got {tok} (line {tok.line}, col {tok.col})")
         self.advance()
         return tok
     
@@ -54,7 +102,11 @@ class Parser:
             self.advance()
             return tok
 
-        raise SyntaxError(f"error: expected type, got {tok}")
+        raise SyntaxError(f"error: expected type, got {tok} (line {tok.line}, col {tok.col})")
+
+    def type_base(self, tok):
+        # struct names are identifiers, builtin types are their own token
+        return tok.value if tok.type == "IDENTIFIER" else tok.type
 
     def parse(self):
         nodes = []
@@ -77,14 +129,20 @@ class Parser:
         return self.parse_statement()
     
     def parse_struct(self):
-        self.eat("STRUCT")
+        start = self.eat("STRUCT")
         name = self.eat("IDENTIFIER").value
         self.typedefs.add(name)
+        # layout modifiers are plain words, so they stay usable as names elsewhere
+        fields = []
+        while self.current().type == "IDENTIFIER" and self.current().value in STRUCT_MODIFIERS:
+            tok = self.current()
+            self.advance()
+            fields.append(ASTNode("LAYOUT", tok.value, pos=tok.pos))
         self.eat("LBRACE")
 
-        fields = []
         while self.current().type != "RBRACE":
             field_type_tok = self.eat_type()
+            field_pos = field_type_tok.pos
             is_ptr = False
             if self.current().type == "MULTIPLY":
                 is_ptr = True
@@ -100,13 +158,13 @@ class Parser:
             type_name = base + ("_PTR" if is_ptr else "")
 
             fields.append(
-                ASTNode("FIELD", field_name, [ASTNode("TYPE", type_name)])
+                ASTNode("FIELD", field_name, [ASTNode("TYPE", type_name, pos=field_pos)], field_pos)
             )
 
         self.eat("RBRACE")
         self.eat("SEMICOLON")
 
-        return ASTNode("STRUCT_DEF", name, fields)
+        return ASTNode("STRUCT_DEF", name, fields, start.pos)
 
     def parse_declaration_or_function(self):
         tok = self.current()
@@ -127,26 +185,26 @@ class Parser:
                 is_ptr = True
                 self.advance()
 
-            type_name = return_type_tok.type + ("_PTR" if is_ptr else "")
-            return_type = ASTNode("TYPE", type_name)
+            type_name = self.type_base(return_type_tok) + ("_PTR" if is_ptr else "")
+            return_type = ASTNode("TYPE", type_name, pos=return_type_tok.pos)
 
             self.eat("LBRACE")
             body = self.parse_block()
             self.eat("RBRACE")
 
-            return ASTNode("FUNCTION", name, [return_type, ASTNode("PARAMS", children=params), ASTNode("BODY", children=body)])
+            return ASTNode("FUNCTION", name, [return_type, ASTNode("PARAMS", children=params, pos=tok.pos), ASTNode("BODY", children=body, pos=tok.pos)], tok.pos)
 
         if tok.type == "INCLUDE":
             self.eat("INCLUDE")
             filename = self.eat("STRING").value
             self.eat("SEMICOLON")
-            return ASTNode("INCLUDE", filename)
+            return ASTNode("INCLUDE", filename, pos=tok.pos)
         
         if tok.type == "EXTERN":
             self.eat("EXTERN")
             filename = self.eat("IDENTIFIER").value
             self.eat("SEMICOLON")
-            return ASTNode("EXTERN", filename)
+            return ASTNode("EXTERN", filename, pos=tok.pos)
         
         if tok.type in self.TYPE_TOKENS or (
             tok.type == "IDENTIFIER" and tok.value in self.typedefs
@@ -172,7 +230,7 @@ class Parser:
 
             type_name = base + ("_PTR" if is_ptr else "")
             type_node = ASTNode("TYPE", type_name,
-                                [ASTNode("ARRAY_SIZE", array_size)] if array_size else [])
+                                [ASTNode("ARRAY_SIZE", array_size, pos=tok.pos)] if array_size else [], tok.pos)
 
             if self.current().type == "LPAREN":
                 self.advance()
@@ -181,7 +239,7 @@ class Parser:
                 self.eat("LBRACE")
                 body = self.parse_block()
                 self.eat("RBRACE")
-                return ASTNode("FUNCTION", name, [type_node, ASTNode("PARAMS", children=params), ASTNode("BODY", children=body)])
+                return ASTNode("FUNCTION", name, [type_node, ASTNode("PARAMS", children=params, pos=tok.pos), ASTNode("BODY", children=body, pos=tok.pos)], tok.pos)
 
             init = None
             if self.current().type == "ASSIGN":
@@ -189,13 +247,12 @@ class Parser:
                 init = self.parse_expression()
 
             self.eat("SEMICOLON")
-            return ASTNode("VAR_DECL", name, [type_node, init] if init else [type_node])
+            return ASTNode("VAR_DECL", name, [type_node, init] if init else [type_node], tok.pos)
 
     def parse_parameters(self):
         params = []
         while self.current().type != "RPAREN":
-            t = self.current()
-            self.advance()
+            t = self.eat_type()
             is_ptr = False
 
             if self.current().type == "MULTIPLY":
@@ -203,8 +260,8 @@ class Parser:
                 self.advance()
             
             name = self.eat("IDENTIFIER").value
-            type_name = t.type + ("_PTR" if is_ptr else "")
-            params.append(ASTNode("PARAM", name, [ASTNode("TYPE", type_name)]))
+            type_name = self.type_base(t) + ("_PTR" if is_ptr else "")
+            params.append(ASTNode("PARAM", name, [ASTNode("TYPE", type_name, pos=t.pos)], t.pos))
             
             if self.current().type == "COMMA":
                 self.advance()
@@ -229,7 +286,7 @@ class Parser:
             if self.current().type != "SEMICOLON":
                 expr = self.parse_expression()
             self.eat("SEMICOLON")
-            return ASTNode("RETURN", children=[expr] if expr else [])
+            return ASTNode("RETURN", children=[expr] if expr else [], pos=tok.pos)
 
         if tok.type == "IF":
             return self.parse_if()
@@ -243,26 +300,26 @@ class Parser:
         if tok.type == "BREAK":
             self.advance()
             self.eat("SEMICOLON")
-            return ASTNode("BREAK")
+            return ASTNode("BREAK", pos=tok.pos)
 
         if tok.type == "CONTINUE":
             self.advance()
             self.eat("SEMICOLON")
-            return ASTNode("CONTINUE")
+            return ASTNode("CONTINUE", pos=tok.pos)
 
         expr = self.parse_expression()
         self.eat("SEMICOLON")
         return expr
 
     def parse_unsafe(self):
-        self.eat("UNSAFE")
+        start = self.eat("UNSAFE")
         self.eat("LBRACE")
         body = self.parse_block()
         self.eat("RBRACE")
-        return ASTNode("UNSAFE_BLOCK", children=body)
+        return ASTNode("UNSAFE_BLOCK", children=body, pos=start.pos)
 
     def parse_if(self):
-        self.eat("IF")
+        start = self.eat("IF")
         self.eat("LPAREN")
         cond = self.parse_expression()
         self.eat("RPAREN")
@@ -271,26 +328,28 @@ class Parser:
         self.eat("RBRACE")
 
         else_block = []
+        else_pos = start.pos
         if self.current().type == "ELSE":
+            else_pos = self.current().pos
             self.advance()
             self.eat("LBRACE")
             else_block = self.parse_block()
             self.eat("RBRACE")
 
-        return ASTNode("IF", children=[cond, ASTNode("THEN", children=then), ASTNode("ELSE", children=else_block)])
+        return ASTNode("IF", children=[cond, ASTNode("THEN", children=then, pos=start.pos), ASTNode("ELSE", children=else_block, pos=else_pos)], pos=start.pos)
 
     def parse_while(self):
-        self.eat("WHILE")
+        start = self.eat("WHILE")
         self.eat("LPAREN")
         cond = self.parse_expression()
         self.eat("RPAREN")
         self.eat("LBRACE")
         body = self.parse_block()
         self.eat("RBRACE")
-        return ASTNode("WHILE", children=[cond, ASTNode("BODY", children=body)])
+        return ASTNode("WHILE", children=[cond, ASTNode("BODY", children=body, pos=start.pos)], pos=start.pos)
 
     def parse_for(self):
-        self.eat("FOR")
+        start = self.eat("FOR")
         self.eat("LPAREN")
         init = self.parse_expression() if self.current().type != "SEMICOLON" else None
         self.eat("SEMICOLON")
@@ -301,7 +360,7 @@ class Parser:
         self.eat("LBRACE")
         body = self.parse_block()
         self.eat("RBRACE")
-        return ASTNode("FOR", children=[init, cond, step, ASTNode("BODY", children=body)])
+        return ASTNode("FOR", children=[init, cond, step, ASTNode("BODY", children=body, pos=start.pos)], pos=start.pos)
 
     def parse_expression(self, min_prec=0):
         left = self.parse_primary()
@@ -316,7 +375,7 @@ class Parser:
             if op.type == "POW":
                 next_min_prec = prec
             right = self.parse_expression(next_min_prec)
-            left = ASTNode("BIN_OP", op.type, [left, right])
+            left = ASTNode("BIN_OP", op.type, [left, right], op.pos)
 
         return left
 
@@ -325,69 +384,75 @@ class Parser:
 
         if tok.type == "NUMBER":
             self.advance()
-            return ASTNode("NUMBER", tok.value)
+            return ASTNode("NUMBER", tok.value, pos=tok.pos)
 
         if tok.type == "STRING":
             self.advance()
-            return ASTNode("STRING", tok.value)
+            return ASTNode("STRING", tok.value, pos=tok.pos)
         
         if tok.type == "CHAR_LIT":
             self.advance()
-            return ASTNode("CHAR_LIT", tok.value)
+            return ASTNode("CHAR_LIT", tok.value, pos=tok.pos)
         
         if tok.type == "MULTIPLY":
             self.advance()
             expr = self.parse_primary()
-            return ASTNode("DEREF", children=[expr])
+            return ASTNode("DEREF", children=[expr], pos=tok.pos)
 
         if tok.type == "AMPERSAND":
             self.advance()
             expr = self.parse_primary()
-            return ASTNode("ADDROF", children=[expr])
+            return ASTNode("ADDROF", children=[expr], pos=tok.pos)
 
         if tok.type == "MINUS":
             self.advance()
             expr = self.parse_primary()
-            return ASTNode("UNARY_MINUS", children=[expr])
+            return ASTNode("UNARY_MINUS", children=[expr], pos=tok.pos)
+
+        if tok.type == "NOT":
+            self.advance()
+            expr = self.parse_primary()
+            return ASTNode("NOT", children=[expr], pos=tok.pos)
 
         if tok.type == "INCREMENT":
             self.advance()
             expr = self.parse_primary()
-            return ASTNode("PRE_INC", children=[expr])
+            return ASTNode("PRE_INC", children=[expr], pos=tok.pos)
 
         if tok.type == "DECREMENT":
             self.advance()
             expr = self.parse_primary()
-            return ASTNode("PRE_DEC", children=[expr])
+            return ASTNode("PRE_DEC", children=[expr], pos=tok.pos)
 
         if tok.type == "IDENTIFIER":
             if self.peek().type == "LPAREN":
                 expr = self.parse_call()
             else:
                 self.advance()
-                expr = ASTNode("IDENTIFIER", tok.value)
+                expr = ASTNode("IDENTIFIER", tok.value, pos=tok.pos)
             
             while True:
+                op_pos = self.current().pos
                 if self.current().type == "LBRACKET":
                     self.advance()
                     index = self.parse_expression()
                     self.eat("RBRACKET")
-                    expr = ASTNode("ARRAY_INDEX", children=[expr, index])
+                    expr = ASTNode("ARRAY_INDEX", children=[expr, index], pos=op_pos)
                 elif self.current().type == "INCREMENT":
                     self.advance()
-                    expr = ASTNode("POST_INC", children=[expr])
+                    expr = ASTNode("POST_INC", children=[expr], pos=op_pos)
                 elif self.current().type == "DECREMENT":
                     self.advance()
-                    expr = ASTNode("POST_DEC", children=[expr])
+                    expr = ASTNode("POST_DEC", children=[expr], pos=op_pos)
                 elif self.current().type == "DOT":
                     self.advance()
                     field = self.eat("IDENTIFIER").value
-                    expr = ASTNode("FIELD_ACCESS", field, [expr])
+                    expr = ASTNode("FIELD_ACCESS", field, [expr], op_pos)
 
                 elif self.current().type == "ARROW":
                     self.advance()
                     field = self.eat("IDENTIFIER").value
-                    expr = ASTNode("PTR_FIELD_ACCESS", field, [expr])
+                    expr = ASTNode("PTR_FIELD_ACCESS", field, [expr], op_pos)
                 else:
                     break
             return expr
@@ -398,10 +463,11 @@ class Parser:
             self.eat("RPAREN")
             return expr
 
-        raise SyntaxError(f"Unexpected token {tok}")
+        raise SyntaxError(f"Unexpected token {tok} (line {tok.line}, col {tok.col})")
 
     def parse_call(self):
-        name = self.eat("IDENTIFIER").value
+        tok = self.eat("IDENTIFIER")
+        name = tok.value
         self.eat("LPAREN")
         args = []
         while self.current().type != "RPAREN":
@@ -409,4 +475,4 @@ class Parser:
             if self.current().type == "COMMA":
                 self.advance()
         self.eat("RPAREN")
-        return ASTNode("CALL", name, args)
+        return ASTNode("CALL", name, args, tok.pos)
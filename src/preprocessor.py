@@ -1,43 +1,111 @@
-from lexer.lexer import Lexer
+from lexer.lexer import TableLexer
 from parser.parser import Parser, ASTNode
+from cache import dump_ast, load_ast
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 import os
 
+INCLUDES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "includes")
+
+
+class IncludeResolver:
+    """Maps include names to canonical module paths along the search path"""
+
+    def __init__(self, include_dirs=()):
+        # cwd first, then -I directories in order, then the bundled includes
+        self.search_path = [os.getcwd(), *(os.path.abspath(d) for d in include_dirs), INCLUDES_DIR]
+        self.resolved = {}
+
+    def resolve(self, filename):
+        path = self.resolved.get(filename)
+        if path is not None:
+            return path
+
+        for directory in self.search_path:
+            candidate = os.path.join(directory, filename)
+            if os.path.isfile(candidate):
+                path = os.path.realpath(candidate)
+                self.resolved[filename] = path
+                return path
+
+        raise LookupError(f"Could not find module '{filename}'")
+
+
+def parse_module(path, cache=None):
+    if cache is None:
+        with open(path) as f:
+            return Parser(TableLexer(reader=f).stream()).parse()
+
+    key = cache.key(path)
+    ast = cache.load(key)
+    if ast is None:
+        with open(path) as f:
+            ast = Parser(TableLexer(reader=f).stream()).parse()
+        cache.store(key, ast)
+    return ast
+
+
+def parse_module_flat(path, cache=None):
+    # worker entry point, the flat form pickles far cheaper than a node tree
+    return dump_ast(parse_module(path, cache))
+
+
 class Preprocessor:
-    def __init__(self):
+    def __init__(self, cache=None, include_dirs=(), jobs=1):
         self.included = set()
+        self.cache = cache
+        self.resolver = IncludeResolver(include_dirs)
+        self.jobs = jobs
 
-    def process(self, filename):
-        #prechecks and processing
-        absdir = None
-
+    def resolve(self, filename):
         if not filename.endswith(".oxy"):
             raise LookupError("Module must be a .oxy file")
-        
-        if filename in self.included:
-            return ASTNode("PROGRAM", children=[])
-
-        if filename in os.listdir(os.getcwd()):
-            absdir = filename
-        elif filename in os.listdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "includes")):
-            absdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "includes", filename)
-        else:
-            raise LookupError(f"Could not find module '{filename}'")
-        
-        #then ye
-        self.included.add(filename)
+        return self.resolver.resolve(filename)
 
-        with open(absdir) as f:
-            text = f.read()
+    def process(self, filename):
+        root = self.resolve(filename)
+        if self.jobs > 1:
+            modules = self.parse_parallel(root)
+            return self.splice(root, modules.__getitem__)
+        return self.splice(root, self.parse_file)
 
-        tokens = Lexer(text).tokenize()
-        ast = Parser(tokens).parse()
+    def splice(self, path, load):
+        # modules are deduplicated by canonical path, not by spelling
+        if path in self.included:
+            return ASTNode("PROGRAM", children=[])
+        self.included.add(path)
 
         new_nodes = []
-        for node in ast.children:
+        for node in load(path).children:
             if node.type == "INCLUDE":
-                sub = self.process(node.value)
+                sub = self.splice(self.resolve(node.value), load)
                 new_nodes.extend(sub.children)
             else:
                 new_nodes.append(node)
 
         return ASTNode("PROGRAM", children=new_nodes)
+
+    def parse_file(self, path):
+        return parse_module(path, self.cache)
+
+    def parse_parallel(self, root):
+        """Parse the whole include graph in worker processes, keyed by module path"""
+        modules = {}
+        seen = {root}
+
+        with ProcessPoolExecutor(self.jobs) as pool:
+            pending = {pool.submit(parse_module_flat, root, self.cache): root}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    ast = load_ast(future.result())
+                    modules[pending.pop(future)] = ast
+
+                    # queue newly discovered modules as soon as their includer is parsed
+                    for node in ast.children:
+                        if node.type == "INCLUDE":
+                            dep = self.resolve(node.value)
+                            if dep not in seen:
+                                seen.add(dep)
+                                pending[pool.submit(parse_module_flat, dep, self.cache)] = dep
+
+        return modules
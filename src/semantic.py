@@ -1,16 +1,132 @@
 class SemanticError(Exception):
     pass
 
+INTEGER_TYPES = {"CHAR", "INT", "INT16", "INT32", "INT64"}
+BUILTIN_TYPES = INTEGER_TYPES | {"FLOAT", "VOID"}
+COMPARISONS = {"EQ", "NE", "LT", "LE", "GT", "GE"}
+LOGICAL = {"AND", "OR"}
+ASSIGN_OPS = {"ASSIGN", "PLUS_ASSIGN", "MINUS_ASSIGN", "MULT_ASSIGN", "DIV_ASSIGN", "MOD_ASSIGN"}
+LVALUES = {"IDENTIFIER", "DEREF", "ARRAY_INDEX", "FIELD_ACCESS", "PTR_FIELD_ACCESS"}
+
+# symbols emitted under their plain name, everything else is mangled by signature
+UNMANGLED = ("main", "puts", "display_number", "display_number_nonl", "print_char")
+RUNTIME = ("puts", "display_number", "display_number_nonl", "print_char")
+
+
+def is_pointer(t):
+    return t.endswith("_PTR")
+
+
+def is_integer(t):
+    return t in INTEGER_TYPES
+
+
+def is_scalar(t):
+    return t in INTEGER_TYPES or t == "FLOAT" or is_pointer(t)
+
+
+def pointee(t):
+    return t[:-4]
+
+
+def mangle(name, param_types):
+    if name in UNMANGLED:
+        return name
+    return f"{name}__{'_'.join(param_types)}"
+
+
+class Symbol:
+    __slots__ = ("name", "type", "kind", "node", "target", "params", "array_size")
+
+    def __init__(self, name, type_, kind, node=None, target=None, params=(), array_size=None):
+        self.name = name
+        self.type = type_
+        self.kind = kind          # local, param, global, function, runtime, extern
+        self.node = node
+        self.target = target      # emitted symbol name for callables
+        self.params = params
+        self.array_size = array_size
+
+    def __repr__(self):
+        return f"Symbol({self.kind} {self.name}: {self.type})"
+
+
+class Scope:
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.symbols = {}
+
+    def lookup(self, name):
+        scope = self
+        while scope is not None:
+            sym = scope.symbols.get(name)
+            if sym is not None:
+                return sym
+            scope = scope.parent
+        return None
+
+    def declare(self, sym):
+        if sym.name in self.symbols:
+            raise SemanticError(f"Redeclaration of '{sym.name}' (line {sym.node.line})")
+        self.symbols[sym.name] = sym
+
+
 class SemanticAnalyzer:
+    """Type checks the program and annotates nodes with .ty and .sym for codegen"""
+
     def __init__(self, ast):
         self.ast = ast
         self.functions = {}
+        self.overloads = {}
+        self.structs = {}
+        self.externs = {}
+        self.globals = Scope()
+        self.scope = self.globals
+        self.current = None
+        self.loop_depth = 0
+
+        self.stmt_handlers = {
+            "VAR_DECL": self.check_var_decl,
+            "RETURN": self.check_return,
+            "IF": self.check_if,
+            "WHILE": self.check_while,
+            "FOR": self.check_for,
+            "UNSAFE_BLOCK": self.check_unsafe,
+            "BREAK": self.check_loop_exit,
+            "CONTINUE": self.check_loop_exit,
+        }
+        self.expr_handlers = {
+            "NUMBER": self.type_number,
+            "CHAR_LIT": self.type_char_lit,
+            "STRING": self.type_string,
+            "IDENTIFIER": self.type_identifier,
+            "BIN_OP": self.type_bin_op,
+            "UNARY_MINUS": self.type_unary_minus,
+            "NOT": self.type_not,
+            "DEREF": self.type_deref,
+            "ADDROF": self.type_addrof,
+            "ARRAY_INDEX": self.type_array_index,
+            "FIELD_ACCESS": self.type_field_access,
+            "PTR_FIELD_ACCESS": self.type_field_access,
+            "PRE_INC": self.type_incdec,
+            "PRE_DEC": self.type_incdec,
+            "POST_INC": self.type_incdec,
+            "POST_DEC": self.type_incdec,
+            "CALL": self.type_call,
+        }
 
     def analyze(self):
         self._collect_globals()
         self._check_main()
+        for node in self.ast.children:
+            if node.type == "FUNCTION":
+                self.check_function(node)
 
     def _collect_globals(self):
+        for node in self.ast.children:
+            if node.type == "STRUCT_DEF":
+                self.check_struct(node)
+
         for node in self.ast.children:
             #if node.type == "FUNCTION":
                 #if node.value in self.functions:
@@ -18,17 +134,21 @@ class SemanticAnalyzer:
                 #self.functions[node.value] = node
 
             if node.type == "VAR_DECL":
-                continue
-                
+                self.check_var_decl(node, kind="global")
+
             elif node.type == "FUNCTION":
                 self.functions[node.value] = node
+                self.declare_function(node)
+
+            elif node.type == "EXTERN":
+                self.externs[node.value] = Symbol(node.value, "INT", "extern", node, node.value)
 
             else:
-                if node.type == "INCLUDE" or node.type == "EXTERN" or node.type.startswith("STRUCT"):
+                if node.type == "INCLUDE" or node.type.startswith("STRUCT"):
                     continue
-                
+
                 raise SemanticError(
-                    f"Illegal top-level statement: {node.type}"
+                    f"Illegal top-level statement: {node.type} (line {node.line})"
                 )
 
     def _check_main(self):
@@ -49,3 +169,321 @@ class SemanticAnalyzer:
             raise SemanticError(
                 "'main' must take no parameters"
             )
+
+    def check_struct(self, node):
+        fields = {}
+        for field in node.children:
+            if field.type != "FIELD":
+                continue
+            typ = field.children[0].value
+            if field.value in fields:
+                raise SemanticError(f"Duplicate field '{field.value}' in struct {node.value} (line {field.line})")
+            base = typ
+            while is_pointer(base):
+                base = pointee(base)
+            if base not in BUILTIN_TYPES and base not in self.structs and base != node.value:
+                raise SemanticError(f"Unknown type '{base}' (line {field.line})")
+            # a struct inside another is laid out first, a pointer may point at any struct
+            if typ == node.value or (not is_pointer(typ) and typ not in BUILTIN_TYPES and typ not in self.structs):
+                raise SemanticError(f"Struct {typ} must be defined before struct {node.value} contains it (line {field.line})")
+            if typ == "VOID":
+                raise SemanticError(f"Field '{field.value}' cannot be void (line {field.line})")
+            fields[field.value] = typ
+        self.structs[node.value] = fields
+
+    def check_type(self, t, node):
+        base = t
+        while is_pointer(base):
+            base = pointee(base)
+        if base not in BUILTIN_TYPES and base not in self.structs:
+            raise SemanticError(f"Unknown type '{base}' (line {node.line})")
+
+    def declare_function(self, fn):
+        params = [p.children[0].value for p in fn.children[1].children]
+        for p in fn.children[1].children:
+            self.check_type(p.children[0].value, p)
+        ret_type = fn.children[0].value
+        self.check_type(ret_type, fn)
+
+        target = mangle(fn.value, params)
+        for other in self.overloads.get(fn.value, ()):
+            if other.target == target:
+                raise SemanticError(f"Duplicate function '{fn.value}({', '.join(params)})' (line {fn.line})")
+
+        fn.sym = Symbol(fn.value, ret_type, "function", fn, target, params)
+        self.overloads.setdefault(fn.value, []).append(fn.sym)
+
+    def check_function(self, fn):
+        self.current = fn.sym
+        self.scope = Scope(self.globals)
+
+        for param in fn.children[1].children:
+            param.sym = Symbol(param.value, param.children[0].value, "param", param)
+            param.ty = param.sym.type
+            self.scope.declare(param.sym)
+
+        # the body shares the parameter scope, as in C
+        for stmt in fn.children[2].children:
+            self.check_stmt(stmt)
+
+        self.scope = self.globals
+        self.current = None
+
+    def check_block(self, stmts):
+        self.scope = Scope(self.scope)
+        for stmt in stmts:
+            self.check_stmt(stmt)
+        self.scope = self.scope.parent
+
+    def check_stmt(self, node):
+        handler = self.stmt_handlers.get(node.type)
+        if handler is not None:
+            handler(node)
+        elif node.type in ("STRUCT_DEF", "INCLUDE", "EXTERN"):
+            return
+        elif node.type == "FUNCTION":
+            raise SemanticError(f"Nested function '{node.value}' (line {node.line})")
+        else:
+            self.expr(node)
+
+    def check_var_decl(self, node, kind="local"):
+        type_node = node.children[0]
+        typ = type_node.value
+        self.check_type(typ, node)
+
+        array_size = None
+        if type_node.children and type_node.children[0].type == "ARRAY_SIZE":
+            array_size = type_node.children[0].value
+
+        if len(node.children) > 1:
+            init = node.children[1]
+            self.expr(init)
+            self.check_assignable(init.ty, typ, init)
+
+        # arrays decay to a pointer to their first element
+        sym_type = typ + "_PTR" if array_size else typ
+        node.sym = Symbol(node.value, sym_type, kind, node, array_size=array_size)
+        node.ty = typ
+        self.scope.declare(node.sym)
+
+    def check_return(self, node):
+        ret_type = self.current.type
+        if node.children:
+            value = node.children[0]
+            self.expr(value)
+            if ret_type == "VOID":
+                raise SemanticError(f"'{self.current.name}' returns void but a value is returned (line {node.line})")
+            self.check_assignable(value.ty, ret_type, value)
+        node.ty = ret_type
+
+    def check_if(self, node):
+        cond, then, els = node.children
+        self.check_condition(cond)
+        self.check_block(then.children)
+        self.check_block(els.children)
+
+    def check_while(self, node):
+        self.check_condition(node.children[0])
+        self.loop_depth += 1
+        self.check_block(node.children[1].children)
+        self.loop_depth -= 1
+
+    def check_for(self, node):
+        init, cond, step, body = node.children
+        if init is not None:
+            self.expr(init)
+        if cond is not None:
+            self.check_condition(cond)
+        if step is not None:
+            self.expr(step)
+        self.loop_depth += 1
+        self.check_block(body.children)
+        self.loop_depth -= 1
+
+    def check_unsafe(self, node):
+        self.check_block(node.children)
+
+    def check_loop_exit(self, node):
+        if not self.loop_depth:
+            raise SemanticError(f"{node.type.lower()} outside loop (line {node.line})")
+
+    def check_condition(self, node):
+        self.expr(node)
+        if not is_scalar(node.ty):
+            raise SemanticError(f"Condition must be a scalar, not {node.ty} (line {node.line})")
+
+    def check_assignable(self, src, dst, node):
+        if src == dst or (is_scalar(src) and is_scalar(dst)):
+            return
+        raise SemanticError(f"Cannot convert {src} to {dst} (line {node.line})")
+
+    def expr(self, node):
+        handler = self.expr_handlers.get(node.type)
+        if handler is None:
+            raise SemanticError(f"Unsupported expression {node.type} (line {node.line})")
+        node.ty = handler(node)
+        return node.ty
+
+    def type_number(self, node):
+        return "FLOAT" if isinstance(node.value, float) else "INT"
+
+    def type_char_lit(self, node):
+        return "CHAR"
+
+    def type_string(self, node):
+        return "CHAR_PTR"
+
+    def type_identifier(self, node):
+        sym = self.scope.lookup(node.value)
+        if sym is None:
+            raise SemanticError(f"Undefined variable '{node.value}' (line {node.line})")
+        node.sym = sym
+        return sym.type
+
+    def type_bin_op(self, node):
+        op = node.value
+        left, right = node.children
+        lt = self.expr(left)
+        rt = self.expr(right)
+
+        if op in ASSIGN_OPS:
+            self.check_lvalue(left)
+            self.check_assignable(rt, lt, right)
+            return lt
+
+        for t, side in ((lt, left), (rt, right)):
+            if not is_scalar(t):
+                raise SemanticError(f"Invalid operand of type {t} for {op} (line {side.line})")
+
+        if op in COMPARISONS or op in LOGICAL:
+            return "INT"
+
+        if is_pointer(lt) or is_pointer(rt):
+            if op == "PLUS" and is_pointer(lt) and is_integer(rt):
+                return lt
+            if op == "PLUS" and is_integer(lt) and is_pointer(rt):
+                return rt
+            if op == "MINUS" and is_pointer(lt) and is_integer(rt):
+                return lt
+            if op == "MINUS" and lt == rt:
+                return "INT"
+            raise SemanticError(f"Invalid pointer arithmetic {lt} {op} {rt} (line {node.line})")
+
+        if lt == "FLOAT" or rt == "FLOAT":
+            if op == "MOD":
+                raise SemanticError(f"Operator % needs integer operands (line {node.line})")
+            return "FLOAT"
+        return "INT"
+
+    def type_unary_minus(self, node):
+        t = self.expr(node.children[0])
+        if t == "FLOAT":
+            return t
+        if not is_integer(t):
+            raise SemanticError(f"Cannot negate {t} (line {node.line})")
+        return "INT"
+
+    def type_not(self, node):
+        t = self.expr(node.children[0])
+        if not is_scalar(t):
+            raise SemanticError(f"Invalid operand of type {t} for ! (line {node.line})")
+        return "INT"
+
+    def type_deref(self, node):
+        t = self.expr(node.children[0])
+        if not is_pointer(t):
+            raise SemanticError(f"Cannot dereference non-pointer {t} (line {node.line})")
+        return pointee(t)
+
+    def type_addrof(self, node):
+        target = node.children[0]
+        t = self.expr(target)
+        if target.type not in ("IDENTIFIER", "ARRAY_INDEX", "FIELD_ACCESS", "PTR_FIELD_ACCESS"):
+            raise SemanticError(f"Can only take the address of variables, array elements and fields (line {node.line})")
+        return t + "_PTR"
+
+    def type_array_index(self, node):
+        base, index = node.children
+        bt = self.expr(base)
+        it = self.expr(index)
+        if not is_pointer(bt):
+            raise SemanticError(f"Cannot index non-pointer {bt} (line {node.line})")
+        if not is_integer(it):
+            raise SemanticError(f"Array index must be an integer, not {it} (line {index.line})")
+        return pointee(bt)
+
+    def type_field_access(self, node):
+        base = node.children[0]
+        bt = self.expr(base)
+        struct = bt
+        if node.type == "PTR_FIELD_ACCESS":
+            if not is_pointer(bt):
+                raise SemanticError(f"'->' on non-pointer {bt} (line {node.line})")
+            struct = pointee(bt)
+        fields = self.structs.get(struct)
+        if fields is None:
+            raise SemanticError(f"{bt} is not a struct (line {node.line})")
+        if node.value not in fields:
+            raise SemanticError(f"Struct {struct} has no field '{node.value}' (line {node.line})")
+        return fields[node.value]
+
+    def type_incdec(self, node):
+        target = node.children[0]
+        t = self.expr(target)
+        self.check_lvalue(target)
+        if not (is_integer(t) or is_pointer(t)):
+            raise SemanticError(f"Cannot increment or decrement {t} (line {node.line})")
+        return t
+
+    def check_lvalue(self, node):
+        if node.type not in LVALUES:
+            raise SemanticError(f"Expression is not assignable (line {node.line})")
+
+    def type_call(self, node):
+        arg_types = [self.expr(arg) for arg in node.children]
+        name = node.value
+
+        candidates = self.overloads.get(name)
+        if candidates is None:
+            if name in self.externs:
+                node.sym = self.externs[name]
+                return node.sym.type
+            if name in RUNTIME:
+                node.sym = Symbol(name, "VOID", "runtime", node, name)
+                return "VOID"
+            raise SemanticError(f"Undefined function '{name}' (line {node.line})")
+
+        node.sym = self.resolve_overload(name, candidates, arg_types, node)
+        return node.sym.type
+
+    def conversion_cost(self, src, dst):
+        if src == dst:
+            return 0
+        if is_integer(src) and is_integer(dst):
+            return 1
+        if (is_integer(src) and dst == "FLOAT") or (src == "FLOAT" and is_integer(dst)):
+            return 2
+        return None
+
+    def resolve_overload(self, name, candidates, arg_types, node):
+        best = []
+        best_cost = None
+        for sym in candidates:
+            if len(sym.params) != len(arg_types):
+                continue
+            costs = [self.conversion_cost(a, p) for a, p in zip(arg_types, sym.params)]
+            if None in costs:
+                continue
+            cost = sum(costs)
+            if best_cost is None or cost < best_cost:
+                best, best_cost = [sym], cost
+            elif cost == best_cost:
+                best.append(sym)
+
+        signature = f"{name}({', '.join(arg_types)})"
+        if not best:
+            raise SemanticError(f"No matching overload for {signature} (line {node.line})")
+        if len(best) > 1:
+            options = ", ".join(s.target for s in best)
+            raise SemanticError(f"Ambiguous call {signature}, candidates: {options} (line {node.line})")
+        return best[0]
@@ -1,24 +1,91 @@
-from lexer.lexer import Lexer
-from parser.parser import Parser
-from preprocessor import Preprocessor
-from semantic import SemanticAnalyzer
-from compiler.x86_64_linux import x86_64_Linux
 import os
+import sys
+import argparse
+import tempfile
+import unittest
+import subprocess
+from bench import build, BENCH_DIR
+from optimizer.passes import LEVELS, pipeline
 
-with open("tests.oxy") as f:
-    source = f.read()
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTS_DIR = os.path.join(REPO, "tests")
 
-pp = Preprocessor()
-ast = pp.process("tests.oxy")
-SemanticAnalyzer(ast).analyze()
-print(ast)
+# every program is built once per -O level and must match its .expected output in all of them
+MODES = [(f"O{level}", pipeline(level)) for level in sorted(LEVELS)]
 
-asm = x86_64_Linux(ast).generate()
-print(asm)
 
-os.makedirs("build", exist_ok=True)
-with open("build/out.asm", "w") as f:
-    f.write(asm)
+def programs():
+    found = [os.path.join(REPO, "tests.oxy")]
+    for directory in (TESTS_DIR, BENCH_DIR):
+        if os.path.isdir(directory):
+            found.extend(sorted(os.path.join(directory, name)
+                                for name in os.listdir(directory) if name.endswith(".oxy")))
+    return found
 
-os.system("nasm -felf64 build/out.asm")
-os.system("gcc build/out.o -no-pie")
\ No newline at end of file
+
+def expected_path(source):
+    return os.path.splitext(source)[0] + ".expected"
+
+
+def run(binary):
+    result = subprocess.run([binary], capture_output=True, timeout=60)
+    if result.returncode < 0:
+        raise RuntimeError(f"killed by signal {-result.returncode}")
+    return result.stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the test programs at every -O level and check their output")
+    parser.add_argument("programs", nargs="*", help="Programs to check (default: tests.oxy, tests/*.oxy, src/benchmarks/*.oxy, then the unit tests in tests/test_*.py)")
+    parser.add_argument("--update", action="store_true", help="Rewrite .expected files from the first mode's output")
+    args = parser.parse_args()
+
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for source in args.programs or programs():
+            name = os.path.relpath(source, REPO)
+            path = expected_path(source)
+            expected = None
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    expected = f.read()
+
+            for tag, passes in MODES:
+                try:
+                    binary, _ = build(source, tmp, tag, passes)
+                    output = run(binary)
+                except Exception as e:
+                    print(f"FAIL {name} [{tag}]: {e}")
+                    failed += 1
+                    continue
+
+                if args.update and tag == MODES[0][0]:
+                    with open(path, "wb") as f:
+                        f.write(output)
+                    expected = output
+                    print(f"wrote {os.path.relpath(path, REPO)}")
+
+                if expected is None:
+                    print(f"FAIL {name} [{tag}]: no {os.path.basename(path)}")
+                    failed += 1
+                elif output != expected:
+                    print(f"FAIL {name} [{tag}]: output differs")
+                    print(f"  expected: {expected[:200]!r}")
+                    print(f"  got:      {output[:200]!r}")
+                    failed += 1
+                else:
+                    print(f"ok   {name} [{tag}]")
+
+    # unit tests look at what the output cannot show, like which calls a pass rewrote
+    if not args.programs:
+        suite = unittest.defaultTestLoader.discover(TESTS_DIR, pattern="test_*.py", top_level_dir=TESTS_DIR)
+        result = unittest.TextTestRunner(verbosity=0).run(suite)
+        failed += len(result.failures) + len(result.errors)
+
+    if failed:
+        print(f"{failed} failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from ir.lower import Lowering
+from optimizer.passes import PassManager, pipeline
+from preprocessor import Preprocessor
+from semantic import SemanticAnalyzer
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(TESTS_DIR), "src")
+PROGRAM = os.path.join(TESTS_DIR, "inline.oxy")
+
+
+def lower(passes, options=None):
+    manager = PassManager(passes, options)
+    ast = Preprocessor().process(PROGRAM)
+    SemanticAnalyzer(ast).analyze()
+    ast = manager.run_ast(ast)
+    return manager.run_ir(Lowering(ast).run()), manager
+
+
+def calls(fn):
+    return {i.target for i in fn.instrs() if i.op in ("call", "tailcall")}
+
+
+class InlineTest(unittest.TestCase):
+    def test_callees_without_callers_are_dropped(self):
+        module, _ = lower(pipeline(2))
+        names = {fn.name for fn in module.functions}
+        self.assertEqual(names, {"main", "fact__INT"})
+        self.assertNotIn("clamp__INT_INT_INT", calls(module.function("main")))
+
+    def test_recursive_callee_stays_a_call(self):
+        module, _ = lower(["inline"])
+        self.assertIn("fact__INT", calls(module.function("main")))
+
+    def test_returns_join_in_a_phi(self):
+        module, _ = lower(["inline"])
+        main = module.function("main")
+        # clamp returns from three places
+        self.assertTrue(any(i.op == "phi" and len(i.args) == 3 for i in main.instrs()))
+
+    def test_callee_slots_are_cloned(self):
+        module, _ = lower(["inline"])
+        slots = [s.name for s in module.function("main").slots]
+        self.assertTrue(any(name.endswith(".digit_sum__INT") and name.startswith("d.") for name in slots))
+        self.assertTrue(any(name.endswith(".digit_sum__INT") and name.startswith("t.") for name in slots))
+
+    def test_callee_that_never_returns(self):
+        module, _ = lower(["inline"])
+        self.assertNotIn("hang__", calls(module.function("main")))
+        self.assertNotIn("hang__", {fn.name for fn in module.functions})
+
+    def test_zero_budget_inlines_nothing(self):
+        module, manager = lower(["inline"], {"inline": {"budget": 0}})
+        self.assertIn("inlined 0 calls", manager.reports[0])
+        self.assertIn("clamp__INT_INT_INT", calls(module.function("twice__INT")))
+
+    def test_cli_zero_budget_skips_the_pass(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            result = subprocess.run(
+                [sys.executable, "cli.py", "compile", "-f", PROGRAM, "-o", os.path.join(tmp, "inline.asm"), "-O2",
+                 "--inline-budget", "0", "--no-cache", "--stats", "--dump-ir"],
+                cwd=SRC_DIR, capture_output=True, text=True, check=True)
+        self.assertNotIn("inline:", result.stdout)
+        self.assertIn("call twice__INT(", result.stdout)
+
+
+if __name__ == "__main__":
+    unittest.main()
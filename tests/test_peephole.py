@@ -0,0 +1,57 @@
+import unittest
+
+from compiler.peephole import Peephole
+
+
+def run(*lines):
+    return Peephole().run(list(lines))
+
+
+class PeepholeTest(unittest.TestCase):
+    def test_dead_write(self):
+        self.assertEqual(run("f:", "    mov rcx, 1", "    mov rcx, 2", "    mov rax, rcx", "    ret"),
+                         ["f:", "    mov rcx, 2", "    mov rax, rcx", "    ret"])
+
+    def test_write_read_at_a_jump_target_stays(self):
+        code = ["f:", "    mov rcx, 1", "    test rdi, rdi", "    je .Ldone",
+                "    mov rcx, 2", ".Ldone:", "    mov rax, rcx", "    ret"]
+        self.assertEqual(run(*code), code)
+
+    def test_return_value_stays(self):
+        self.assertEqual(run("f:", "    mov rax, rdi", "    ret"), ["f:", "    mov rax, rdi", "    ret"])
+
+    def test_store_reload(self):
+        self.assertEqual(run("f:", "    mov qword [rbp-8], rcx", "    mov rdx, qword [rbp-8]", "    add rax, rdx", "    ret"),
+                         ["f:", "    mov qword [rbp-8], rcx", "    mov rdx, rcx", "    add rax, rdx", "    ret"])
+
+    def test_op_through_temp(self):
+        self.assertEqual(run("f:", "    mov rcx, rax", "    add rcx, rdx", "    mov rax, rcx", "    ret"),
+                         ["f:", "    add rax, rdx", "    ret"])
+
+    def test_op_through_temp_keeps_a_live_temp(self):
+        code = ["f:", "    mov rcx, rax", "    add rcx, rdx", "    mov rax, rcx", "    imul rax, rcx", "    ret"]
+        self.assertEqual(run(*code), code)
+
+    def test_zero_idiom(self):
+        self.assertEqual(run("f:", "    mov rax, 0", "    ret"), ["f:", "    xor eax, eax", "    ret"])
+
+    def test_zero_idiom_with_live_flags(self):
+        # xor would clobber the flags setl reads
+        code = ["f:", "    cmp rdi, rsi", "    mov rax, 0", "    setl al", "    ret"]
+        self.assertEqual(run(*code), code)
+
+    def test_jump_to_next_keeps_the_label(self):
+        # other jumps may still land on it
+        self.assertEqual(run("f:", "    je .Lnext", "    mov rax, 1", "    jmp .Lnext", ".Lnext:", "    ret"),
+                         ["f:", "    je .Lnext", "    mov rax, 1", ".Lnext:", "    ret"])
+
+    def test_local_labels_resolve_in_their_function(self):
+        # only g's .Lnext jumps on, f's branch must keep its target
+        f = ["f:", "    test rdi, rdi", "    je .Lnext", "    mov rax, 2", "    ret", ".Lnext:", "    mov rax, 1", "    ret"]
+        g = ["g:", "    test rdi, rdi", "    je .Lnext", "    mov rax, 3", "    ret",
+             ".Lout:", "    mov rax, 4", "    ret", ".Lnext:", "    jmp .Lout"]
+        self.assertEqual(run(*f, *g), f + [line.replace("je .Lnext", "je .Lout") for line in g])
+
+
+if __name__ == "__main__":
+    unittest.main()